@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# Benchmarks whole deployments, from scanning the local files to updating
+# the host status, against simulated hosts served by benchmarks/ssh_standin.py
+# on this machine. For each number of hosts it measures a first deployment,
+# a run where nothing has changed and a run after a single file changed.
+# Needs Linux, which routes all of 127.0.0.0/8 to the loopback interface.
+#
+#   python benchmarks/end_to_end.py [--hosts 1,10,100] [--parallel N] [--rtt-ms MS] [--bandwidth-mbit MBIT]
+#                                   [--fail-connect F] [--fail-auth F] [--fail-command F] [--fail-disconnect F]
+#                                   [--files N] [--trace PREFIX] [--output PATH] [--compare PATH]
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_FOLDER = os.path.join(ROOT, "benchmarks", "results")
+PHASES = ["first_deployment", "unchanged", "one_file_changed"]
+
+sys.path.insert(0, ROOT)
+from ssh_standin import Failures, StandIn  # noqa: E402
+
+
+def create_home(home: str, num_files: int) -> None:
+    for i in range(num_files):
+        directory = f"{home}/dotfiles/dir{i % 20}"
+        os.makedirs(directory, exist_ok=True)
+        with open(f"{directory}/file{i}", "w") as f:
+            f.write(f"export VAR{i}={i}\n" * (10 + i % 100))
+
+    with open(f"{home}/init.sh", "w") as f:
+        f.write("echo init\n")
+
+
+def write_config(home: str, port: int) -> None:
+    os.makedirs(f"{home}/.scd", exist_ok=True)
+    config = {
+        "user": "user",
+        "password": "password",
+        "port": port,
+        "timeout": 30,
+        "files": ["~/dotfiles"],
+        "programs": ["tree"],
+        "shell": "bash",
+        "scripts": ["~/init.sh"]
+    }
+    with open(f"{home}/.scd/config", "w") as f:
+        json.dump(config, f)
+
+
+def reset_status(home: str) -> None:
+    for name in os.listdir(f"{home}/.scd"):
+        if name.startswith("server_status"):
+            os.remove(f"{home}/.scd/{name}")
+
+
+def deploy(urls: List[str], parallel: int, verbose: bool, trace: Optional[str]) -> float:
+    from scd.main import SCD
+
+    sys.argv = ["scd", "--parallel", str(parallel), *(["--trace", trace] if trace else []), *urls]
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    start = time.perf_counter()
+    with output:
+        SCD().run()
+    return time.perf_counter() - start
+
+
+def bench_hosts(home: str, num_hosts: int, args: argparse.Namespace) -> Dict[str, Dict]:
+    failures = Failures(args.fail_connect, args.fail_auth, args.fail_command, args.fail_disconnect)
+    bandwidth = args.bandwidth_mbit * 1e6 / 8 if args.bandwidth_mbit else None
+    results = {}
+    with StandIn(num_hosts, rtt=args.rtt_ms / 1000, bandwidth=bandwidth, failures=failures) as stand_in:
+        write_config(home, stand_in.port)
+        reset_status(home)
+        changed_file = f"{home}/dotfiles/dir0/file0"
+
+        for phase in PHASES:
+            if phase == "one_file_changed":
+                with open(changed_file, "a") as f:
+                    f.write("export CHANGED=1\n")
+
+            connections = sum(h.connections for h in stand_in.hosts.values())
+            trace = args.trace and f"{args.trace}-{phase}-{num_hosts}.json"
+            seconds = deploy(stand_in.urls, args.parallel, args.verbose, trace)
+            deployed = [h for h in stand_in.hosts.values() if _is_deployed(h.sandbox, changed_file, home)]
+            result = {
+                "seconds": seconds,
+                "hosts": num_hosts,
+                "hosts_per_second": num_hosts / seconds,
+                "up_to_date_hosts": len(deployed),
+                "failing_hosts": len([h for h in stand_in.hosts.values() if h.failure]),
+                "connections": sum(h.connections for h in stand_in.hosts.values()) - connections
+            }
+            results[f"{phase}.{num_hosts}"] = result
+            print_result(f"{phase}.{num_hosts}", result)
+    return results
+
+
+def _is_deployed(sandbox: str, local_path: str, home: str) -> bool:
+    remote_path = sandbox + local_path[len(home):]
+    if not os.path.isfile(remote_path):
+        return False
+    with open(local_path, "rb") as local, open(remote_path, "rb") as remote:
+        return local.read() == remote.read()
+
+
+def print_result(name: str, result: Dict[str, any]) -> None:
+    print(
+        f"{name:30} {result['seconds'] * 1000:10.1f} ms  {result['hosts_per_second']:8.1f} hosts/s  "
+        f"{result['up_to_date_hosts']}/{result['hosts']} up to date, {result['connections']} connections",
+        flush=True
+    )
+
+
+def compare(results: Dict[str, Dict], path: str) -> None:
+    with open(path) as f:
+        baseline = json.load(f)
+    print(f"\nCompared to {baseline.get('commit')} ({path}):")
+    for name, result in results.items():
+        previous = baseline["results"].get(name)
+        if previous:
+            change = (result["seconds"] / previous["seconds"] - 1) * 100
+            print(f"{name:30} {previous['seconds'] * 1000:10.1f} ms -> {result['seconds'] * 1000:10.1f} ms  {change:+6.1f}%")
+
+
+def current_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip() or "unknown"
+    except OSError:
+        return "unknown"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="End to end benchmarks of scd against simulated hosts.")
+    parser.add_argument("--hosts", type=str, default="1,10,100", help="numbers of simulated hosts, up to 500 (default 1,10,100)")
+    parser.add_argument("--parallel", type=int, default=32, help="number of hosts to deploy to concurrently (default 32)")
+    parser.add_argument("--rtt-ms", type=float, default=0, help="round trip time of the simulated links in milliseconds (default 0)")
+    parser.add_argument("--bandwidth-mbit", type=float, help="bandwidth of each simulated link in megabits per second (default unlimited)")
+    parser.add_argument("--fail-connect", type=float, default=0, help="fraction of the hosts refusing connections")
+    parser.add_argument("--fail-auth", type=float, default=0, help="fraction of the hosts rejecting the password")
+    parser.add_argument("--fail-command", type=float, default=0, help="fraction of the hosts failing every command")
+    parser.add_argument("--fail-disconnect", type=float, default=0, help="fraction of the hosts dropping the connection while receiving files")
+    parser.add_argument("--files", type=int, default=200, help="number of files to deploy (default 200)")
+    parser.add_argument("--verbose", action="store_true", help="show the output of scd")
+    parser.add_argument("--trace", metavar="PREFIX", type=str, help="write a trace of each run to PREFIX-<phase>-<hosts>.json, see scd --trace")
+    parser.add_argument("--output", type=str, help="where to save the results (default benchmarks/results/end_to_end-<commit>.json)")
+    parser.add_argument("--compare", type=str, help="results of an earlier run to compare to")
+    args = parser.parse_args()
+
+    host_counts = [int(h) for h in args.hosts.split(",")]
+    if max(host_counts) > 500:
+        sys.exit("At most 500 hosts can be simulated.")
+    commit = current_commit()
+
+    with tempfile.TemporaryDirectory(prefix="scd_end_to_end_") as home:
+        # Everything scd reads and writes ends up in the temporary home
+        os.environ["HOME"] = home
+        create_home(home, args.files)
+
+        results: Dict[str, Dict] = {}
+        for num_hosts in host_counts:
+            results.update(bench_hosts(home, num_hosts, args))
+
+    output = args.output or os.path.join(RESULTS_FOLDER, f"end_to_end-{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump({
+            "commit": commit,
+            "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "settings": vars(args),
+            "results": results
+        }, f, indent=2)
+    print(f"\nSaved results to {output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
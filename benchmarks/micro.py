@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+# Microbenchmarks of the local hot paths of scd: finding the files to deploy
+# in synthetic dotfile trees, writing the tar file, loading and saving the
+# status of many hosts and printing. The results are saved as JSON, named
+# after the current commit, so that they can be compared between commits.
+#
+#   python benchmarks/micro.py [--sizes 10000,50000,200000] [--repeat N] [--only NAME,...]
+#                              [--output PATH] [--compare PATH]
+
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_FOLDER = os.path.join(ROOT, "benchmarks", "results")
+BENCHMARKS = ["files_to_deploy", "write_tar", "host_status", "printer"]
+URL = "benchmark.host"
+
+IGNORED_FILES = ["*/.git/*", "*/.DS_Store", "*.pyc", "*/node_modules/*"]
+# Of every ten files in the trees, one is in a .git directory and one is matched by another ignore rule
+GIT_FRACTION = 10
+IGNORED_FRACTION = 10
+TAR_FILES = 10000
+STATUS_HOSTS = 10000
+PRINTED_LINES = 100000
+
+
+def create_tree(root: str, num_files: int) -> None:
+    # Both deep and wide: files are spread over directories of a few levels
+    # with many siblings, and every top directory is a repository
+    for i in range(num_files):
+        top = f"{root}/dotfiles/repo{i % 16}"
+        if i % GIT_FRACTION == 0:
+            directory = f"{top}/.git/objects/{i % 256:02x}"
+            name = f"{i:038x}"
+        elif i % IGNORED_FRACTION == 1 and (i // IGNORED_FRACTION) % 2:
+            directory = f"{top}/node_modules/pkg{i % 50}"
+            name = f"index{i}.js"
+        elif i % IGNORED_FRACTION == 1:
+            directory = f"{top}/lib/__pycache__"
+            name = f"module{i}.pyc"
+        else:
+            directory = f"{top}/d{i % 7}/d{i % 11}/d{i % 13}"
+            name = f"file{i}.sh"
+        os.makedirs(directory, exist_ok=True)
+        with open(f"{directory}/{name}", "w") as f:
+            f.write(f"export VAR{i}={i}\n" * (1 + i % 40))
+
+    # Old enough for the scan index to store the listings
+    past = time.time() - 60
+    for directory, _, files in os.walk(root):
+        for path in [directory] + [f"{directory}/{f}" for f in files]:
+            os.utime(path, (past, past))
+
+
+def write_config(home: str) -> None:
+    os.makedirs(f"{home}/.scd", exist_ok=True)
+    config = {
+        "user": "user",
+        "files": ["~/dotfiles"],
+        "ignored_files": IGNORED_FILES
+    }
+    with open(f"{home}/.scd/config", "w") as f:
+        json.dump(config, f)
+
+
+def measure(repeat: int, run: Callable[[], None], setup: Callable[[], None] = None) -> Dict[str, float]:
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    return {"seconds": statistics.median(times), "min_seconds": min(times), "runs": repeat}
+
+
+def bench_files_to_deploy(home: str, sizes: List[int], repeat: int) -> Dict[str, Dict]:
+    from scd.data_structs import empty_status
+    from scd.host_configuration import HostConfiguration
+    from scd.printer import Printer
+    from scd.scanner import ScanIndex, Snapshot
+    from scd.settings import Settings
+
+    results = {}
+    for size in sizes:
+        if os.path.isdir(f"{home}/dotfiles"):
+            shutil.rmtree(f"{home}/dotfiles")
+        create_tree(home, size)
+        settings = Settings()
+        printer = Printer()
+
+        # Nothing deployed yet, every file is hashed
+        def _first_deployment() -> None:
+            HostConfiguration(printer, settings, empty_status(), None)
+
+        deployed = empty_status()
+        deployed.deployed_files = [f.from_path for f in settings.files]
+        deployed.manifest = HostConfiguration(printer, settings, empty_status(), None).manifest
+        files = len(deployed.manifest)
+
+        # Nothing changed since the last deployment, every file is only stat:ed
+        def _unchanged() -> None:
+            HostConfiguration(printer, settings, deployed, None)
+
+        scan_index = ScanIndex(settings.ignored_files)
+        HostConfiguration(printer, settings, deployed, Snapshot(settings.ignored_files, settings.scan_threads, scan_index))
+
+        # As above, but the directory listings come from the scan index
+        def _unchanged_with_index() -> None:
+            HostConfiguration(printer, settings, deployed, Snapshot(settings.ignored_files, settings.scan_threads, scan_index))
+
+        # Every host after the first of a run, which reuses the snapshot of the run
+        snapshot = Snapshot(settings.ignored_files, settings.scan_threads)
+        HostConfiguration(printer, settings, deployed, snapshot)
+
+        def _unchanged_same_run() -> None:
+            HostConfiguration(printer, settings, deployed, snapshot)
+
+        for name, run in [("first_deployment", _first_deployment), ("unchanged", _unchanged), ("unchanged_scan_index", _unchanged_with_index), ("unchanged_same_run", _unchanged_same_run)]:
+            result = measure(repeat, run)
+            result.update(tree_files=size, deployed_files=files, files_per_second=files / result["seconds"])
+            results[f"files_to_deploy.{name}.{size}"] = result
+            print_result(f"files_to_deploy.{name}.{size}", result)
+    return results
+
+
+def bench_write_tar(home: str, repeat: int) -> Dict[str, Dict]:
+    from types import SimpleNamespace
+
+    from scd import compression
+    from scd.artifact_cache import ArtifactCache
+    from scd.config_deployer import ConfigDeployer
+    from scd.data_structs import empty_status
+    from scd.host_configuration import HostConfiguration
+    from scd.printer import Printer
+    from scd.settings import Settings
+
+    if os.path.isdir(f"{home}/dotfiles"):
+        shutil.rmtree(f"{home}/dotfiles")
+    create_tree(home, TAR_FILES)
+    settings = Settings()
+    printer = Printer()
+    files = list(HostConfiguration(printer, settings, empty_status(), None).files)
+    input_bytes = sum(os.path.getsize(f.from_path) for f in files)
+    # The tar file is written without a host to send it to
+    deployer = ConfigDeployer(printer, settings, SimpleNamespace(name=URL), ArtifactCache(0))
+
+    results = {}
+    for spec in [compression.NONE, compression.GZIP, f"{compression.GZIP}:1"]:
+        codec = compression.parse_codec(spec)
+        sink = _Sink()
+
+        def _write_tar() -> None:
+            deployer._write_tar(files, codec.writer(sink), {})
+
+        result = measure(repeat, _write_tar)
+        result.update(files=len(files), input_bytes=input_bytes, megabytes_per_second=input_bytes / result["seconds"] / 1e6)
+        results[f"write_tar.{spec}"] = result
+        print_result(f"write_tar.{spec}", result)
+    return results
+
+
+def bench_host_status(home: str, repeat: int) -> Dict[str, Dict]:
+    from scd.constants import SERVER_STATUS_DB
+    from scd.data_structs import FileData
+    from scd.host_status import HostStatus
+
+    hosts = [f"host{i:05}.example.com" for i in range(STATUS_HOSTS)]
+    files = [FileData(f"{home}/dotfiles/file{i}", f"~/file{i}") for i in range(20)]
+    manifest = {f"/home/user/file{i}": [1000 + i, 1600000000000000000 + i, f"{i:040x}"] for i in range(200)}
+
+    def _remove_db() -> None:
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.isfile(SERVER_STATUS_DB + suffix):
+                os.remove(SERVER_STATUS_DB + suffix)
+
+    def _save_all() -> None:
+        host_status = HostStatus()
+        with host_status.batch():
+            for host in hosts:
+                host_status.add_host_mapping(host, host)
+                host_status.update(host, installed_programs={"git", "zsh"}, deployed_files=files, shell="zsh", scripts=["~/init.sh"], manifest=manifest)
+
+    def _load_all() -> None:
+        host_status = HostStatus()
+        for host in hosts:
+            host_status[host]
+
+    def _update_one() -> None:
+        HostStatus().update(hosts[len(hosts) // 2], installed_programs={"tree"})
+
+    def _find_one() -> None:
+        HostStatus().find(hosts[-1])
+
+    results = {}
+    for name, run, setup in [("save", _save_all, _remove_db), ("load", _load_all, None), ("update_one", _update_one, None), ("find_one", _find_one, None)]:
+        result = measure(repeat, run, setup)
+        result.update(hosts=len(hosts))
+        if name in ("save", "load"):
+            result.update(hosts_per_second=len(hosts) / result["seconds"])
+        results[f"host_status.{name}"] = result
+        print_result(f"host_status.{name}", result)
+    return results
+
+
+def bench_printer(repeat: int) -> Dict[str, Dict]:
+    from scd import colors
+    from scd.output import Output
+    from scd.printer import Printer
+
+    colors.no_color = False
+    results = {}
+    for name, host_width in [("single_host", 0), ("parallel_hosts", 1)]:
+        def _print() -> None:
+            output = Output(stream=io.StringIO())
+            if host_width:
+                output.show_hosts([f"host{i}" for i in range(8)])
+            printers = [Printer(False, output, f"host{i}") for i in range(8)]
+            for i in range(PRINTED_LINES):
+                printers[i % 8].info("Deploying file %s to %s:%s", f"~/dotfiles/file{i}", "host", f"/home/user/file{i}")
+            output.close()
+
+        result = measure(repeat, _print)
+        result.update(lines=PRINTED_LINES, lines_per_second=PRINTED_LINES / result["seconds"])
+        results[f"printer.{name}"] = result
+        print_result(f"printer.{name}", result)
+    colors.no_color = True
+    return results
+
+
+class _Sink:
+    def write(self, data: bytes) -> int:
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+def print_result(name: str, result: Dict[str, any]) -> None:
+    rates = [f"{value:,.0f} {key.replace('_', ' ')}" for key, value in result.items() if key.endswith("_per_second")]
+    print(f"{name:45} {result['seconds'] * 1000:10.1f} ms  {', '.join(rates)}", flush=True)
+
+
+def compare(results: Dict[str, Dict], path: str) -> None:
+    with open(path) as f:
+        baseline = json.load(f)
+    print(f"\nCompared to {baseline.get('commit')} ({path}):")
+    for name, result in results.items():
+        previous = baseline["results"].get(name)
+        if previous:
+            change = (result["seconds"] / previous["seconds"] - 1) * 100
+            print(f"{name:45} {previous['seconds'] * 1000:10.1f} ms -> {result['seconds'] * 1000:10.1f} ms  {change:+6.1f}%")
+
+
+def current_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip() or "unknown"
+    except OSError:
+        return "unknown"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Microbenchmarks of the local hot paths of scd.")
+    parser.add_argument("--sizes", type=str, default="10000,50000,200000", help="number of files in the trees to find files to deploy in (default 10000,50000,200000)")
+    parser.add_argument("--repeat", type=int, default=3, help="number of timed runs of each benchmark, the median is reported (default 3)")
+    parser.add_argument("--only", type=str, default=",".join(BENCHMARKS), help=f"comma separated benchmarks to run (default {','.join(BENCHMARKS)})")
+    parser.add_argument("--output", type=str, help="where to save the results (default benchmarks/results/<commit>.json)")
+    parser.add_argument("--compare", type=str, help="results of an earlier run to compare to")
+    args = parser.parse_args()
+
+    only = args.only.split(",")
+    unknown = [b for b in only if b not in BENCHMARKS]
+    if unknown:
+        sys.exit(f"Unknown benchmarks {', '.join(unknown)}, expected some of {', '.join(BENCHMARKS)}")
+    sizes = [int(s) for s in args.sizes.split(",")]
+    commit = current_commit()
+
+    with tempfile.TemporaryDirectory(prefix="scd_micro_") as home:
+        # Everything scd reads and writes ends up in the temporary home
+        os.environ["HOME"] = home
+        sys.path.insert(0, ROOT)
+        sys.argv = ["scd", URL]
+        write_config(home)
+
+        results: Dict[str, Dict] = {}
+        if "files_to_deploy" in only:
+            results.update(bench_files_to_deploy(home, sizes, args.repeat))
+        if "write_tar" in only:
+            results.update(bench_write_tar(home, args.repeat))
+        if "host_status" in only:
+            results.update(bench_host_status(home, args.repeat))
+        if "printer" in only:
+            results.update(bench_printer(args.repeat))
+
+    output = args.output or os.path.join(RESULTS_FOLDER, f"{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump({
+            "commit": commit,
+            "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "results": results
+        }, f, indent=2)
+    print(f"\nSaved results to {output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,433 @@
+# An in-process stand-in for a fleet of SSH hosts, to benchmark deployments
+# without a network or virtual machines. Every simulated host listens on a
+# loopback address of its own (127.1.x.y, which Linux routes to lo without
+# any setup) and serves exec and SFTP with paramiko. Commands run in bash
+# with the sandbox of the host, a temporary directory, as their home
+# directory, and with no-op stand-ins for sudo, usermod, hostname and the
+# package managers on the PATH. Paths outside of the sandbox can't be
+# reached through SFTP.
+#
+# Each connection goes through a simulated link with a round trip time and
+# bandwidth, and a fraction of the hosts can be made to fail in the ways
+# real hosts do: refusing connections, rejecting the password, failing every
+# command or dropping the connection in the middle of a transfer.
+#
+#   with StandIn(100, rtt=0.05, bandwidth=10e6, failures=Failures(auth=0.01)) as stand_in:
+#       deploy to stand_in.urls on stand_in.port
+
+import errno
+import heapq
+import os
+import random
+import selectors
+import shutil
+import socket
+import stat
+import subprocess
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import paramiko
+from paramiko import SFTPAttributes, SFTPHandle, SFTPServer, SFTPServerInterface
+
+READ_SIZE = 32 * 1024
+
+# Commands the deployments run which need root or would change the machine running the benchmark
+FAKE_COMMANDS = {
+    "sudo": """#!/bin/sh
+while [ $# -gt 0 ]; do
+    case "$1" in
+        --prompt=*|-S|-A|-E|-H|-n) shift ;;
+        -p|-u) shift 2 ;;
+        *) break ;;
+    esac
+done
+exec "$@"
+""",
+    "hostname": '#!/bin/sh\necho "$SCD_STANDIN_HOSTNAME"\n',
+    "usermod": "#!/bin/sh\nexit 0\n",
+    **{manager: "#!/bin/sh\nexit 0\n" for manager in ["apt-get", "yum", "pacman", "emerge", "zypper", "brew"]}
+}
+
+
+# The fraction of the hosts failing in each way, which hosts fail is decided by the seed
+class Failures:
+    def __init__(self, connect=0.0, auth=0.0, command=0.0, disconnect=0.0, seed=0):
+        self.connect = connect
+        self.auth = auth
+        self.command = command
+        self.disconnect = disconnect
+        self.seed = seed
+
+
+class SimulatedHost:
+    CONNECT = "connect"
+    AUTH = "auth"
+    COMMAND = "command"
+    DISCONNECT = "disconnect"
+
+    def __init__(self, address: str, name: str, sandbox: str, failure: Optional[str]):
+        self.address = address
+        self.name = name
+        self.sandbox = sandbox
+        self.failure = failure
+        self.connections = 0
+        self.commands: List[str] = []
+
+
+class StandIn:
+    def __init__(self,
+                 num_hosts: int,
+                 rtt: float = 0.0,
+                 bandwidth: Optional[float] = None,
+                 failures: Optional[Failures] = None,
+                 port: int = 0):
+        # rtt is in seconds and bandwidth in bytes per second, None is unlimited
+        self.rtt = rtt
+        self.bandwidth = bandwidth
+        self.failures = failures or Failures()
+        self.port = port
+        self.root = tempfile.mkdtemp(prefix="scd_standin_")
+        self.bin_folder = os.path.join(self.root, "bin")
+        self.key = paramiko.RSAKey.generate(2048)
+        self.hosts: Dict[str, SimulatedHost] = {}
+        self._sockets: List[socket.socket] = []
+        self._selector = selectors.DefaultSelector()
+        self._running = False
+        self._create_hosts(num_hosts)
+        self.urls = list(self.hosts)
+
+    def __enter__(self) -> "StandIn":
+        self.start()
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    def start(self) -> None:
+        # All hosts listen on the same port, the first one picks it if none was given.
+        # Hosts refusing connections don't listen at all.
+        for address, host in self.hosts.items():
+            if host.failure == SimulatedHost.CONNECT:
+                continue
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((address, self.port))
+            sock.listen(128)
+            sock.setblocking(False)
+            self.port = sock.getsockname()[1]
+            self._sockets.append(sock)
+            self._selector.register(sock, selectors.EVENT_READ, host)
+
+        self._running = True
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def close(self) -> None:
+        self._running = False
+        for sock in self._sockets:
+            self._selector.unregister(sock)
+            sock.close()
+        self._sockets.clear()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def _create_hosts(self, num_hosts: int) -> None:
+        os.makedirs(self.bin_folder)
+        for name, content in FAKE_COMMANDS.items():
+            path = os.path.join(self.bin_folder, name)
+            with open(path, "w") as f:
+                f.write(content)
+            os.chmod(path, 0o755)
+
+        failing = self._assign_failures(num_hosts)
+        for i in range(num_hosts):
+            address = f"127.1.{i // 250}.{i % 250 + 1}"
+            name = f"host{i:04}.standin"
+            sandbox = os.path.join(self.root, name)
+            os.makedirs(sandbox)
+            self.hosts[address] = SimulatedHost(address, name, sandbox, failing.get(i))
+
+    def _assign_failures(self, num_hosts: int) -> Dict[int, str]:
+        rng = random.Random(self.failures.seed)
+        indices = list(range(num_hosts))
+        rng.shuffle(indices)
+        failing: Dict[int, str] = {}
+        for failure, fraction in [(SimulatedHost.CONNECT, self.failures.connect),
+                                  (SimulatedHost.AUTH, self.failures.auth),
+                                  (SimulatedHost.COMMAND, self.failures.command),
+                                  (SimulatedHost.DISCONNECT, self.failures.disconnect)]:
+            count = round(fraction * num_hosts)
+            for index in indices[:count]:
+                failing[index] = failure
+            indices = indices[count:]
+        return failing
+
+    def _accept(self) -> None:
+        while self._running:
+            for key, _ in self._selector.select(timeout=0.2):
+                try:
+                    sock, _ = key.fileobj.accept()
+                except (BlockingIOError, OSError):
+                    continue
+                sock.setblocking(True)
+                threading.Thread(target=self._serve, args=(sock, key.data), daemon=True).start()
+
+    def _serve(self, sock: socket.socket, host: SimulatedHost) -> None:
+        host.connections += 1
+        server_side, link_side = socket.socketpair()
+        _Link(sock, link_side, self.rtt, self.bandwidth).start()
+
+        transport = paramiko.Transport(server_side)
+        transport.add_server_key(self.key)
+        transport.set_subsystem_handler("sftp", SFTPServer, _SandboxedSFTP, host)
+        try:
+            transport.start_server(server=_Server(self, host))
+        except (paramiko.SSHException, EOFError, OSError):
+            transport.close()
+
+
+class _Server(paramiko.ServerInterface):
+    def __init__(self, stand_in: StandIn, host: SimulatedHost):
+        self.stand_in = stand_in
+        self.host = host
+
+    def get_allowed_auths(self, username: str) -> str:
+        return "password,publickey"
+
+    def check_auth_password(self, username: str, password: str) -> int:
+        return paramiko.AUTH_FAILED if self.host.failure == SimulatedHost.AUTH else paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_publickey(self, username: str, key: paramiko.PKey) -> int:
+        return self.check_auth_password(username, "")
+
+    def check_channel_request(self, kind: str, chanid: int) -> int:
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_pty_request(self, *args) -> bool:
+        return True
+
+    def check_channel_exec_request(self, channel: paramiko.Channel, command: bytes) -> bool:
+        self.host.commands.append(command.decode())
+        threading.Thread(target=self._execute, args=(channel, command.decode()), daemon=True).start()
+        return True
+
+    def _execute(self, channel: paramiko.Channel, command: str) -> None:
+        if self.host.failure == SimulatedHost.COMMAND:
+            channel.sendall(b"Simulated failure\n")
+            channel.send_exit_status(1)
+            channel.shutdown_write()
+            return
+
+        env = dict(
+            os.environ,
+            HOME=self.host.sandbox,
+            PATH=f"{self.stand_in.bin_folder}:{os.environ.get('PATH', '')}",
+            SCD_STANDIN_HOSTNAME=self.host.name
+        )
+        process = subprocess.Popen(["bash", "-c", command], cwd=self.host.sandbox, env=env,
+                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+        def _feed_input() -> None:
+            try:
+                for data in iter(lambda: channel.recv(READ_SIZE), b""):
+                    if self.host.failure == SimulatedHost.DISCONNECT:
+                        # Files are sent as the input of a command
+                        channel.get_transport().close()
+                        break
+                    process.stdin.write(data)
+                    process.stdin.flush()
+            except (OSError, ValueError):
+                pass  # The command exited without reading all of its input
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
+
+        threading.Thread(target=_feed_input, daemon=True).start()
+        try:
+            for data in iter(lambda: process.stdout.read1(READ_SIZE), b""):
+                channel.sendall(data)
+            channel.send_exit_status(process.wait())
+            # The client closes the channel, closing it here could overtake
+            # the reply to the exec request and fail the command on the client
+            channel.shutdown_write()
+        except OSError:
+            process.kill()
+
+
+class _SandboxedSFTP(SFTPServerInterface):
+    def __init__(self, server: _Server, host: SimulatedHost, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.host = host
+
+    def _path(self, path: str) -> str:
+        path = os.path.realpath(os.path.join(self.host.sandbox, path))
+        if path != self.host.sandbox and not path.startswith(self.host.sandbox + os.sep):
+            raise OSError(errno.EACCES, os.strerror(errno.EACCES), path)
+        return path
+
+    def open(self, path: str, flags: int, attr: SFTPAttributes):
+        try:
+            fd = os.open(self._path(path), flags, 0o600)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        mode = "ab" if flags & os.O_APPEND else "r+b" if flags & os.O_RDWR else "wb" if flags & os.O_WRONLY else "rb"
+        handle = _FileHandle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def stat(self, path: str):
+        try:
+            return SFTPAttributes.from_stat(os.stat(self._path(path)))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def list_folder(self, path: str):
+        try:
+            folder = self._path(path)
+            return [SFTPAttributes.from_stat(os.stat(os.path.join(folder, f)), f) for f in os.listdir(folder)]
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def remove(self, path: str) -> int:
+        try:
+            os.remove(self._path(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rename(self, old_path: str, new_path: str) -> int:
+        try:
+            os.rename(self._path(old_path), self._path(new_path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def mkdir(self, path: str, attr: SFTPAttributes) -> int:
+        try:
+            os.mkdir(self._path(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def chattr(self, path: str, attr: SFTPAttributes) -> int:
+        try:
+            if attr.st_mode is not None:
+                os.chmod(self._path(path), stat.S_IMODE(attr.st_mode))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+
+class _FileHandle(SFTPHandle):
+    def stat(self):
+        return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+    def chattr(self, attr: SFTPAttributes) -> int:
+        return paramiko.SFTP_OK
+
+
+# Forwards the data of a connection in both directions, each delayed by half
+# the round trip time and limited to the bandwidth. Data is read as soon as
+# it arrives and delivered once it would have crossed the link, so the
+# window sizes of the SSH channels affect throughput like on a real link.
+# The sockets are only shut down by the forwarding threads and closed once
+# both directions are done, since a socket closed while another thread
+# reads from it can have its file descriptor reused by a new connection.
+class _Link:
+    def __init__(self, client: socket.socket, server: socket.socket, rtt: float, bandwidth: Optional[float]):
+        self.client = client
+        self.server = server
+        self.delay = rtt / 2
+        self.bandwidth = bandwidth
+        self._lock = threading.Lock()
+        self._running_directions = 2
+
+    def start(self) -> None:
+        threading.Thread(target=self._forward, args=(self.client, self.server), daemon=True).start()
+        threading.Thread(target=self._forward, args=(self.server, self.client), daemon=True).start()
+
+    def _forward(self, source: socket.socket, destination: socket.socket) -> None:
+        if self.delay == 0 and self.bandwidth is None:
+            self._pipe(source, destination)
+            return
+
+        queue: List[Tuple[float, int, bytes]] = []
+        condition = threading.Condition()
+        threading.Thread(target=self._deliver, args=(queue, condition, destination), daemon=True).start()
+
+        link_free = 0.0
+        sequence = 0
+        while True:
+            data = self._recv(source)
+            now = time.monotonic()
+            # The time it takes to put the data on the link, after what was sent before it
+            link_free = max(now, link_free) + (len(data) / self.bandwidth if self.bandwidth else 0)
+            with condition:
+                heapq.heappush(queue, (link_free + self.delay, sequence, data))
+                sequence += 1
+                condition.notify()
+            if not data:
+                return
+
+    def _deliver(self, queue: List[Tuple[float, int, bytes]], condition: threading.Condition, destination: socket.socket) -> None:
+        while True:
+            with condition:
+                while not queue:
+                    condition.wait()
+                deliver_at, _, data = queue[0]
+                wait = deliver_at - time.monotonic()
+                if wait > 0:
+                    condition.wait(wait)
+                    continue
+                heapq.heappop(queue)
+            if not data or not self._send(destination, data):
+                self._end_of_direction(destination)
+                return
+
+    def _pipe(self, source: socket.socket, destination: socket.socket) -> None:
+        while True:
+            data = self._recv(source)
+            if not data or not self._send(destination, data):
+                self._end_of_direction(destination)
+                return
+
+    def _end_of_direction(self, destination: socket.socket) -> None:
+        self._shutdown(destination, socket.SHUT_WR)
+        with self._lock:
+            self._running_directions -= 1
+            if self._running_directions > 0:
+                return
+        self.client.close()
+        self.server.close()
+
+    def _disconnect(self) -> None:
+        self._shutdown(self.client, socket.SHUT_RDWR)
+        self._shutdown(self.server, socket.SHUT_RDWR)
+
+    def _send(self, sock: socket.socket, data: bytes) -> bool:
+        try:
+            sock.sendall(data)
+            return True
+        except OSError:
+            # The other end is gone, so is the connection
+            self._disconnect()
+            return False
+
+    @staticmethod
+    def _recv(sock: socket.socket) -> bytes:
+        try:
+            return sock.recv(READ_SIZE)
+        except OSError:
+            return b""
+
+    @staticmethod
+    def _shutdown(sock: socket.socket, how: int) -> None:
+        try:
+            sock.shutdown(how)
+        except OSError:
+            pass
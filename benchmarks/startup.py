@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# Measures how long scd takes to find out that a host is already up to date.
+# Since scd runs before every ssh this path has to be fast, and it shouldn't
+# import paramiko or pygments. Exits with a non zero status if it got slower
+# than the given limit or if any of the slow modules are imported.
+#
+#   python benchmarks/startup.py [--runs N] [--max-ms MS] [--files N]
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+URL = "benchmark.host"
+SLOW_MODULES = ["paramiko", "pygments", "scd.host", "scd.config_deployer"]
+
+# Stores the status a successful deployment of the configuration would have left
+SETUP_SCRIPT = f"""
+import sys
+sys.argv = ["scd", "{URL}"]
+from scd.host_configuration import HostConfiguration
+from scd.host_status import HostStatus, empty_status
+from scd.printer import Printer
+from scd.settings import Settings
+
+settings = Settings()
+configuration = HostConfiguration(Printer(), settings, empty_status(), None)
+host_status = HostStatus()
+host_status.add_host_mapping("{URL}", "{URL}")
+host_status.update(
+    "{URL}",
+    installed_programs=set(configuration.programs),
+    deployed_files=settings.files,
+    shell=configuration.shell,
+    scripts=[s.path for s in configuration.scripts],
+    manifest=configuration.manifest
+)
+"""
+
+IMPORT_SCRIPT = f"""
+import sys
+sys.argv = ["scd", "{URL}"]
+from scd.main import main
+try:
+    main()
+except SystemExit:
+    pass
+print(" ".join(m for m in {SLOW_MODULES!r} if m in sys.modules))
+"""
+
+
+def create_home(home: str, num_files: int) -> None:
+    dotfiles = f"{home}/dotfiles"
+    for i in range(num_files):
+        directory = f"{dotfiles}/dir{i % 20}"
+        os.makedirs(directory, exist_ok=True)
+        with open(f"{directory}/file{i}", "w") as f:
+            f.write(f"export VAR{i}={i}\n" * 10)
+
+    with open(f"{home}/init.sh", "w") as f:
+        f.write("echo init\n")
+
+    # Old enough for the scan index to store the listings
+    past = time.time() - 60
+    for directory, _, files in os.walk(home):
+        for path in [directory] + [f"{directory}/{f}" for f in files]:
+            os.utime(path, (past, past))
+
+    os.makedirs(f"{home}/.scd")
+    config = {
+        "user": "user",
+        "files": ["~/dotfiles"],
+        "programs": ["git", "tree"],
+        "shell": "zsh",
+        "scripts": ["~/init.sh"],
+        "ignored_files": ["*/.git/*"]
+    }
+    with open(f"{home}/.scd/config", "w") as f:
+        json.dump(config, f)
+
+
+def run(env: dict, cwd: str, *args: str) -> str:
+    result = subprocess.run([sys.executable, *args], env=env, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode != 0:
+        sys.exit(f"Command {' '.join(args)} failed:\n{result.stdout}{result.stderr}")
+    return result.stdout
+
+
+def time_runs(env: dict, cwd: str, runs: int, *args: str) -> float:
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        run(env, cwd, *args)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1000
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Startup time of scd when there's nothing to deploy.")
+    parser.add_argument("--runs", type=int, default=20, help="number of timed runs (default 20)")
+    parser.add_argument("--max-ms", type=float, default=100, help="fail if scd adds more than this many milliseconds to the startup of the interpreter (default 100)")
+    parser.add_argument("--files", type=int, default=200, help="number of deployed files (default 200)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="scd_startup_") as home:
+        create_home(home, args.files)
+        env = dict(os.environ, HOME=home, PYTHONPATH=ROOT)
+
+        run(env, home, "-c", SETUP_SCRIPT)
+        # The first run creates the scan index
+        output = run(env, home, "-m", "scd.main", "-v", URL)
+        if "Skipping deployment" not in output:
+            sys.exit(f"Expected {URL} to be up to date:\n{output}")
+
+        slow_modules = run(env, home, "-c", IMPORT_SCRIPT).split()
+        interpreter = time_runs(env, home, args.runs, "-c", "pass")
+        scd = time_runs(env, home, args.runs, "-m", "scd.main", URL)
+
+    overhead = scd - interpreter
+    print(f"Interpreter startup: {interpreter:.1f} ms")
+    print(f"scd with nothing to deploy: {scd:.1f} ms ({overhead:.1f} ms over the interpreter, limit {args.max_ms:.0f} ms)")
+
+    failed = False
+    if slow_modules:
+        print(f"Imported on the fast path: {', '.join(slow_modules)}")
+        failed = True
+    if overhead > args.max_ms:
+        print("Startup is slower than the limit")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# Benchmarks uploading a large archive to a simulated host served by
+# benchmarks/ssh_standin.py over a link with a round trip time, comparing
+# streaming it into a command, a single SFTP channel and Host.send_file
+# splitting it over several SFTP channels.
+# Needs Linux, which routes all of 127.0.0.0/8 to the loopback interface.
+#
+#   python benchmarks/upload.py [--size-mb MB] [--rtt-ms MS] [--bandwidth-mbit MBIT] [--channels 1,2,4,8]
+#                               [--repeat N] [--output PATH] [--compare PATH]
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import BinaryIO, Callable, Dict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_FOLDER = os.path.join(ROOT, "benchmarks", "results")
+
+sys.path.insert(0, ROOT)
+from ssh_standin import StandIn  # noqa: E402
+
+
+def write_config(home: str, port: int) -> None:
+    os.makedirs(f"{home}/.scd", exist_ok=True)
+    with open(f"{home}/.scd/config", "w") as f:
+        json.dump({"user": "user", "password": "password", "port": port, "timeout": 60}, f)
+
+
+def create_host(url: str):
+    from scd.host import Host
+    from scd.host_status import HostStatus
+    from scd.printer import Printer
+    from scd.settings import Settings
+
+    sys.argv = ["scd", url]
+    return Host(Printer(), Settings(), HostStatus(), url)
+
+
+def measure(upload: Callable[[], None], size: int, repeat: int) -> Dict[str, float]:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        upload()
+        times.append(time.perf_counter() - start)
+    seconds = statistics.median(times)
+    return {"seconds": seconds, "mbit_per_second": size * 8 / seconds / 1e6}
+
+
+def bench(archive: str, args: argparse.Namespace) -> Dict[str, Dict[str, float]]:
+    from scd.host import Host
+
+    size = os.path.getsize(archive)
+    bandwidth = args.bandwidth_mbit * 1e6 / 8 if args.bandwidth_mbit else None
+    results = {}
+    with StandIn(1, rtt=args.rtt_ms / 1000, bandwidth=bandwidth) as stand_in:
+        write_config(os.environ["HOME"], stand_in.port)
+        simulated_host = stand_in.hosts[stand_in.urls[0]]
+        host = create_host(stand_in.urls[0])
+        remote_path = f"{host.home_path}/upload.bin"
+        received_path = f"{simulated_host.sandbox}/upload.bin"
+
+        def _stream(out: BinaryIO) -> None:
+            with open(archive, "rb") as f:
+                shutil.copyfileobj(f, out, 256 * 1024)
+
+        def _check(name: str, result: Dict[str, float]) -> None:
+            received = os.path.getsize(received_path) if os.path.isfile(received_path) else 0
+            if received != size:
+                sys.exit(f"{name} sent {received} of {size} bytes.")
+            os.remove(received_path)
+            results[name] = result
+            print(f"{name:20} {result['seconds'] * 1000:10.1f} ms  {result['mbit_per_second']:8.1f} Mbit/s", flush=True)
+
+        _check("stdin", measure(lambda: host.execute_command([f"cat > {remote_path}"], echo_commands=False, write_input=_stream), size, args.repeat))
+        for channels in [int(c) for c in args.channels.split(",")]:
+            Host.UPLOAD_CHANNELS = channels
+            Host.PARALLEL_UPLOAD_MIN_SIZE = 0
+            with open(archive, "rb") as f:
+                _check(f"sftp.{channels}", measure(lambda: host.send_file(f, remote_path), size, args.repeat))
+        host.close()
+    return results
+
+
+def compare(results: Dict[str, Dict], path: str) -> None:
+    with open(path) as f:
+        baseline = json.load(f)
+    print(f"\nCompared to {baseline.get('commit')} ({path}):")
+    for name, result in results.items():
+        previous = baseline["results"].get(name)
+        if previous:
+            change = (result["seconds"] / previous["seconds"] - 1) * 100
+            print(f"{name:20} {previous['seconds'] * 1000:10.1f} ms -> {result['seconds'] * 1000:10.1f} ms  {change:+6.1f}%")
+
+
+def current_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip() or "unknown"
+    except OSError:
+        return "unknown"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmarks uploading a large archive to a simulated host.")
+    parser.add_argument("--size-mb", type=int, default=64, help="size of the archive in megabytes (default 64)")
+    parser.add_argument("--rtt-ms", type=float, default=50, help="round trip time of the simulated link in milliseconds (default 50)")
+    parser.add_argument("--bandwidth-mbit", type=float, help="bandwidth of the simulated link in megabits per second (default unlimited)")
+    parser.add_argument("--channels", type=str, default="1,2,4,8", help="numbers of SFTP channels to compare (default 1,2,4,8)")
+    parser.add_argument("--repeat", type=int, default=3, help="number of uploads to take the median of (default 3)")
+    parser.add_argument("--output", type=str, help="where to save the results (default benchmarks/results/upload-<commit>.json)")
+    parser.add_argument("--compare", type=str, help="results of an earlier run to compare to")
+    args = parser.parse_args()
+    commit = current_commit()
+
+    with tempfile.TemporaryDirectory(prefix="scd_upload_") as home:
+        # Everything scd reads and writes ends up in the temporary home
+        os.environ["HOME"] = home
+        archive = f"{home}/archive.bin"
+        with open(archive, "wb") as f:
+            # Random data, as compressed archives are
+            for _ in range(args.size_mb):
+                f.write(os.urandom(1024 * 1024))
+        results = bench(archive, args)
+
+    output = args.output or os.path.join(RESULTS_FOLDER, f"upload-{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump({
+            "commit": commit,
+            "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "settings": vars(args),
+            "results": results
+        }, f, indent=2)
+    print(f"\nSaved results to {output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
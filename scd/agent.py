@@ -0,0 +1,431 @@
+import json
+import os
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+from timeit import default_timer as timer
+from typing import BinaryIO, Dict, Tuple, Optional
+
+import paramiko
+
+from scd.constants import AGENT_SOCKET, SCD_FOLDER
+
+# Frames sent between scd and the agent: one byte kind, four bytes length, payload
+HEADER = b"h"
+STDIN = b"i"
+EOF = b"c"
+OUTPUT = b"o"
+EXIT = b"x"
+ERROR = b"e"
+
+AGENT_START_TIMEOUT = 5
+ACCEPT_TIMEOUT = 1
+
+HostKey = Tuple[str, int, str]
+
+
+def _send_frame(sock: socket.socket, kind: bytes, payload: bytes = b"") -> None:
+    sock.sendall(kind + struct.pack("!I", len(payload)) + payload)
+
+
+def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError("Connection to scd agent closed unexpectedly")
+        data += chunk
+    return data
+
+
+def _recv_frame(sock: socket.socket) -> Tuple[bytes, bytes]:
+    header = _recv_exactly(sock, 5)
+    size = struct.unpack("!I", header[1:])[0]
+    return header[:1], _recv_exactly(sock, size)
+
+
+def _raise_error(payload: bytes) -> None:
+    error = json.loads(payload.decode())
+    kind, message = error["kind"], error["message"]
+    if kind == "auth":
+        raise paramiko.ssh_exception.AuthenticationException(message)
+    if kind == "timeout":
+        raise socket.timeout(message)
+    raise paramiko.ssh_exception.SSHException(message)
+
+
+# Mirrors the parts of paramiko.Channel used by Host
+class AgentChannel:
+    def __init__(self, connection: "AgentConnection"):
+        self.connection = connection
+        self.pty = False
+        self.sock: Optional[socket.socket] = None
+        self.pending_output = b""
+        self.exit_status: Optional[int] = None
+
+    def get_pty(self) -> None:
+        self.pty = True
+
+    def set_combine_stderr(self, _combine: bool) -> None:
+        pass  # The agent always combines stderr with stdout
+
+    def exec_command(self, command: str) -> None:
+        self.sock = self.connection.request("exec", command=command, pty=self.pty)
+
+    def sendall(self, data: bytes) -> None:
+        sock = self.sock
+        if not sock:
+            raise OSError("Channel is closed")
+        _send_frame(sock, STDIN, data)
+
+    def shutdown_write(self) -> None:
+        _send_frame(self.sock, EOF)
+
+    def recv(self, size: int) -> bytes:
+        while not self.pending_output:
+            if not self.read_frame():
+                return b""
+
+        data = self.pending_output[:size]
+        self.pending_output = self.pending_output[size:]
+        return data
+
+    def read_frame(self) -> bool:
+        sock = self.sock
+        if self.exit_status is not None or not sock:
+            return False
+
+        try:
+            kind, payload = _recv_frame(sock)
+        except (EOFError, OSError):
+            if self.sock:
+                self.connection.active = False
+                raise
+            return False  # Closed by another thread, as a channel is
+        if kind == OUTPUT:
+            self.pending_output += payload
+            return True
+        if kind == EXIT:
+            self.exit_status = json.loads(payload.decode())["status"]
+            return False
+        _raise_error(payload)
+
+    def recv_exit_status(self) -> int:
+        while self.read_frame():
+            self.pending_output = b""
+        return self.exit_status if self.exit_status is not None else -1
+
+    def close(self) -> None:
+        sock, self.sock = self.sock, None
+        if sock:
+            # Wakes up a thread waiting for output
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+
+
+class _AgentTransport:
+    def __init__(self, connection: "AgentConnection"):
+        self.connection = connection
+
+    def open_session(self) -> AgentChannel:
+        return AgentChannel(self.connection)
+
+    def is_active(self) -> bool:
+        return self.connection.active
+
+
+class _AgentSFTP:
+    def __init__(self, connection: "AgentConnection"):
+        self.connection = connection
+
+    def putfo(self, file_from: BinaryIO, file_to: str, _file_size: int = 0) -> None:
+        sock = self.connection.request("put", path=file_to)
+        try:
+            for chunk in iter(lambda: file_from.read(paramiko.common.DEFAULT_MAX_PACKET_SIZE), b""):
+                _send_frame(sock, STDIN, chunk)
+            _send_frame(sock, EOF)
+            kind, payload = _recv_frame(sock)
+            if kind != EXIT:
+                _raise_error(payload)
+        finally:
+            sock.close()
+
+    def close(self) -> None:
+        pass
+
+
+# Mirrors the parts of paramiko.SSHClient used by Host. Every channel is a
+# request to the agent, which keeps the transport to the host alive between runs.
+class AgentConnection:
+    def __init__(self, url: str, port: int, user: str, password: Optional[str], private_key: Optional[str], timeout: float, ttl: float):
+        self.host = {
+            "url": url,
+            "port": port,
+            "user": user,
+            "password": password,
+            "private_key": private_key,
+            "timeout": timeout,
+            "ttl": ttl
+        }
+        # The agent reconnects by itself if its transport to the host dies, so
+        # the connection is only dead once talking to the agent has failed
+        self.active = True
+        sock = self.request("connect")
+        try:
+            kind, payload = _recv_frame(sock)
+            if kind != EXIT:
+                _raise_error(payload)
+        finally:
+            sock.close()
+
+    def request(self, op: str, **kwargs) -> socket.socket:
+        sock = None
+        try:
+            sock = _connect_to_agent(self.host["ttl"])
+            header = dict(kwargs, op=op, host=self.host)
+            _send_frame(sock, HEADER, json.dumps(header).encode())
+            return sock
+        except (OSError, paramiko.ssh_exception.SSHException):
+            self.active = False
+            if sock:
+                sock.close()
+            raise
+
+    def get_transport(self) -> _AgentTransport:
+        return _AgentTransport(self)
+
+    def open_sftp(self) -> _AgentSFTP:
+        return _AgentSFTP(self)
+
+    def close(self) -> None:
+        pass
+
+
+def _connect_to_agent(ttl: float) -> socket.socket:
+    sock = _try_connect()
+    if sock:
+        return sock
+
+    subprocess.Popen(
+        [sys.executable, "-m", "scd.agent", str(ttl)],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True
+    )
+
+    start = timer()
+    while timer() - start < AGENT_START_TIMEOUT:
+        sock = _try_connect()
+        if sock:
+            return sock
+        time.sleep(0.02)
+
+    raise paramiko.ssh_exception.SSHException(f"Could not start scd agent at {AGENT_SOCKET}")
+
+
+def _try_connect() -> Optional[socket.socket]:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(AGENT_SOCKET)
+        return sock
+    except (FileNotFoundError, ConnectionRefusedError):
+        sock.close()
+        return None
+
+
+class _Transport:
+    def __init__(self, client: paramiko.SSHClient, ttl: float):
+        self.client = client
+        self.ttl = ttl
+        self.last_used = timer()
+        self.users = 0
+
+
+# Background process keeping SSH transports to recently used hosts alive,
+# similar to an OpenSSH ControlMaster. Transports are closed after being idle
+# for their ttl and the agent exits once it has nothing left to do.
+class Agent:
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.transports: Dict[HostKey, _Transport] = {}
+        self.lock = threading.Lock()
+        self.connect_locks: Dict[HostKey, threading.Lock] = {}
+        self.active_requests = 0
+        self.last_request = timer()
+
+    def serve(self) -> None:
+        if _try_connect():
+            return  # Another agent is already running
+
+        if os.path.exists(AGENT_SOCKET):
+            os.remove(AGENT_SOCKET)
+
+        if not os.path.exists(SCD_FOLDER):
+            os.makedirs(SCD_FOLDER)
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o177)
+        try:
+            server.bind(AGENT_SOCKET)
+        finally:
+            os.umask(old_umask)
+        server.listen(64)
+        server.settimeout(ACCEPT_TIMEOUT)
+
+        try:
+            while not self._should_exit():
+                try:
+                    sock, _ = server.accept()
+                except socket.timeout:
+                    continue
+                sock.settimeout(None)
+                with self.lock:
+                    self.active_requests += 1
+                    self.last_request = timer()
+                threading.Thread(target=self._handle, args=(sock,), daemon=True).start()
+        finally:
+            server.close()
+            if os.path.exists(AGENT_SOCKET):
+                os.remove(AGENT_SOCKET)
+            for transport in self.transports.values():
+                transport.client.close()
+
+    def _should_exit(self) -> bool:
+        with self.lock:
+            now = timer()
+            for key, transport in list(self.transports.items()):
+                if transport.users == 0 and now - transport.last_used > transport.ttl:
+                    transport.client.close()
+                    del self.transports[key]
+
+            return not self.transports and self.active_requests == 0 and now - self.last_request > self.ttl
+
+    def _handle(self, sock: socket.socket) -> None:
+        transport = None
+        try:
+            kind, payload = _recv_frame(sock)
+            request = json.loads(payload.decode())
+            transport = self._get_transport(request["host"])
+            op = request["op"]
+            if op == "connect":
+                _send_frame(sock, EXIT, json.dumps({"status": 0}).encode())
+            elif op == "exec":
+                self._exec(sock, transport.client, request["command"], request.get("pty", False))
+            elif op == "put":
+                self._put(sock, transport.client, request["path"])
+        except paramiko.ssh_exception.AuthenticationException as e:
+            self._send_error(sock, "auth", e)
+        except socket.timeout as e:
+            self._send_error(sock, "timeout", e)
+        except Exception as e:
+            self._send_error(sock, "other", e)
+        finally:
+            with self.lock:
+                self.active_requests -= 1
+                self.last_request = timer()
+                if transport:
+                    transport.users -= 1
+                    transport.last_used = timer()
+            sock.close()
+
+    def _get_transport(self, host: Dict[str, any]) -> _Transport:
+        key = (host["url"], host["port"], host["user"])
+        with self.lock:
+            connect_lock = self.connect_locks.setdefault(key, threading.Lock())
+
+        with connect_lock:
+            with self.lock:
+                transport = self.transports.get(key)
+                paramiko_transport = transport and transport.client.get_transport()
+                if paramiko_transport and paramiko_transport.is_active():
+                    transport.users += 1
+                    transport.ttl = host["ttl"]
+                    return transport
+                if transport:
+                    transport.client.close()
+                    del self.transports[key]
+
+            client = self._connect(host)
+            with self.lock:
+                transport = _Transport(client, host["ttl"])
+                transport.users += 1
+                self.transports[key] = transport
+                return transport
+
+    @staticmethod
+    def _connect(host: Dict[str, any]) -> paramiko.SSHClient:
+        pkey = None
+        if host["private_key"]:
+            path = os.path.expanduser(host["private_key"])
+            pkey = paramiko.RSAKey.from_private_key_file(path, password=host["password"])
+
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        ssh.connect(host["url"], username=host["user"], password=host["password"], port=host["port"], timeout=host["timeout"], pkey=pkey)
+        return ssh
+
+    @staticmethod
+    def _exec(sock: socket.socket, client: paramiko.SSHClient, command: str, pty: bool) -> None:
+        channel = client.get_transport().open_session()
+        if pty:
+            channel.get_pty()
+        channel.set_combine_stderr(True)
+        channel.exec_command(command)
+
+        def _forward_stdin() -> None:
+            try:
+                while True:
+                    kind, payload = _recv_frame(sock)
+                    if kind == STDIN:
+                        channel.sendall(payload)
+                    elif kind == EOF:
+                        channel.shutdown_write()
+            except (EOFError, OSError):
+                pass
+
+        threading.Thread(target=_forward_stdin, daemon=True).start()
+
+        while True:
+            data = channel.recv(paramiko.common.DEFAULT_MAX_PACKET_SIZE)
+            if not data:
+                break
+            _send_frame(sock, OUTPUT, data)
+
+        status = channel.recv_exit_status()
+        channel.close()
+        _send_frame(sock, EXIT, json.dumps({"status": status}).encode())
+
+    @staticmethod
+    def _put(sock: socket.socket, client: paramiko.SSHClient, path: str) -> None:
+        sftp = client.open_sftp()
+        try:
+            with sftp.open(path, "wb") as f:
+                f.set_pipelined(True)
+                while True:
+                    kind, payload = _recv_frame(sock)
+                    if kind != STDIN:
+                        break
+                    f.write(payload)
+        finally:
+            sftp.close()
+        _send_frame(sock, EXIT, json.dumps({"status": 0}).encode())
+
+    @staticmethod
+    def _send_error(sock: socket.socket, kind: str, e: Exception) -> None:
+        try:
+            _send_frame(sock, ERROR, json.dumps({"kind": kind, "message": str(e)}).encode())
+        except OSError:
+            pass
+
+
+if __name__ == "__main__":
+    signal.signal(signal.SIGTERM, lambda _signal, _frame: sys.exit(0))
+    Agent(float(sys.argv[1])).serve()
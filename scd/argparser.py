@@ -5,6 +5,9 @@ from scd.constants import *
 
 
 def _read_description() -> str:
+    if not os.path.isfile("README.md"):
+        return ""
+
     with open("README.md", 'r') as f:
         description = f.read()
 
@@ -13,8 +16,15 @@ def _read_description() -> str:
     return description
 
 
-parser = argparse.ArgumentParser(prog="scd", description=_read_description(),
-                                 formatter_class=argparse.RawTextHelpFormatter)
+class _ArgumentParser(argparse.ArgumentParser):
+    # The description is only read when the help text is printed
+    def format_help(self) -> str:
+        if self.description is None:
+            self.description = _read_description()
+        return super().format_help()
+
+
+parser = _ArgumentParser(prog="scd", formatter_class=argparse.RawTextHelpFormatter)
 parser.add_argument("hosts", type=str, nargs="*",
                     help="the hosts to deploy configuration to")
 parser.add_argument("-P", "--port", dest="port", type=int,
@@ -31,6 +41,32 @@ parser.add_argument("-v", "--verbose", dest="verbose", action="store_true",
                     help="print more output")
 parser.add_argument("-u", "--user", dest="user", type=str,
                     help="the user to authenticate with")
+parser.add_argument("--parallel", metavar="N", dest="parallel", type=int,
+                    help="deploy to up to N hosts concurrently (default 1)")
+parser.add_argument("--plan", dest="plan", action="store_true",
+                    help="print what would be deployed to each host without connecting to them")
+parser.add_argument("--canary", metavar="N", dest="canary", type=int,
+                    help="deploy to the first N hosts and stop if any of them fails before deploying to the rest")
+parser.add_argument("--batch-size", metavar="N", dest="batch_size", type=int,
+                    help="deploy in waves of N hosts, each starting when the previous one has finished")
+parser.add_argument("--max-failures", metavar="N", dest="max_failures", type=str,
+                    help="stop starting new waves once more than N hosts, or N%% of the hosts, have failed")
+parser.add_argument("--probe", dest="probe", action="store_true",
+                    help="connect to all hosts concurrently to cache their hostnames and facts, measure their links and check sudo, without deploying")
+parser.add_argument("--log-folder", metavar="PATH", dest="log_folder", type=str,
+                    help="also write the output of each host to PATH/<host>.log")
+parser.add_argument("--status-table", dest="status_table", action="store_true",
+                    help="show a table with the state of each host instead of their output")
+parser.add_argument("--trace", metavar="PATH", dest="trace", type=str,
+                    help="write the time spent in each phase to PATH in the Chrome trace format")
+parser.add_argument("--profile", metavar="PATH", dest="profile", type=str,
+                    help="write cProfile statistics of the run to PATH")
+parser.add_argument("--compression", metavar="CODEC", dest="compression", type=str,
+                    help="compression of deployed files: auto, none, gzip, xz or zstd with an optional level, e.g. gzip:9")
+parser.add_argument("--delta", dest="delta_transfer", action="store_true",
+                    help="only send the changed blocks of large modified files")
+parser.add_argument("--agent", dest="use_agent", action="store_true",
+                    help="keep connections to hosts alive in a background agent between runs")
 parser.add_argument("--no-color", dest="no_color", action="store_true",
                     help="removes all color from output")
 parser.add_argument("--clear-status", metavar="HOST", dest="clear_status", type=str,
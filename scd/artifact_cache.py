@@ -0,0 +1,144 @@
+import os
+import threading
+from contextlib import contextmanager
+from typing import BinaryIO, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+from scd.compression import Codec
+from scd.constants import ARTIFACT_CACHE_FOLDER
+from scd.data_structs import FileData
+from scd.utils import file_hash
+
+
+class _TeeWriter:
+    def __init__(self, out: BinaryIO, copy: BinaryIO):
+        self.out = out
+        self.copy = copy
+
+    def write(self, data: bytes) -> int:
+        self.out.write(data)
+        self.copy.write(data)
+        return len(data)
+
+
+# Deployment archives stored by a digest of their content so that an archive
+# is only built once for all hosts and runs that need the same set of files.
+# The first host of a run needing an archive that isn't cached streams it
+# instead, copying it into the cache as it goes for the hosts and runs after
+# it. The least recently used archives are removed when the
+# cache grows too big. Archives are handed out as open files so that they can
+# still be read when another thread or process evicts them.
+class ArtifactCache:
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.key_locks: Dict[str, threading.Lock] = {}
+        self.requested_keys: Set[str] = set()
+
+    def is_enabled(self) -> bool:
+        return self.max_size > 0
+
+    # Returns the archive opened for reading, or None if it should be streamed
+    # with tee as no other host of the run has needed it yet
+    def get(self, key: str, create: Callable[[BinaryIO], None]) -> Optional[BinaryIO]:
+        path = self._path(key)
+        with self.lock:
+            is_first_request = key not in self.requested_keys
+            self.requested_keys.add(key)
+
+        with self._key_lock(key):
+            archive = self._open(path)
+            if archive or is_first_request:
+                return archive
+
+            fd, tmp_path = self._create_temporary_file()
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    create(f)
+                archive = open(tmp_path, "rb")
+                os.rename(tmp_path, path)
+            finally:
+                if os.path.isfile(tmp_path):
+                    os.remove(tmp_path)
+
+        self._evict(keep=path)
+        return archive
+
+    # Writes to out and, given a key, to the cache as well. The copy is only stored if the block completes.
+    @contextmanager
+    def tee(self, key: Optional[str], out: BinaryIO) -> Iterator[BinaryIO]:
+        if not key or not self.is_enabled():
+            yield out
+            return
+
+        path = self._path(key)
+        fd, tmp_path = self._create_temporary_file()
+        try:
+            with os.fdopen(fd, "wb") as f:
+                yield _TeeWriter(out, f)
+            with self._key_lock(key):
+                # Another host may have created the archive in the meantime
+                if not os.path.isfile(path):
+                    os.rename(tmp_path, path)
+        finally:
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+        self._evict(keep=path)
+
+    def _key_lock(self, key: str) -> threading.Lock:
+        with self.lock:
+            return self.key_locks.setdefault(key, threading.Lock())
+
+    @staticmethod
+    def _path(key: str) -> str:
+        return f"{ARTIFACT_CACHE_FOLDER}/{key}"
+
+    @staticmethod
+    def _open(path: str) -> Optional[BinaryIO]:
+        # The archive can be evicted by another process at any point, which is a miss
+        try:
+            archive = open(path, "rb")
+            os.utime(archive.fileno())
+            return archive
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def _create_temporary_file() -> Tuple[int, str]:
+        # Written to a temporary file first so other processes never see a partial archive
+        import tempfile
+        os.makedirs(ARTIFACT_CACHE_FOLDER, exist_ok=True)
+        return tempfile.mkstemp(prefix=".tmp_", dir=ARTIFACT_CACHE_FOLDER)
+
+    def _evict(self, keep: str) -> None:
+        with self.lock:
+            entries = []
+            for entry in os.scandir(ARTIFACT_CACHE_FOLDER):
+                if entry.is_file() and not entry.name.startswith(".tmp_"):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue  # Evicted by another process
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+            total_size = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total_size <= self.max_size:
+                    break
+                if path == keep:
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass  # Evicted by another process
+                total_size -= size
+
+    @staticmethod
+    def key(files: List[FileData], codec: Codec) -> str:
+        import hashlib
+        sha1 = hashlib.sha1(str(codec).encode())
+        for file in sorted(files, key=lambda f: f.to_path):
+            content_hash = file.content_hash or file_hash(file.from_path)
+            # The archive also stores the mode and mtime of each file
+            stat = os.stat(file.from_path)
+            sha1.update(f"{file.from_path}\0{file.to_path}\0{content_hash}\0{stat.st_mode}\0{stat.st_mtime_ns}\n".encode())
+        return sha1.hexdigest()
@@ -0,0 +1,125 @@
+import zlib
+from typing import BinaryIO, List, Optional
+
+NONE = "none"
+GZIP = "gzip"
+XZ = "xz"
+ZSTD = "zstd"
+AUTO = "auto"
+
+DEFAULT_LEVELS = {NONE: 0, GZIP: 6, XZ: 6, ZSTD: 3}
+MAX_LEVELS = {NONE: 0, GZIP: 9, XZ: 9, ZSTD: 22}
+EXTRACT_COMMANDS = {
+    NONE: "tar -xf - -C /",
+    GZIP: "tar -xzf - -C /",
+    XZ: "tar -xJf - -C /",
+    ZSTD: "zstd -dcq | tar -xf - -C /"
+}
+
+CODEC_PREFIX = "SCD_CODEC"
+DETECT_COMMAND = f"for p in gzip xz zstd; do if command -v $p >/dev/null; then echo {CODEC_PREFIX} $p; fi; done"
+
+# Throughput in bytes per second above which a link is considered fast or below which it is considered slow
+FAST_LINK = 50 * 1024 * 1024
+SLOW_LINK = 1024 * 1024
+
+
+class Codec:
+    def __init__(self, name: str, level: Optional[int] = None):
+        self.name = name
+        self.level = DEFAULT_LEVELS[name] if level is None else level
+
+    def __str__(self) -> str:
+        return self.name if self.name == NONE else f"{self.name}:{self.level}"
+
+    def extract_command(self) -> str:
+        return EXTRACT_COMMANDS[self.name]
+
+    def writer(self, out: BinaryIO) -> "CompressingWriter":
+        if self.name == GZIP:
+            # wbits 31 produces the gzip format
+            return CompressingWriter(out, zlib.compressobj(self.level, zlib.DEFLATED, 31))
+        if self.name == XZ:
+            import lzma
+            return CompressingWriter(out, lzma.LZMACompressor(preset=self.level))
+        if self.name == ZSTD:
+            import zstandard
+            return CompressingWriter(out, zstandard.ZstdCompressor(level=self.level).compressobj())
+        return CompressingWriter(out, None)
+
+
+class CompressingWriter:
+    def __init__(self, out: BinaryIO, compressor):
+        self.out = out
+        self.compressor = compressor
+        self.bytes_written = 0
+
+    def write(self, data: bytes) -> int:
+        self._write(self.compressor.compress(data) if self.compressor else data)
+        return len(data)
+
+    def close(self) -> None:
+        if self.compressor:
+            self._write(self.compressor.flush())
+
+    def _write(self, data: bytes) -> None:
+        if data:
+            self.out.write(data)
+            self.bytes_written += len(data)
+
+
+def parse_codec(spec: str) -> Optional[Codec]:
+    name, _, level = spec.partition(":")
+    if name not in DEFAULT_LEVELS or (level and not level.isdigit()):
+        return None
+    if level and not 0 <= int(level) <= MAX_LEVELS[name]:
+        return None
+    return Codec(name, int(level) if level else None)
+
+
+def is_valid_spec(spec: str) -> bool:
+    return spec == AUTO or parse_codec(spec) is not None
+
+
+def local_codecs() -> List[str]:
+    codecs = [NONE, GZIP, XZ]
+    # Only imported once files are deployed, it's an optional dependency
+    try:
+        import zstandard
+        codecs.append(ZSTD)
+    except ImportError:
+        pass
+    return codecs
+
+
+def parse_remote_codecs(lines: List[str]) -> List[str]:
+    codecs = [NONE]
+    for line in lines:
+        parts = line.split(" ")
+        if len(parts) == 2 and parts[0] == CODEC_PREFIX:
+            codecs.append(parts[1])
+    return codecs
+
+
+def needs_remote_codecs(spec: str) -> bool:
+    return spec not in (NONE, GZIP) and not spec.startswith(GZIP + ":")
+
+
+def select_codec(spec: str, remote_codecs: List[str], throughput: Optional[float]) -> Codec:
+    available = [c for c in local_codecs() if c in remote_codecs]
+    if spec != AUTO:
+        codec = parse_codec(spec)
+        return codec if codec.name in available else Codec(GZIP)
+
+    def _first_available(*codecs: Codec) -> Codec:
+        return next(c for c in codecs if c.name in available)
+
+    # Cheap compression on fast links where CPU is the bottleneck and strong
+    # compression on slow links where the transfer is
+    if throughput is None:
+        return Codec(GZIP)
+    if throughput >= FAST_LINK:
+        return _first_available(Codec(ZSTD, 1), Codec(NONE))
+    if throughput <= SLOW_LINK:
+        return _first_available(Codec(ZSTD, 19), Codec(XZ, 6), Codec(GZIP, 9), Codec(NONE))
+    return _first_available(Codec(ZSTD, 3), Codec(GZIP, 6), Codec(NONE))
@@ -1,167 +1,381 @@
 import os
+import shlex
+import shutil
 import tarfile
-from typing import List, Callable
+from typing import BinaryIO, Dict, List, Callable, Optional, Set, Tuple
 
+from scd import compression, facts, tracing
+from scd.artifact_cache import ArtifactCache
 from scd.colors import *
 from scd.constants import *
-from scd.data_structs import DeploymentException, FileData
+from scd.data_structs import DeploymentException, FileData, ScriptData
+from scd.compression import Codec
+from scd.execution_plan import ExecutionPlan, Step, WriteInput
+from scd.delta import DELTA_SUFFIX, block_size_for, signature_command, patch_command, parse_signatures, write_delta
 from scd.host import Host
+from scd.host_configuration import HostConfiguration
 from scd.printer import Printer
+from scd.settings import Settings
 from scd.utils import *
 
 
 class ConfigDeployer:
     MAX_FILES_TO_PRINT = 10
+    DELTA_MIN_SIZE = 1024 * 1024
+    MIN_THROUGHPUT_SAMPLE = 256 * 1024
+    COPY_BUFFER_SIZE = 256 * 1024
+    REMOTE_SCRIPT_FOLDER = ".scd_scripts"
 
-    def __init__(self, printer: Printer, host: Host):
+    def __init__(self, printer: Printer, settings: Settings, host: Host, artifact_cache: ArtifactCache):
         self.printer = printer
+        self.settings = settings
         self.host = host
+        self.artifact_cache = artifact_cache
+        # The transfer of the files is timed from when sending starts until the
+        # files step has finished on the host
+        self.transfer_start: Optional[float] = None
+        self.transfer_end: Optional[float] = None
+        self.bytes_sent = 0
+        # The cached archive being deployed, kept open until the deployment has ended
+        self.archive: Optional[BinaryIO] = None
 
-    def install_programs(self, programs: List[str]) -> None:
-        if len(programs) == 0:
+    def deploy(self, configuration: HostConfiguration) -> ExecutionPlan:
+        plan = ExecutionPlan(self.settings.output_lines)
+        deltas: Dict[FileData, str] = {}
+        try:
+            # The scripts are deployed together with the files, which go first
+            # so their data is consumed before the other steps produce any output
+            script_steps, script_files = self._plan_scripts(configuration.scripts)
+            self._plan_files(plan, configuration.files, script_files, deltas)
+            self._plan_programs(plan, configuration.programs)
+            self._plan_shell(plan, configuration.shell)
+            for step in script_steps:
+                plan.add(step)
+            self._execute(plan, self._scripts_use_sudo(configuration.scripts, script_files))
+        finally:
+            for delta_path in deltas.values():
+                remove_temporary_file(delta_path)
+            if self.archive:
+                self.archive.close()
+        return plan
+
+    def _execute(self, plan: ExecutionPlan, uses_sudo: bool) -> None:
+        if plan.is_empty():
             return
 
+        # The output is printed as it arrives and each step is reported as soon as it finishes
+        def _on_line(line: str) -> None:
+            step = plan.feed(line)
+            if step:
+                self._report(step)
+            else:
+                self.printer.info([magenta(line) if line.startswith("+") else line], verbose=True)
+
+        # Sessions given input get no pty, which sudo needs on hosts requiring
+        # a tty. The input is then uploaded first so the plan can run with one.
+        if plan.write_input() and self.host.needs_password(plan.commands(), uses_sudo):
+            self._upload_input(plan)
+
         start = timer()
+        exit_code, _ = self.host.execute_command(
+            plan.commands(),
+            exit_on_failure=False,
+            echo_commands=False,
+            write_input=plan.write_input(),
+            uses_sudo=uses_sudo,
+            on_line=_on_line
+        )
+        interrupted_step = plan.finish(exit_code)
+        if interrupted_step:
+            self._report(interrupted_step)
+        self._update_throughput()
+        self.printer.info("Executed %s steps on host %s in %s s.", len([s for s in plan.steps if s.has_run()]), self.host.name, get_time(start), verbose=True)
+
+    def _report(self, step: Step) -> None:
+        if step.skipped:
+            self.printer.error("Skipped %s %s, it runs after a %s that failed.", step.kind, step.name, step.kind)
+            return
+
+        # The step ran on the host, so its span ends when its result arrives
+        end = timer()
+        name = step.kind if step.name == step.kind else f"{step.kind} {step.name}"
+        tracing.record(name, end - (step.elapsed or 0), end, exit_code=step.exit_code, output_lines=step.line_count)
+
+        elapsed = "%.2f" % (step.elapsed or 0)
+        self._handle_result(step.exit_code, step.output, step.line_count, lambda: step.on_success(elapsed), step.on_error)
+
+    @staticmethod
+    def _scripts_use_sudo(scripts: List[ScriptData], script_files: List[FileData]) -> bool:
+        if any(s.as_sudo for s in scripts):
+            return True
+        for file in script_files:
+            with open(file.from_path, errors="replace") as f:
+                if "sudo" in f.read():
+                    return True
+        return False
+
+    def _plan_programs(self, plan: ExecutionPlan, programs: List[str]) -> None:
+        if len(programs) == 0:
+            return
 
         self.printer.info("Installing " + ", ".join([magenta(p) for p in programs]))
 
-        select_package_manager = f"""
-            if [ -f /etc/redhat-release ]; then
-                PACKAGE_MANAGER="yum"
-                ANSWER_YES="-y"
-            elif [ -f /etc/arch-release ]; then
-                PACKAGE_MANAGER="pacman"
-                ANSWER_YES="--noconfirm"
-            elif [ -f /etc/gentoo-release ]; then
-                PACKAGE_MANAGER="emerge"
-                ANSWER_YES=""
-            elif [ -f /etc/SuSE-release ]; then
-                PACKAGE_MANAGER="zypper"
-                ANSWER_YES="-n"
-            elif [ -f /etc/debian_version ]; then
-                PACKAGE_MANAGER="apt-get"
-                ANSWER_YES="-y"
-            elif [ "$(uname)" == "Darwin" ]; then
-                PACKAGE_MANAGER="brew"
-                ANSWER_YES=""
-            else
-                echo "Unsupported distribution."
-                exit 1
-            fi
-            sudo $PACKAGE_MANAGER $ANSWER_YES install {" ".join(programs)}
-        """
-
-        lines = trim_multiline_str(select_package_manager).split("\n")
-        exit_code, output = self.host.execute_command(lines)
-        elapsed_time = get_time(start)
-        self._handle_result(
-            exit_code,
-            output,
-            lambda: self.printer.success("Successfully installed needed programs in %s s.", elapsed_time, verbose=True),
-            lambda: self.printer.error("Failed to install programs."))
-        if exit_code != 0:
-            raise DeploymentException
+        command = facts.install_command(self.host.status.facts or {}, programs)
+        commands = [command] if command else ['echo "Unsupported distribution."', "exit 1"]
+
+        plan.add(Step(
+            Step.PROGRAMS,
+            commands,
+            on_success=lambda elapsed: self.printer.success("Successfully installed needed programs in %s s.", elapsed, verbose=True),
+            on_error=lambda: self.printer.error("Failed to install programs.")
+        ))
 
-    def change_shell(self, shell: str) -> None:
+    def _plan_shell(self, plan: ExecutionPlan, shell: str) -> None:
         if not shell:
             return
 
-        start = timer()
         self.printer.info("Changing default shell to %s", shell)
         user = self.host.user
-        command = [f"sudo usermod -s $(which {shell}) {user}"]
-
-        exit_code, output = self.host.execute_command(command)
-        elapsed_time = get_time(start)
-        self._handle_result(
-            exit_code,
-            output,
-            lambda: self.printer.success("Successfully changed default shell to %s for user %s in %s s.", shell, user, elapsed_time, verbose=True),
-            lambda: self.printer.error("Failed to change shell to %s for user %s.", shell, user))
-        if exit_code != 0:
-            raise DeploymentException
+        plan.add(Step(
+            Step.SHELL,
+            [f"sudo usermod -s $(which {shell}) {user}"],
+            on_success=lambda elapsed: self.printer.success("Successfully changed default shell to %s for user %s in %s s.", shell, user, elapsed, verbose=True),
+            on_error=lambda: self.printer.error("Failed to change shell to %s for user %s.", shell, user)
+        ))
 
-    def deploy_files(self, files: List[FileData]) -> None:
-        if len(files) == 0:
+    def _plan_files(self, plan: ExecutionPlan, files: List[FileData], script_files: List[FileData], deltas: Dict[FileData, str]) -> None:
+        if len(files) == 0 and len(script_files) == 0:
             return
 
-        start = timer()
-        files_str = "file" if len(files) == 1 else "files"
-        self.printer.info(f"Deploying %s {files_str}", len(files))
-        if len(files) < self.MAX_FILES_TO_PRINT:
-            self.printer.info([magenta(f.from_path) for f in files])
-        self._create_tar(files)
-        home = "/home/%s" % self.host.user
-        remote_tar_path = f"{home}/{TAR_NAME}"
-        self.host.send_file(TAR_PATH, remote_tar_path)
-        os.remove(TAR_PATH)
-        commands = [
-            f"tar -xzf {remote_tar_path} -C /",
-            f"rm {remote_tar_path}"
-        ]
-        exit_code, output = self.host.execute_command(commands)
-        elapsed_time = get_time(start)
-        self._handle_result(
-            exit_code,
-            output,
-            lambda: self.printer.success("Successfully deployed %s configuration files to host in %s s.", len(files), elapsed_time, verbose=True),
-            lambda: self.printer.error("Failed to deploy configuration files to host."))
-        if exit_code != 0:
-            raise DeploymentException
+        if len(files) > 0:
+            files_str = "file" if len(files) == 1 else "files"
+            self.printer.info(f"Deploying %s {files_str}", len(files))
+            if len(files) < self.MAX_FILES_TO_PRINT:
+                self.printer.info([magenta(f.from_path) for f in files])
+        if self.settings.delta_transfer:
+            deltas.update(self._create_deltas(files))
+        codec = self._select_codec()
+        commands = [codec.extract_command()]
+        if deltas:
+            commands.append(patch_command([f.to_path for f in deltas]))
 
-    def run_scripts(self, scripts: List[str]) -> List[str]:
-        if len(scripts) == 0:
-            return []
+        archive_files = list(files) + script_files
+        input_path = None
+        if deltas or not self.artifact_cache.is_enabled():
+            write_input = self._stream_tar(archive_files, codec, deltas)
+        else:
+            key = self.artifact_cache.key(archive_files, codec)
+            self.archive = self._get_cached_tar(key, archive_files, codec)
+            if not self.archive:
+                write_input = self._stream_tar(archive_files, codec, deltas, cache_key=key)
+            elif self.host.prefers_parallel_upload(os.fstat(self.archive.fileno()).st_size):
+                # Large archives on links with a high latency are uploaded over several channels first and extracted from the uploaded file
+                input_path = self._upload_archive(self.archive)
+                write_input = None
+            else:
+                write_input = self._send_cached_tar(self.archive, len(archive_files))
+        if script_files:
+            # Also removes copies of scripts whose steps never ran, as when an earlier deployment failed
+            commands.insert(0, f"rm -rf {shlex.quote(f'{self.host.home_path}/{self.REMOTE_SCRIPT_FOLDER}')}")
 
-        executed_scripts: List[str] = []
-        for script in scripts:
-            if self.run_script(script):
-                executed_scripts.append(script)
+        plan.add(Step(
+            Step.FILES,
+            commands,
+            write_input=write_input,
+            input_path=input_path,
+            on_success=lambda elapsed: self._on_files_deployed(len(files), elapsed),
+            on_error=lambda: self.printer.error("Failed to deploy configuration files to host.")
+        ))
 
-        return executed_scripts
+    def _on_files_deployed(self, num_files: int, elapsed: str) -> None:
+        self.transfer_end = timer()
+        self.printer.success("Successfully deployed %s configuration files to host in %s s.", num_files, elapsed, verbose=True)
 
-    def run_script(self, script: str) -> bool:
-        start = timer()
+    def _plan_scripts(self, scripts: List[ScriptData]) -> Tuple[List[Step], List[FileData]]:
+        # The scripts run in parallel unless they depend on each other, see ExecutionPlan._group_commands
+        steps: List[Step] = []
+        executed_scripts = set(self.host.status.executed_scripts)
+        planned_scripts = {s.path for s in scripts}
+        unavailable: Set[str] = set()
+        script_files: List[FileData] = []
+        for index, script in enumerate(scripts):
+            full_path = os.path.expanduser(script.path)
+            if not os.path.isfile(full_path):
+                self.printer.error("Can't execute script %s, no such file.", script.path)
+                unavailable.add(script.path)
+                continue
 
-        self.printer.info("Executing script %s.", script)
-        full_path = os.path.expanduser(script)
-        if not os.path.isfile(full_path):
-            self.printer.error("Can't execute script %s, no such file.", script)
-            return False
+            missing = [a for a in script.after if a in unavailable or (a not in planned_scripts and a not in executed_scripts)]
+            if missing:
+                self.printer.error("Can't execute script %s, it runs after %s which can't be executed.", script.path, ", ".join(missing))
+                unavailable.add(script.path)
+                continue
 
-        with open(full_path) as script_file:
-            script_content = [s for s in script_file.read().split("\n") if s]
+            self.printer.info("Executing script %s.", script.path)
+            remote_path = f"{self.host.home_path}/{self.REMOTE_SCRIPT_FOLDER}/{index}_{os.path.basename(full_path)}"
+            script_files.append(FileData(full_path, remote_path))
+            # Sourced rather than executed so the script runs like commands sent to the host do.
+            # The copy is removed once the step ends, however the script exits, and
+            # the folder with it once the last script has ended.
+            command = 'sudo sh -x "$SCD_SCRIPT"' if script.as_sudo else '. "$SCD_SCRIPT"'
+            cleanup = 'rm -f "$SCD_SCRIPT"; rmdir "${SCD_SCRIPT%/*}" 2>/dev/null || true'
 
-        exit_code, output = self.host.execute_command(script_content, exit_on_failure=False)
+            steps.append(Step(
+                Step.SCRIPT,
+                [f"SCD_SCRIPT={shlex.quote(remote_path)}", f"trap {shlex.quote(cleanup)} EXIT", command],
+                name=script.path,
+                exit_on_failure=False,
+                parallel=True,
+                after=script.after,
+                on_success=lambda elapsed, path=script.path: self.printer.success("Successfully executed script %s on host %s in %s s.", path, self.host.name, elapsed, verbose=True),
+                on_error=lambda path=script.path: self.printer.error("Failed executing script %s on host %s.", path, self.host.name)
+            ))
 
-        elapsed_time = get_time(start)
-        self._handle_result(
-            exit_code,
-            output,
-            lambda: self.printer.success("Successfully executed script %s on host %s in %s s.", script, self.host.name, elapsed_time, verbose=True),
-            lambda: self.printer.error("Failed executing script %s on host %s.", script, self.host.name))
-        return exit_code == 0
+        return steps, script_files
 
-    def _handle_result(self, exit_code: int, lines: List[str], on_success: Callable[[], None], on_error: Callable[[], None]) -> None:
+    def _handle_result(self, exit_code: int, lines: List[str], line_count: int, on_success: Callable[[], None], on_error: Callable[[], None]) -> None:
         if exit_code == 0:
-            self.printer.info("Output:", verbose=True)
-            self.printer.info([magenta(l) if l.startswith("+") else l for l in lines], verbose=True)
             on_success()
-        else:
-            self.printer.error("Exit code %s:", exit_code)
+            return
+
+        # In verbose mode the output has already been printed as it arrived
+        self.printer.error("Exit code %s:", exit_code)
+        if not self.settings.verbose:
+            if line_count > len(lines):
+                self.printer.error("Showing the last %s of %s lines of output:", len(lines), line_count)
             self.printer.error([magenta(l) if l.startswith("+") else red(l) for l in lines])
-            on_error()
+        on_error()
+
+    def _create_deltas(self, files: List[FileData]) -> Dict[FileData, str]:
+        manifest = self.host.status.manifest
+        candidates = [f for f in files if f.to_path in manifest and os.path.getsize(f.from_path) >= self.DELTA_MIN_SIZE]
+        if len(candidates) == 0:
+            return {}
+
+        with tracing.span("create deltas", files=len(candidates)):
+            return self._create_deltas_of(candidates)
+
+    def _create_deltas_of(self, candidates: List[FileData]) -> Dict[FileData, str]:
+        start = timer()
+        self.printer.info("Fetching block checksums of %s files from host.", len(candidates), verbose=True)
+        remote_files = [(block_size_for(os.path.getsize(f.from_path)), f.to_path) for f in candidates]
+        output: List[str] = []
+        exit_code, _ = self.host.execute_command([signature_command(remote_files)], echo_commands=False, on_line=output.append)
+        if exit_code != 0:
+            self.printer.info("Could not fetch block checksums, deploying whole files instead.", verbose=True)
+            return {}
+
+        deltas: Dict[FileData, str] = {}
+        for index, signature in parse_signatures(output, remote_files).items():
+            file = candidates[index]
+            delta_path = create_temporary_file(os.path.basename(file.to_path) + DELTA_SUFFIX)
+            with open(delta_path, "wb") as f:
+                is_smaller = write_delta(file.from_path, os.stat(file.from_path).st_mode & 0o7777, signature, f)
+
+            if is_smaller:
+                deltas[file] = delta_path
+                self.printer.info("Deploying %s as a delta of %s bytes.", file.from_path, os.path.getsize(delta_path), verbose=True)
+            else:
+                remove_temporary_file(delta_path)
+
+        self.printer.info("Created %s deltas in %s s.", len(deltas), get_time(start), verbose=True)
+        return deltas
+
+    def _stream_tar(self, files: List[FileData], codec: Codec, deltas: Dict[FileData, str], cache_key: Optional[str]=None) -> WriteInput:
+        # The tar file is streamed straight into tar on the host, compressing
+        # while sending, and copied into the cache if given a key
+        def _write_input(out: BinaryIO) -> None:
+            self.transfer_start = timer()
+            with self.artifact_cache.tee(cache_key, out) as tee:
+                writer = codec.writer(tee)
+                with tracing.span("stream tar", codec=str(codec), files=len(files)) as span:
+                    self._write_tar(files, writer, deltas)
+                    span.set(bytes=writer.bytes_written)
+            self.bytes_sent = writer.bytes_written
+
+        return _write_input
+
+    def _get_cached_tar(self, key: str, files: List[FileData], codec: Codec) -> Optional[BinaryIO]:
+        def _create_tar(out: BinaryIO) -> None:
+            with tracing.span("create tar", codec=str(codec), files=len(files)) as span:
+                writer = codec.writer(out)
+                self._write_tar(files, writer, {})
+                span.set(bytes=writer.bytes_written)
+
+        return self.artifact_cache.get(key, _create_tar)
+
+    def _upload_input(self, plan: ExecutionPlan) -> None:
+        step = next(s for s in plan.steps if s.write_input)
+        input_path = create_temporary_file("archive")
+        try:
+            with open(input_path, "w+b") as f:
+                step.write_input(f)
+                f.flush()
+                step.input_path = self._upload_archive(f)
+        finally:
+            remove_temporary_file(input_path)
+        step.write_input = None
+
+    def _upload_archive(self, archive: BinaryIO) -> str:
+        remote_archive = f"{self.host.home_path}/.scd_archive_{os.urandom(8).hex()}"
+        self.printer.info("Uploading tar file of %s to %s.", format_size(os.fstat(archive.fileno()).st_size), self.host.name, verbose=True)
+        self.transfer_start = timer()
+        self.host.send_file(archive, remote_archive)
+        self.bytes_sent = os.fstat(archive.fileno()).st_size
+        return remote_archive
+
+    def _send_cached_tar(self, archive: BinaryIO, num_files: int) -> WriteInput:
+        size = os.fstat(archive.fileno()).st_size
+        self.printer.info("Sending cached tar file of %s to %s.", format_size(size), self.host.name, verbose=True)
+
+        def _write_input(out: BinaryIO) -> None:
+            self.transfer_start = timer()
+            with tracing.span("send tar", files=num_files, bytes=size):
+                shutil.copyfileobj(archive, out, self.COPY_BUFFER_SIZE)
+            self.bytes_sent = size
+
+        return _write_input
+
+    # Only transfers that were sent in full and extracted successfully are measured
+    def _update_throughput(self) -> None:
+        if self.transfer_end is None or self.transfer_start is None or self.bytes_sent < self.MIN_THROUGHPUT_SAMPLE:
+            return
+        throughput = self.bytes_sent / (self.transfer_end - self.transfer_start)
+        self.host.host_status.update_link(self.host.name, throughput=throughput)
+
+    def _select_codec(self) -> Codec:
+        spec = self.settings.compression_for(self.host.url, self.host.name)
+        status = self.host.status
+        remote_codecs = status.codecs
+        if remote_codecs is None:
+            if compression.needs_remote_codecs(spec):
+                remote_codecs = self._detect_remote_codecs()
+            else:
+                remote_codecs = [compression.NONE, compression.GZIP]
+
+        codec = compression.select_codec(spec, remote_codecs, status.link_throughput())
+        if spec != compression.AUTO and codec.name != compression.parse_codec(spec).name:
+            self.printer.info("Compression %s is not available for %s, using %s instead.", spec, self.host.name, codec)
+        self.printer.info("Compressing files using %s.", codec, verbose=True)
+        return codec
 
-    def _create_tar(self, files: List[FileData]) -> None:
-        self.printer.info("Creating new tar file %s.", TAR_PATH, verbose=True)
-        if os.path.isfile(TAR_PATH):
-            os.remove(TAR_PATH)
+    def _detect_remote_codecs(self) -> List[str]:
+        exit_code, output = self.host.execute_command([compression.DETECT_COMMAND], exit_on_failure=False, echo_commands=False)
+        codecs = compression.parse_remote_codecs(output)
+        self.host.host_status.update_link(self.host.name, codecs=codecs)
+        return codecs
 
-        with tarfile.open(TAR_PATH, "w:gz", dereference=True) as tar:
+    def _write_tar(self, files: List[FileData], out: compression.CompressingWriter, deltas: Dict[FileData, str]) -> None:
+        self.printer.info("Streaming tar file to %s.", self.host.name, verbose=True)
+        with tarfile.open(fileobj=out, mode="w|", dereference=True) as tar:
             for file in files:
                 try:
-                    tar.add(file.from_path, arcname=file.to_path)
+                    if file in deltas:
+                        tar.add(deltas[file], arcname=file.to_path + DELTA_SUFFIX)
+                    else:
+                        tar.add(file.from_path, arcname=file.to_path)
                 except PermissionError as e:
                     self.printer.error("Could not add %s to deployment tar file.", file.from_path)
                     self.printer.error(f"    {e}")
                     raise DeploymentException
+        out.close()
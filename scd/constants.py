@@ -3,15 +3,13 @@ import os.path
 HOME: str = os.path.expanduser("~")
 SCD_FOLDER = f"{HOME}/.scd"
 SCD_CONFIG = f"{SCD_FOLDER}/config"
-TAR_NAME = "scd_conf.tar.gz"
-TAR_PATH = f"{SCD_FOLDER}/{TAR_NAME}"
 
-PWD_NAME = f"tmp.txt"
-PWD_PATH = f"{SCD_FOLDER}/{PWD_NAME}"
-
-TEMPORARY_FILES = [TAR_PATH, PWD_PATH]
+SCAN_INDEX_FILE = f"{SCD_FOLDER}/scan_index"
+ARTIFACT_CACHE_FOLDER = f"{SCD_FOLDER}/cache"
+AGENT_SOCKET = f"{SCD_FOLDER}/agent.sock"
 
 SERVER_STATUS_FILE = SCD_FOLDER + "/server_status"
+SERVER_STATUS_DB = SCD_FOLDER + "/server_status.db"
 TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
 
 VERSION = "1.1"
@@ -1,27 +1,84 @@
-from typing import List, Optional
+from typing import Dict, List, Optional
 
 
 class FileData:
-    def __init__(self, from_path: str, to_path: str):
+    def __init__(self, from_path: str, to_path: str, content_hash: Optional[str] = None):
         self.from_path = from_path
         self.to_path = to_path
+        self.content_hash = content_hash
+
+
+class ScriptData:
+    def __init__(self, path: str, after: Optional[List[str]] = None, as_sudo: bool = False):
+        self.path = path
+        # Scripts that have to execute successfully before this one
+        self.after = after or []
+        self.as_sudo = as_sudo
 
 
 class StatusData:
 
-    def __init__(self, last_deployment: str, installed_programs: List[str], deployed_files: List[str], executed_scripts: List[str], shell: Optional[str]):
+    def __init__(self,
+                 last_deployment: str,
+                 installed_programs: List[str],
+                 deployed_files: List[str],
+                 executed_scripts: List[str],
+                 shell: Optional[str],
+                 manifest: Dict[str, List],
+                 codecs: Optional[List[str]],
+                 throughput: Optional[float],
+                 facts: Optional[Dict[str, any]],
+                 script_results: Dict[str, List],
+                 deploy_seconds: Optional[float],
+                 rtt: Optional[float],
+                 sudo: Optional[bool],
+                 probe_throughput: Optional[float]):
         self.last_deployment = last_deployment
         self.installed_programs = installed_programs
         self.deployed_files = deployed_files
         self.executed_scripts = executed_scripts
         self.shell = shell
+        # Maps each deployed host path to [size, mtime_ns, content hash, mode] of its local file
+        self.manifest = manifest
+        # Compression codecs available on the host, None if they haven't been detected yet
+        self.codecs = codecs
+        # Bytes per second measured during the last deployment of files
+        self.throughput = throughput
+        # What was found when the host was last probed, see scd.facts
+        self.facts = facts
+        # Maps each script to [exit code, seconds it took, date] of its last execution
+        self.script_results = script_results
+        # How long the last deployment to the host took, used to order the hosts of a run
+        self.deploy_seconds = deploy_seconds
+        # Seconds a round trip to the host takes, measured by scd --probe
+        self.rtt = rtt
+        # Whether the user can use sudo on the host, None if it hasn't been checked by scd --probe
+        self.sudo = sudo
+        # Bytes per second streamed to the host by scd --probe, which also counts starting the command receiving them
+        self.probe_throughput = probe_throughput
+
+    # The throughput of the last deployment, or of the last probe when the host hasn't been deployed to
+    def link_throughput(self) -> Optional[float]:
+        return self.throughput if self.throughput is not None else self.probe_throughput
 
     def init(self, new_dict) -> None:
         self.__dict__.update(new_dict)
 
 
 def empty_status() -> StatusData:
-    return StatusData("1970-01-01 01:00:00", [], [], [], None)
+    return StatusData("1970-01-01 01:00:00", [], [], [], None, {}, None, None, None, {}, None, None, None, None)
+
+
+class DeploymentResult:
+    DEPLOYED = "deployed"
+    UNCHANGED = "unchanged"
+    FAILED = "failed"
+    SKIPPED = "skipped"
+
+    def __init__(self, url: str, result: str, elapsed_time: str):
+        self.url = url
+        self.result = result
+        self.elapsed_time = elapsed_time
 
 
 class DeploymentException(Exception):
@@ -0,0 +1,183 @@
+import hashlib
+import math
+import shlex
+import struct
+import zlib
+from typing import BinaryIO, Dict, List, Optional, Tuple
+
+from scd.utils import trim_multiline_str
+
+DELTA_SUFFIX = ".scd_delta"
+SIGNATURE_PREFIX = "SCD_SIG"
+MIN_BLOCK_SIZE = 4096
+ADLER_MOD = 65521
+READ_SIZE = 64 * 1024
+# Deltas are given up on early once 1/SAMPLE_FRACTION of a file has been read with too few matching blocks
+SAMPLE_FRACTION = 8
+
+# Delta files start with a header followed by a sequence of operations, either
+# copying a block of the file on the host or inserting literal bytes.
+MAGIC = b"SCDD"
+COPY = b"C"
+LITERAL = b"L"
+
+Signature = Tuple[int, Dict[int, Dict[str, int]]]
+
+# Both scripts run with python3 on the host. The signature script prints the
+# adler32 and md5 of every block of the given files, the patch script rebuilds
+# each file from its current content and the deployed delta.
+SIGNATURE_SCRIPT = trim_multiline_str(f"""
+    import hashlib, os, sys, zlib
+    args = sys.argv[1:]
+    for i in range(0, len(args), 2):
+        block_size, path = int(args[i]), args[i + 1]
+        if not os.path.isfile(path):
+            print("{SIGNATURE_PREFIX} %d -" % (i // 2))
+            continue
+        blocks = []
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(block_size), b""):
+                blocks.append("%x:%s" % (zlib.adler32(block), hashlib.md5(block).hexdigest()))
+        print("{SIGNATURE_PREFIX} %d %s" % (i // 2, ",".join(blocks) or "="))
+""")
+
+PATCH_SCRIPT = trim_multiline_str(f"""
+    import hashlib, os, struct, sys
+    for path in sys.argv[1:]:
+        delta_path, new_path = path + "{DELTA_SUFFIX}", path + ".scd_new"
+        sha1 = hashlib.sha1()
+        with open(delta_path, "rb") as delta, open(path, "rb") as old, open(new_path, "wb") as new:
+            _, block_size, mode, digest = delta.read(4), *struct.unpack("!II", delta.read(8)), delta.read(20)
+            for op in iter(lambda: delta.read(1), b""):
+                n = struct.unpack("!I", delta.read(4))[0]
+                if op == {COPY!r}:
+                    old.seek(n * block_size)
+                    chunk = old.read(block_size)
+                else:
+                    chunk = delta.read(n)
+                sha1.update(chunk)
+                new.write(chunk)
+        os.remove(delta_path)
+        if sha1.digest() != digest:
+            os.remove(new_path)
+            print("Checksum mismatch when applying delta to " + path)
+            sys.exit(1)
+        os.chmod(new_path, mode)
+        os.rename(new_path, path)
+""")
+
+
+def block_size_for(size: int) -> int:
+    # Same heuristic as rsync, the block size grows with the square root of the file size
+    return max(MIN_BLOCK_SIZE, int(math.sqrt(size)) // 8 * 8)
+
+
+def signature_command(files: List[Tuple[int, str]]) -> str:
+    args = " ".join(f"{block_size} {shlex.quote(path)}" for block_size, path in files)
+    return _python_command(SIGNATURE_SCRIPT, args)
+
+
+def patch_command(paths: List[str]) -> str:
+    return _python_command(PATCH_SCRIPT, " ".join(shlex.quote(path) for path in paths))
+
+
+def parse_signatures(lines: List[str], files: List[Tuple[int, str]]) -> Dict[int, Signature]:
+    signatures: Dict[int, Signature] = {}
+    for line in lines:
+        parts = line.split(" ")
+        if len(parts) != 3 or parts[0] != SIGNATURE_PREFIX or parts[2] == "-":
+            continue
+
+        index = int(parts[1])
+        blocks: Dict[int, Dict[str, int]] = {}
+        if parts[2] != "=":
+            for block_index, block in enumerate(parts[2].split(",")):
+                weak, strong = block.split(":")
+                blocks.setdefault(int(weak, 16), {}).setdefault(strong, block_index)
+        signatures[index] = (files[index][0], blocks)
+    return signatures
+
+
+# Returns False, leaving an incomplete delta, if the delta would be larger than half of the file
+def write_delta(path: str, mode: int, signature: Signature, out: BinaryIO) -> bool:
+    block_size, blocks = signature
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(READ_SIZE), b""):
+            sha1.update(chunk)
+        size = f.tell()
+        f.seek(0)
+        out.write(MAGIC + struct.pack("!II", block_size, mode) + sha1.digest())
+        return _write_operations(f, size, block_size, blocks, out)
+
+
+# The file is read a window at a time, indexes are relative to the start of
+# the window, which is at offset base of the file
+def _write_operations(f: BinaryIO, size: int, block_size: int, blocks: Dict[int, Dict[str, int]], out: BinaryIO) -> bool:
+    max_literal_size = size // 2
+    literal_size = 0
+
+    def _write_literal(data: bytes, start: int, end: int) -> int:
+        if end > start:
+            out.write(LITERAL + struct.pack("!I", end - start))
+            out.write(data[start:end])
+        return end - start
+
+    data = f.read(max(READ_SIZE, block_size))
+    base = i = literal_start = 0
+    weak: Optional[int] = None
+    a = b = 0
+    is_eof = False
+    while True:
+        if i + block_size > len(data):
+            if is_eof:
+                break
+            literal_size += _write_literal(data, literal_start, i)
+            # Most of the file being literal so far means it's unlikely to be worth a delta, give up early
+            base += i
+            if base >= size // SAMPLE_FRACTION and literal_size * size > max_literal_size * base:
+                return False
+
+            chunk = f.read(max(READ_SIZE, block_size))
+            is_eof = not chunk
+            data = data[i:] + chunk
+            i = literal_start = 0
+            continue
+
+        if weak is None:
+            weak = zlib.adler32(data[i:i + block_size])
+            a, b = weak & 0xffff, weak >> 16
+
+        candidates = blocks.get(weak)
+        if candidates:
+            block_index = candidates.get(hashlib.md5(data[i:i + block_size]).hexdigest())
+            if block_index is not None:
+                literal_size += _write_literal(data, literal_start, i)
+                out.write(COPY + struct.pack("!I", block_index))
+                i += block_size
+                literal_start = i
+                weak = None
+                continue
+
+        if i - literal_start + literal_size > max_literal_size:
+            return False
+
+        # Roll the adler32 checksum forward one byte, the next byte may still have to be read
+        if i + block_size < len(data):
+            removed, added = data[i], data[i + block_size]
+            a = (a - removed + added) % ADLER_MOD
+            b = (b - block_size * removed + a - 1) % ADLER_MOD
+            weak = (b << 16) | a
+        else:
+            weak = None
+        i += 1
+
+    if len(data) - literal_start + literal_size > max_literal_size:
+        return False
+
+    _write_literal(data, literal_start, len(data))
+    return True
+
+
+def _python_command(script: str, args: str) -> str:
+    return f"python3 - {args} <<'SCD_PYTHON'\n{script}\nSCD_PYTHON"
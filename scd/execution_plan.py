@@ -0,0 +1,223 @@
+import os
+import shlex
+from collections import deque
+from typing import BinaryIO, Callable, Deque, Dict, List, Optional
+
+WriteInput = Callable[[BinaryIO], None]
+
+# Seconds since the epoch, with decimals if the shell is bash 5 or newer
+NOW = "${EPOCHREALTIME:-$(date +%s)}"
+SKIPPED = "skipped"
+
+
+class Step:
+    FILES = "files"
+    PROGRAMS = "programs"
+    SHELL = "shell"
+    SCRIPT = "script"
+
+    def __init__(self,
+                 kind: str,
+                 commands: List[str],
+                 name: Optional[str] = None,
+                 exit_on_failure=True,
+                 write_input: WriteInput = None,
+                 input_path: Optional[str] = None,
+                 parallel=False,
+                 after: Optional[List[str]] = None,
+                 on_success: Callable[[str], None] = None,
+                 on_error: Callable[[], None] = None):
+        self.kind = kind
+        self.name = name or kind
+        self.commands = commands
+        self.exit_on_failure = exit_on_failure
+        self.write_input = write_input
+        # A file uploaded to the host before the plan runs which the step reads
+        # instead of the input of the session, removed once the step ends
+        self.input_path = input_path
+        # Consecutive parallel steps run at the same time, except for those
+        # that have to run after other steps of the group
+        self.parallel = parallel
+        self.after = after or []
+        self.on_success = on_success
+        self.on_error = on_error
+
+        # Set once the plan has executed, the exit code stays None if the step never ran
+        self.exit_code: Optional[int] = None
+        self.elapsed: Optional[float] = None
+        self.skipped = False
+        self.output: List[str] = []
+        # The number of lines of output, of which only the last ones are kept in output
+        self.line_count = 0
+
+    def has_run(self) -> bool:
+        return self.exit_code is not None
+
+    def succeeded(self) -> bool:
+        return self.exit_code == 0
+
+
+# Every step of a deployment compiled into a single script which is executed
+# in one session. Each step runs in its own subshell and is followed by a
+# marker line with its exit code and start and end times, which is how the
+# output is split up per step as it arrives. A failing step stops the rest of
+# the plan unless it's allowed to fail, like scripts are.
+class ExecutionPlan:
+    def __init__(self, output_lines: int):
+        self.steps: List[Step] = []
+        # Random so that the output of a step can't be mistaken for a marker
+        self.marker = f"SCD_STEP_{os.urandom(4).hex()}"
+        # Only the last lines of output of each step are kept
+        self._output: Deque[str] = deque(maxlen=output_lines)
+        self._line_count = 0
+
+    def add(self, step: Step) -> None:
+        self.steps.append(step)
+
+    def is_empty(self) -> bool:
+        return len(self.steps) == 0
+
+    # Only a single step can read the input of the session
+    def write_input(self) -> Optional[WriteInput]:
+        return next((s.write_input for s in self.steps if s.write_input), None)
+
+    def commands(self) -> List[str]:
+        commands = []
+        group: List[int] = []
+        for index, step in enumerate(self.steps):
+            if step.parallel:
+                group.append(index)
+                continue
+            if group:
+                commands.extend(self._group_commands(group))
+                group = []
+            commands.extend(self._step_commands(index))
+
+        if group:
+            commands.extend(self._group_commands(group))
+        return commands
+
+    def _step_commands(self, index: int) -> List[str]:
+        step = self.steps[index]
+        commands = [f"SCD_START={NOW}", *self._subshell(step)]
+        commands.append("SCD_EXIT_CODE=$?")
+        commands.append(f"printf '\\n{self.marker} {index} %s %s %s\\n' $SCD_EXIT_CODE $SCD_START {NOW}")
+        if step.exit_on_failure:
+            commands.append("[ $SCD_EXIT_CODE -eq 0 ] || exit $SCD_EXIT_CODE")
+        return commands
+
+    def _group_commands(self, group: List[int]) -> List[str]:
+        # Each step runs in the background with its output written to a file
+        # which is printed once the step has finished, so that the output of
+        # steps running at the same time doesn't interleave. Steps are started
+        # in waves where each wave only contains steps whose dependencies ran
+        # in earlier waves.
+        commands = ['SCD_RUN_DIR=$(mktemp -d)']
+        for wave in self._waves(group):
+            for index in wave:
+                step = self.steps[index]
+                dependencies = [self._index_of(name) for name in step.after if self._index_of(name) in group]
+                job = [
+                    "(",
+                    f"SCD_START={NOW}",
+                    *self._subshell(step, f'>"$SCD_RUN_DIR/{index}" 2>&1'),
+                    f'echo "$? $SCD_START {NOW}" >"$SCD_RUN_DIR/{index}.status"',
+                    ") &",
+                    f"SCD_PID_{index}=$!"
+                ]
+                if dependencies:
+                    condition = " && ".join(f'[ "$SCD_EXIT_{d}" = 0 ]' for d in dependencies)
+                    job = [f"if {condition}; then", *job, "else", f"SCD_PID_{index}=", "fi"]
+                commands.extend(job)
+
+            for index in wave:
+                commands.extend([
+                    f'if [ -n "$SCD_PID_{index}" ]; then',
+                    f'wait $SCD_PID_{index}',
+                    f'cat "$SCD_RUN_DIR/{index}"',
+                    f'SCD_RESULT=$(cat "$SCD_RUN_DIR/{index}.status")',
+                    f'SCD_EXIT_{index}=${{SCD_RESULT%% *}}',
+                    f"printf '\\n{self.marker} {index} %s\\n' \"$SCD_RESULT\"",
+                    "else",
+                    f"printf '\\n{self.marker} {index} {SKIPPED}\\n'",
+                    "fi"
+                ])
+        commands.append('rm -rf "$SCD_RUN_DIR"')
+        return commands
+
+    def _subshell(self, step: Step, redirect: str = "") -> List[str]:
+        commands = ["("]
+        if step.exit_on_failure:
+            commands.append("set -e")
+        if step.input_path:
+            commands.append(f"trap {shlex.quote(f'rm -f {shlex.quote(step.input_path)}')} EXIT")
+        commands.append("set -x")
+        commands.extend(step.commands)
+        # The input is meant for a single step, the others mustn't consume it
+        has_input = self.write_input() is not None
+        if step.input_path:
+            stdin = f"<{shlex.quote(step.input_path)}"
+        else:
+            stdin = "</dev/null" if has_input and not step.write_input else ""
+        commands.append(" ".join(p for p in [")", stdin, redirect] if p))
+        return commands
+
+    def _waves(self, group: List[int]) -> List[List[int]]:
+        waves: List[List[int]] = []
+        wave_of: Dict[int, int] = {}
+        for index in group:
+            dependencies = [self._index_of(name) for name in self.steps[index].after]
+            wave = 1 + max([wave_of[d] for d in dependencies if d in wave_of], default=-1)
+            wave_of[index] = wave
+            if wave == len(waves):
+                waves.append([])
+            waves[wave].append(index)
+        return waves
+
+    def _index_of(self, name: str) -> Optional[int]:
+        return next((i for i, s in enumerate(self.steps) if s.name == name), None)
+
+    # Called with each line of output as it arrives, returns the step that
+    # finished if the line is the marker of a step
+    def feed(self, line: str) -> Optional[Step]:
+        parts = line.split(" ")
+        if len(parts) not in (3, 5) or parts[0] != self.marker or not parts[1].isdigit():
+            self._output.append(line)
+            self._line_count += 1
+            return None
+
+        step = self.steps[int(parts[1])]
+        step.output, step.line_count = list(self._output), self._line_count
+        self._output.clear()
+        self._line_count = 0
+        if parts[2] == SKIPPED:
+            step.skipped = True
+            return step
+
+        step.exit_code = int(parts[2]) if parts[2].isdigit() else 1
+        if len(parts) == 5:
+            try:
+                # The decimal separator of EPOCHREALTIME depends on the locale
+                step.elapsed = float(parts[4].replace(",", ".")) - float(parts[3].replace(",", "."))
+            except ValueError:
+                pass
+        return step
+
+    # Called once the session has ended, returns the step that was interrupted if any
+    def finish(self, exit_code: int) -> Optional[Step]:
+        # A step without a marker was interrupted, unless it's missing because an earlier step failed
+        unfinished = [s for s in self.steps if not (s.has_run() or s.skipped)]
+        finished = [s for s in self.steps if s.has_run()]
+        if not unfinished or (finished and finished[-1].exit_on_failure and not finished[-1].succeeded()):
+            return None
+
+        step = unfinished[0]
+        step.exit_code = exit_code or 1
+        step.output, step.line_count = list(self._output), self._line_count
+        return step
+
+    def succeeded(self, kind: Optional[str] = None) -> bool:
+        return all(s.succeeded() for s in self.steps if kind is None or s.kind == kind)
+
+    def succeeded_steps(self, kind: str) -> List[str]:
+        return [s.name for s in self.steps if s.kind == kind and s.succeeded()]
@@ -0,0 +1,80 @@
+import shlex
+import time
+from typing import Dict, List, Optional
+
+from scd import compression
+
+FACT_PREFIX = "SCD_FACT"
+
+# Files identifying the distribution, the package manager it uses and its flag for answering yes
+PACKAGE_MANAGERS = [
+    ("/etc/redhat-release", "yum", "-y"),
+    ("/etc/arch-release", "pacman", "--noconfirm"),
+    ("/etc/gentoo-release", "emerge", ""),
+    ("/etc/SuSE-release", "zypper", "-n"),
+    ("/etc/debian_version", "apt-get", "-y"),
+]
+DARWIN_PACKAGE_MANAGER = ("brew", "")
+CODEC_PROGRAMS = [compression.GZIP, compression.XZ, compression.ZSTD]
+
+
+# Everything scd needs to know about a host, collected in a single command:
+#   hostname, home directory, operating system, package manager and which
+#   of the given programs are available
+def probe_command(programs: List[str]) -> str:
+    checks = []
+    for i, (path, name, _) in enumerate(PACKAGE_MANAGERS):
+        checks.append(f"{'if' if i == 0 else 'elif'} [ -f {path} ]; then echo {FACT_PREFIX} package_manager {name}")
+    checks.append(f'elif [ "$(uname)" = "Darwin" ]; then echo {FACT_PREFIX} package_manager {DARWIN_PACKAGE_MANAGER[0]}')
+    checks.append("fi")
+
+    names = " ".join(shlex.quote(p) for p in sorted(set(programs) | set(CODEC_PROGRAMS)))
+    return "\n".join([
+        f'echo {FACT_PREFIX} hostname "$(hostname)"',
+        f'echo {FACT_PREFIX} home "$HOME"',
+        f'echo {FACT_PREFIX} os "$(uname -s)"',
+        *checks,
+        f'for p in {names}; do if command -v "$p" >/dev/null 2>&1; then echo {FACT_PREFIX} program "$p"; fi; done'
+    ])
+
+
+def parse_facts(lines: List[str], programs: List[str]) -> Dict[str, any]:
+    facts: Dict[str, any] = {
+        "hostname": None,
+        "home": None,
+        "os": None,
+        "package_manager": None,
+        "checked_programs": sorted(set(programs) | set(CODEC_PROGRAMS)),
+        "programs": [],
+        "time": time.time()
+    }
+    for line in lines:
+        parts = line.split(" ", 2)
+        if len(parts) != 3 or parts[0] != FACT_PREFIX:
+            continue
+
+        key, value = parts[1], parts[2]
+        if key == "program":
+            facts["programs"].append(value)
+        elif key in facts:
+            facts[key] = value
+    return facts
+
+
+def is_fresh(facts: Optional[Dict[str, any]], programs: List[str], ttl: float) -> bool:
+    if not facts or time.time() - facts["time"] > ttl:
+        return False
+    return all(p in facts["checked_programs"] for p in programs)
+
+
+def install_command(facts: Dict[str, any], programs: List[str]) -> Optional[str]:
+    name = facts.get("package_manager")
+    if not name:
+        return None
+
+    answer_yes = next((yes for _, n, yes in PACKAGE_MANAGERS if n == name), DARWIN_PACKAGE_MANAGER[1])
+    return " ".join(p for p in ["sudo", name, answer_yes, "install", *programs] if p)
+
+
+def available_codecs(facts: Dict[str, any]) -> List[str]:
+    return [compression.NONE] + [c for c in CODEC_PROGRAMS if c in facts["programs"]]
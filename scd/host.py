@@ -1,96 +1,405 @@
+import codecs
 import socket
-from typing import List, Tuple, Callable, TypeVar
+import threading
+from collections import deque
+from typing import BinaryIO, Deque, Dict, List, Tuple, Callable, TypeVar, Optional
 
 import os.path
 import paramiko
 
+from scd import compression, facts, tracing
+from scd.agent import AgentConnection
 from scd.constants import *
 from scd.data_structs import DeploymentException
 from scd.host_status import HostStatus
 from scd.printer import Printer
 from scd.settings import Settings
+from scd.utils import get_time, timer
 
 T = TypeVar('T')
 
 
+class _InputClosedException(Exception):
+    pass
+
+
+class _ChannelWriter:
+    def __init__(self, channel: paramiko.Channel):
+        self.channel = channel
+        self.bytes_written = 0
+
+    def write(self, data: bytes) -> int:
+        try:
+            self.channel.sendall(data)
+        except OSError:
+            # The remote command exited without reading all of its input
+            raise _InputClosedException
+        self.bytes_written += len(data)
+        return len(data)
+
+
+# Every channel opened on the connection gets a window and packets larger than
+# paramiko's defaults, so the output of commands needs fewer window adjustments
+# and packets
+WINDOW_SIZE = 8 * 1024 * 1024
+MAX_PACKET_SIZE = 64 * 1024
+
+
+def _create_transport(sock, **kwargs) -> paramiko.Transport:
+    return paramiko.Transport(sock, default_window_size=WINDOW_SIZE, default_max_packet_size=MAX_PACKET_SIZE, **kwargs)
+
+
+# Accepts any host key like paramiko.AutoAddPolicy. paramiko authenticates as
+# part of connecting and checks the host key in between, so when that happens
+# is noted to tell the key exchange and authenticating apart in traces.
+class _HostKeyPolicy(paramiko.MissingHostKeyPolicy):
+    def __init__(self):
+        self.auto_add = paramiko.AutoAddPolicy()
+        self.checked_at: Optional[float] = None
+
+    def missing_host_key(self, client: paramiko.SSHClient, hostname: str, key: paramiko.PKey) -> None:
+        self.checked_at = timer()
+        self.auto_add.missing_host_key(client, hostname, key)
+
+
 class Host:
+    READ_SIZE = 32 * 1024
+    MAX_LINE_LENGTH = 64 * 1024
+    # Files at least this big are uploaded in ranges over several SFTP channels
+    PARALLEL_UPLOAD_MIN_SIZE = 8 * 1024 * 1024
+    UPLOAD_CHANNELS = 4
+    # The window OpenSSH gives each channel, no more than this is in flight on a channel
+    REMOTE_WINDOW_SIZE = 2 * 1024 * 1024
+    # Transfers reaching this fraction of a window per round trip were held back by the window
+    WINDOW_BOUND_FRACTION = 0.5
+    # Without a measured throughput only archives of at least this many windows are uploaded
+    UPLOAD_MIN_WINDOWS = 16
+    # The largest write request SFTP servers are required to accept
+    UPLOAD_CHUNK_SIZE = 32 * 1024
+    RTT_SAMPLES = 3
+    UPLOAD_PROBE_SIZE = 4 * 1024 * 1024
+    # Printed by sessions with a pty once the terminal has stopped echoing its input
+    PTY_READY = "SCD_PTY_READY"
+
     def __init__(self, printer: Printer, settings: Settings, host_status: HostStatus, url: str):
         self.printer = printer
-        self.user = settings.user
+        self.user = settings.user_for(url)
         self.password = settings.password
-        self.port = settings.port
+        self.port = settings.port_for(url)
         self.timeout = settings.timeout
-        self.private_key = settings.private_key
+        self.private_key = settings.private_key_for(url)
+        self.agent_ttl = settings.agent_ttl if settings.use_agent else None
+        self.facts_ttl = settings.facts_ttl
+        self.output_lines = settings.output_lines
+        self.programs = sorted((settings.programs | {settings.shell}) if settings.shell else settings.programs)
         self.host_status = host_status
 
         self.url = url
+        self.connection: Optional[paramiko.SSHClient] = None
+        self.home_path = f"/home/{self.user}"
+        self.has_probed = False
         self.name = url  # To display in error message if we're unable to resolve the hostname
-        self.name = self._get_host_name(url)
+        probed_facts: Dict[str, any] = {}
+        try:
+            self.name = self._get_host_name(url, probed_facts)
+        except DeploymentException:
+            self.close()
+            raise
         self.status = self.host_status[self.name]
-        self.needs_cleanup = False
-        self.home_path = f"/home/{self.user}"
+        if probed_facts:
+            self._update_facts(probed_facts)
+        elif self.status.facts:
+            self.home_path = self.status.facts["home"] or self.home_path
 
-    def execute_command(self, commands: List[str],  exit_on_failure=True, echo_commands=True) -> Tuple[int, List[str]]:
-        as_sudo = self.password and any("sudo" in c for c in commands)
+    def execute_command(self,
+                        commands: List[str],
+                        exit_on_failure=True,
+                        echo_commands=True,
+                        write_input: Callable[[BinaryIO], None]=None,
+                        uses_sudo: bool=False,
+                        on_line: Callable[[str], None]=None) -> Tuple[int, List[str]]:
+        # Returns the exit code and the last output_lines lines of output, on_line receives every line as it arrives
+        # Commands can also use sudo indirectly, for instance from scripts deployed to the host
+        as_sudo = self.needs_password(commands, uses_sudo)
         commands = self._get_commands(commands, as_sudo, exit_on_failure, echo_commands)
+        # The input is streamed as binary data which a pty would mangle, only
+        # sessions whose sole input is the password get one
+        pty = write_input is None
         if as_sudo:
-            self._send_pwd()
+            write_input = self._with_password(write_input)
+
+        return self._with_connection(lambda connection: self._execute(connection, "\n".join(commands), write_input, on_line, pty))
+
+    # Whether the commands are given the password for sudo
+    def needs_password(self, commands: List[str], uses_sudo: bool=False) -> bool:
+        return bool(self.password) and (uses_sudo or any("sudo" in c for c in commands))
+
+    def probe_facts(self, force=False) -> bool:
+        # Returns whether the host was probed, the stored facts are used as long as they are fresh
+        if self.has_probed or (not force and facts.is_fresh(self.status.facts, self.programs, self.facts_ttl)):
+            return False
+
+        self._update_facts(self._probe())
+        return True
+
+    def measure_rtt(self) -> float:
+        # The fastest of a few global requests, which the host answers without
+        # opening a channel or starting a process. The agent doesn't relay
+        # them, which is why scd --probe doesn't use the agent.
+        def _measure(connection: paramiko.SSHClient) -> float:
+            transport = connection.get_transport()
+            samples = []
+            for _ in range(self.RTT_SAMPLES):
+                start = timer()
+                transport.global_request("keepalive@openssh.com", wait=True)
+                samples.append(timer() - start)
+            return min(samples)
 
-        def _execute_command(connection: paramiko.SSHClient) -> Tuple[int, List[str]]:
-            res = self._execute(connection, "\n".join(commands))
-            self.needs_cleanup = False
-            return res
+        with tracing.span("measure rtt", samples=self.RTT_SAMPLES) as span:
+            rtt = self._with_connection(_measure)
+            span.set(rtt=rtt)
+        self.host_status.update_link(self.name, rtt=rtt)
+        return rtt
 
-        return self._with_connection(_execute_command)
+    def measure_throughput(self, rtt: float) -> float:
+        # Random data since compressed archives are what's normally sent. The
+        # exit status arrives about a round trip after the last byte was sent.
+        # Starting the command is counted as well, which is why this is stored
+        # apart from the throughput measured by deployments.
+        data = os.urandom(self.UPLOAD_PROBE_SIZE)
+        start = 0.0
+
+        def _write_input(out: BinaryIO) -> None:
+            nonlocal start
+            start = timer()
+            out.write(data)
+
+        with tracing.span("measure throughput", bytes=len(data)) as span:
+            exit_code, _ = self.execute_command(["cat > /dev/null"], echo_commands=False, write_input=_write_input)
+            if exit_code != 0:
+                self.printer.error("Could not measure the throughput to %s.", self.name)
+                raise DeploymentException
+            throughput = len(data) / max(timer() - start - rtt, 1e-3)
+            span.set(throughput=throughput)
+        self.host_status.update_link(self.name, probe_throughput=throughput)
+        return throughput
+
+    def check_sudo(self) -> bool:
+        # With a password sudo is given it on stdin, without one sudo has to work without a password
+        command = "sudo true" if self.password else "sudo -n true"
+        with tracing.span("check sudo"):
+            exit_code, _ = self.execute_command([command], exit_on_failure=False, echo_commands=False)
+        self.host_status.update_sudo(self.name, exit_code == 0)
+        return exit_code == 0
+
+    def send_file(self, file_from: BinaryIO, file_to: str) -> None:
+        size = os.fstat(file_from.fileno()).st_size
+        channels = self.UPLOAD_CHANNELS if self.supports_parallel_upload() and size >= self.PARALLEL_UPLOAD_MIN_SIZE else 1
 
-    def send_file(self, file_from: str, file_to: str) -> None:
         def _send_file(connection: paramiko.SSHClient) -> None:
-            sftp = paramiko.SFTPClient.from_transport(connection.get_transport())
-            self.printer.info("Deploying file %s to %s:%s", file_from, self.url, file_to, verbose=True)
-            sftp.put(file_from, file_to)
-            sftp.close()
+            self.printer.info("Deploying file %s to %s:%s using %s channels.", file_from.name, self.url, file_to, channels, verbose=True)
+            with tracing.span("send file", files=1, bytes=size, channels=channels):
+                if channels == 1:
+                    sftp = connection.open_sftp()
+                    file_from.seek(0)
+                    sftp.putfo(file_from, file_to, size)
+                    sftp.close()
+                else:
+                    self._send_in_parallel(connection.get_transport(), file_from, file_to, size, channels)
 
-        return self._with_connection(_send_file)
+        try:
+            self._with_connection(_send_file)
+        except (IOError, paramiko.SSHException) as e:
+            self.printer.error("Could not send %s to %s:%s.", file_from.name, self.name, file_to)
+            self.printer.error(f"    {e}")
+            raise DeploymentException
 
-    def cleanup(self) -> None:
-        if self.needs_cleanup:
-            command = f"rm {self.home_path}/{PWD_NAME}"
-            self._with_connection(lambda conn: self._execute(conn, command))
+    # The agent only relays single file transfers
+    def supports_parallel_upload(self) -> bool:
+        return not self.agent_ttl
 
-    def _execute(self, connection: paramiko.SSHClient, command: str) -> Tuple[int, List[str]]:
+    # Uploading over several channels costs a few round trips to open them and
+    # is slower than streaming over stdin, unless a single channel is held back
+    # by only having a window in flight per round trip. That's the case when
+    # the last transfer came close to that limit or, without one, when the
+    # limit is below a fast link and sending the file takes many windows.
+    def prefers_parallel_upload(self, size: int) -> bool:
+        if not self.supports_parallel_upload() or size < self.PARALLEL_UPLOAD_MIN_SIZE:
+            return False
+
+        rtt = self.status.rtt if self.status.rtt is not None else self.measure_rtt()
+        window_limit = self.REMOTE_WINDOW_SIZE / max(rtt, 1e-6)
+        throughput = self.status.link_throughput()
+        if throughput is not None:
+            return throughput >= self.WINDOW_BOUND_FRACTION * window_limit
+        return window_limit < compression.FAST_LINK and size >= self.UPLOAD_MIN_WINDOWS * self.REMOTE_WINDOW_SIZE
+
+    def close(self) -> None:
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+
+    def _execute(self,
+                 connection: paramiko.SSHClient,
+                 command: str,
+                 write_input: Callable[[BinaryIO], None]=None,
+                 on_line: Callable[[str], None]=None,
+                 pty=True) -> Tuple[int, List[str]]:
         channel = connection.get_transport().open_session()
-        channel.get_pty()
+        if pty:
+            channel.get_pty()
+        else:
+            channel.set_combine_stderr(True)
 
         self.printer.info("Executing command on server:", verbose=True)
         self.printer.info(command.split("\n"), verbose=True)
 
-        channel.exec_command(command)
-        output = self._read_output(channel)
-        status = channel.recv_exit_status()
-        channel.close()
-        
+        # A terminal echoes its input back into the output, so the input of a
+        # session with a pty is only written once the echo has been turned off
+        ready = threading.Event() if pty and write_input else None
+        if ready:
+            command = f"stty -echo 2>/dev/null; echo {self.PTY_READY}\n{command}"
+
+        with tracing.span("execute command") as span:
+            channel.exec_command(command)
+            if write_input:
+                output, bytes_sent = self._execute_with_input(channel, write_input, on_line, ready)
+                span.set(bytes_sent=bytes_sent)
+            else:
+                output = self._read_output(channel, on_line)
+            status = channel.recv_exit_status()
+            channel.close()
+            span.set(exit_code=status)
+
         return status, output
 
-    def _send_pwd(self) -> None:
-        with open(PWD_PATH, 'w') as f:
-            f.write(self.password + '\n')
-        self.send_file(PWD_PATH, f"{self.home_path}/{PWD_NAME}")
-        self.needs_cleanup = True
-        if os.path.isfile(PWD_PATH):
-            os.remove(PWD_PATH)
+    def _send_in_parallel(self, transport: paramiko.Transport, file_from: BinaryIO, file_to: str, size: int, channels: int) -> None:
+        # A single channel can't have more data in flight than the window of
+        # the host, which on links with a high latency leaves most of the
+        # bandwidth unused. Each channel has its own window, so the file is
+        # split into a range per channel which are written at the same time
+        # with pipelined requests. Opening a channel takes a few round trips,
+        # so the channels are opened at the same time as well.
+        from concurrent.futures import ThreadPoolExecutor, wait
+        range_size = -(-size // channels)
+        ranges = [(i * range_size, min(size, (i + 1) * range_size)) for i in range(channels)]
+        with ThreadPoolExecutor(max_workers=channels) as executor:
+            opened = [executor.submit(paramiko.SFTPClient.from_transport, transport) for _ in range(channels)]
+            wait(opened)
+            try:
+                sftp_clients = [future.result() for future in opened]
+                sftp_clients[0].open(file_to, "w").close()
+                sent = [executor.submit(self._send_range, sftp, file_from, file_to, start, end) for sftp, (start, end) in zip(sftp_clients, ranges)]
+                for future in sent:
+                    future.result()
+            finally:
+                for future in opened:
+                    if future.exception() is None:
+                        future.result().close()
+
+    def _send_range(self, sftp: paramiko.SFTPClient, file_from: BinaryIO, file_to: str, start: int, end: int) -> None:
+        with sftp.open(file_to, "r+") as remote:
+            # Writes are acknowledged all at once when the file is closed
+            remote.set_pipelined(True)
+            remote.seek(start)
+            offset = start
+            while offset < end:
+                # Read at an offset as the other ranges are read from the same file at the same time
+                data = os.pread(file_from.fileno(), min(self.UPLOAD_CHUNK_SIZE, end - offset), offset)
+                if not data:
+                    raise IOError(f"{file_from.name} ended after {offset} of {end} bytes")
+                remote.write(data)
+                offset += len(data)
+
+    def _execute_with_input(self,
+                            channel: paramiko.Channel,
+                            write_input: Callable[[BinaryIO], None],
+                            on_line: Optional[Callable[[str], None]],
+                            ready: Optional[threading.Event]) -> Tuple[List[str], int]:
+        # The input is written from another thread while the output is read,
+        # a command writing more output than the window holds before it has
+        # read all of its input would otherwise wait for a reader forever.
+        # Whichever side fails closes the channel to stop the other one.
+        from concurrent.futures import ThreadPoolExecutor
+        host = tracing.get_host()
+
+        def _write() -> int:
+            tracing.set_host(host)
+            try:
+                if ready:
+                    ready.wait()
+                return self._write_input(channel, write_input, is_terminal=bool(ready))
+            except BaseException:
+                channel.close()
+                raise
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            written = executor.submit(_write)
+            try:
+                output = self._read_output(channel, on_line, ready)
+            except BaseException:
+                channel.close()
+                raise
+            finally:
+                if ready:
+                    ready.set()
+            return output, written.result()
+
+    @staticmethod
+    def _write_input(channel: paramiko.Channel, write_input: Callable[[BinaryIO], None], is_terminal: bool) -> int:
+        # Returns the number of bytes written
+        writer = _ChannelWriter(channel)
+        try:
+            write_input(writer)
+            if is_terminal:
+                # A terminal only ends its input with ^D at the start of a line
+                writer.write(b"\x04")
+            channel.shutdown_write()
+        except _InputClosedException:
+            pass  # The reason will be in the output of the command
+        return writer.bytes_written
+
+    def _with_password(self, write_input: Optional[Callable[[BinaryIO], None]]) -> Callable[[BinaryIO], None]:
+        # The password is the first line of the input, read by the session before anything else
+        def _write_input(out: BinaryIO) -> None:
+            out.write((self.password + "\n").encode())
+            if write_input:
+                write_input(out)
 
-    def _get_host_name(self, url: str) -> str:
+        return _write_input
+
+    def _probe(self) -> Dict[str, any]:
+        start = timer()
+        output: List[str] = []
+        with tracing.span("probe facts", programs=len(self.programs)):
+            exit_code, _ = self.execute_command([facts.probe_command(self.programs)], echo_commands=False, on_line=output.append)
+        host_facts = facts.parse_facts(output, self.programs)
+        if exit_code != 0 or not host_facts["hostname"]:
+            self.printer.error("Could not probe host %s.", self.url)
+            raise DeploymentException
+
+        self.printer.info("Probed %s in %s s, found %s.", self.url, get_time(start), ", ".join(host_facts["programs"]) or "no programs", verbose=True)
+        return host_facts
+
+    def _update_facts(self, host_facts: Dict[str, any]) -> None:
+        self.has_probed = True
+        self.host_status.update_facts(self.name, host_facts)
+        self.host_status.update_link(self.name, codecs=facts.available_codecs(host_facts))
+        self.home_path = host_facts["home"] or self.home_path
+
+    def _get_host_name(self, url: str, probed_facts: Dict[str, any]) -> str:
+        with tracing.span("resolve hostname"):
+            return self._resolve_host_name(url, probed_facts)
+
+    def _resolve_host_name(self, url: str, probed_facts: Dict[str, any]) -> str:
         name = self.host_status.get_host_name(url)
         if name:
             self.printer.info("Fetched hostname of %s from host mappings: %s.", url, name, verbose=True)
             return name
 
-        exit_code, output = self.execute_command(["hostname"], echo_commands=False)
-        if exit_code != 0:
-            self.printer.error("Could not get hostname of %s", url)
-            raise DeploymentException
-
-        name = output[0]
+        # The hostname is fetched together with the rest of the facts to save a round trip
+        probed_facts.update(self._probe())
+        name = probed_facts["hostname"]
         self.printer.info("Fetched hostname of %s from host: %s.", url, name, verbose=True)
         self.host_status.add_host_mapping(url, name)
         return name
@@ -105,26 +414,51 @@ class Host:
         if not as_sudo:
             return full_command + commands
 
+        # The password never touches the disk of the host, it's kept in the
+        # environment of the session and given to sudo by an askpass helper
+        # which only prints it from there. sudo reads neither the password nor
+        # the terminal from stdin, so the input of the session is left to the
+        # command and the session can keep its pty for hosts with requiretty.
+        # A function rather than a replacement of the commands so that it also
+        # applies to scripts sourced by the commands. Everything is plain sh,
+        # the login shell of the host may not be bash.
         full_command.extend([
-            f"function cleanup {{ rm -- {self.home_path}/{PWD_NAME} }}",
-            "trap cleanup EXIT"
+            "IFS= read -r SCD_PASSWORD",
+            "export SCD_PASSWORD",
+            "SCD_ASKPASS=$(mktemp)",
+            "trap 'rm -f \"$SCD_ASKPASS\"' EXIT",
+            "cat > \"$SCD_ASKPASS\" <<'SCD_ASKPASS'",
+            "#!/bin/sh",
+            "printf '%s\\n' \"$SCD_PASSWORD\"",
+            "SCD_ASKPASS",
+            "chmod 700 \"$SCD_ASKPASS\"",
+            "sudo() { SUDO_ASKPASS=\"$SCD_ASKPASS\" command sudo -A \"$@\"; }"
         ])
-        sudo_replacement = f"cat '{self.home_path}/{PWD_NAME}' | sudo --prompt='' -S"
-        return full_command + [c.replace("sudo", sudo_replacement) for c in commands]
+        return full_command + commands
 
     def _with_connection(self, do: Callable[[paramiko.SSHClient], T]) -> T:
-        connection = self._connect()
-        res = do(connection)
-        connection.close()
-        return res
+        # The connection is opened lazily and reused for every command and file
+        # transfer, only reconnecting if the transport has died in between.
+        transport = self.connection and self.connection.get_transport()
+        if not (transport and transport.is_active()):
+            self.close()
+            with tracing.span("connect", agent=bool(self.agent_ttl)):
+                self.connection = self._connect()
+        return do(self.connection)
 
     def _connect(self) -> paramiko.SSHClient:
+        # The agent loads the private key itself, only once for as long as it keeps the connection
+        pkey = None if self.agent_ttl else self._get_private_key()
         ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        pkey = self._get_private_key()
+        host_key_policy = _HostKeyPolicy()
+        ssh.set_missing_host_key_policy(host_key_policy)
+        start = timer()
 
         try:
-            ssh.connect(self.url, username=self.user, password=self.password, port=self.port, timeout=self.timeout, pkey=pkey)
+            if self.agent_ttl:
+                return AgentConnection(self.url, self.port, self.user, self.password, self.private_key, self.timeout, self.agent_ttl)
+            ssh.connect(self.url, username=self.user, password=self.password, port=self.port, timeout=self.timeout, pkey=pkey,
+                        transport_factory=_create_transport)
         except paramiko.ssh_exception.AuthenticationException:
             if self.password is None:
                 self.printer.error(
@@ -142,6 +476,9 @@ class Host:
             self.printer.error(f"    {e}")
             raise DeploymentException
 
+        if host_key_policy.checked_at:
+            tracing.record("handshake", start, host_key_policy.checked_at)
+            tracing.record("authenticate", host_key_policy.checked_at, timer(), method=ssh.get_transport().auth_handler.auth_method)
         return ssh
 
     def _get_private_key(self) -> paramiko.PKey:
@@ -158,14 +495,48 @@ class Host:
             self.printer.error("Could not read private key %s", self.private_key)
             raise DeploymentException
 
-    @staticmethod
-    def _read_output(channel) -> List[str]:
-        output = ""
-        with channel.makefile("rb", -1) as stdout:
-            while True:
-                lines = stdout.read().decode("utf-8", errors="replace")
-                if len(lines) == 0:
-                    break
-
-                output += lines.replace("\r\r", "\n").replace("\r\n", "\n")
-        return [line.strip() for line in output.split("\n") if len(line) > 0]
+    def _read_output(self, channel: paramiko.Channel, on_line: Callable[[str], None]=None, ready: threading.Event=None) -> List[str]:
+        # The output is decoded incrementally and handled a line at a time as
+        # it arrives. Only the last lines are kept so chatty commands don't
+        # grow the memory use.
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        lines: Deque[str] = deque(maxlen=self.output_lines)
+        partial_line = ""
+
+        def _add_line(line: str) -> None:
+            line = line.strip()
+            if len(line) == 0:
+                return
+            if ready and not ready.is_set() and line == self.PTY_READY:
+                ready.set()
+                return
+            lines.append(line)
+            if on_line:
+                on_line(line)
+
+        # A carriage return ending a chunk is held back as it could be the start of a \r\r
+        carriage_return = ""
+        while True:
+            data = channel.recv(self.READ_SIZE)
+            text = (carriage_return + decoder.decode(data, final=not data)).replace("\r\r", "\n")
+            carriage_return = ""
+            if data and text.endswith("\r"):
+                text, carriage_return = text[:-1], "\r"
+
+            # Only the new data is split, the partial line is completed by its first line
+            *complete_lines, rest = text.split("\n")
+            if complete_lines:
+                complete_lines[0] = partial_line + complete_lines[0]
+                partial_line = rest
+            else:
+                partial_line += rest
+            for line in complete_lines:
+                _add_line(line)
+
+            if len(partial_line) > self.MAX_LINE_LENGTH:
+                # Output redrawing its line with carriage returns, like progress
+                # bars, never ends it. Only what a terminal would show is kept.
+                partial_line = partial_line[partial_line.rfind("\r") + 1:][-self.MAX_LINE_LENGTH:]
+            if not data:
+                _add_line(partial_line)
+                return list(lines)
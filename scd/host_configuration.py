@@ -1,19 +1,26 @@
 import os
 import sys
-from fnmatch import fnmatch
-from typing import List, Set, Optional
+from typing import Dict, List, Set, Optional
 
-from scd.data_structs import StatusData
+from scd import tracing
+from scd.data_structs import ScriptData, StatusData
 from scd.printer import Printer
+from scd.scanner import Snapshot
 from scd.settings import Settings, FileData
 from scd.utils import date_to_time_stamp
 
 
+# What has to be deployed to a host: the files of the snapshot that changed
+# since they were last deployed to the host, and the programs, scripts and
+# shell it doesn't have yet
 class HostConfiguration:
-    def __init__(self, printer: Printer, settings: Settings, status: StatusData):
+    def __init__(self, printer: Printer, settings: Settings, status: StatusData, snapshot: Optional[Snapshot], user: Optional[str] = None):
         self.settings = settings
+        self.user = user or settings.user
         self.status = status
         self.printer = printer
+        self.snapshot = snapshot or Snapshot(settings.ignored_files, settings.scan_threads)
+        self.manifest: Dict[str, List] = {}
 
         self.programs = self._programs_to_install()
         self.files = self._files_to_deploy()
@@ -25,14 +32,25 @@ class HostConfiguration:
     def is_empty(self) -> bool:
         return len(self.files) == 0 and len(self.programs) == 0 and len(self.scripts) == 0 and not self.shell
 
+    def files_size(self) -> int:
+        return sum(self.manifest[f.to_path][0] for f in self.files)
+
     def _programs_to_install(self) -> List[str]:
         shell = self.settings.shell
         programs = set(self.settings.programs)
         if shell:
             programs.add(shell)
-        return [p for p in programs if p not in self.status.installed_programs]
+        # Programs found on the host when it was probed don't have to be installed
+        available = (self.status.facts or {}).get("programs") or []
+        return [p for p in programs if p not in self.status.installed_programs and p not in available]
 
     def _files_to_deploy(self) -> Set[FileData]:
+        with tracing.span("scan files") as span:
+            files = self._scan_files(span)
+            span.set(changed_files=len(files), changed_bytes=sum(self.manifest[f.to_path][0] for f in files))
+            return files
+
+    def _scan_files(self, span: tracing.Span) -> Set[FileData]:
         files: Set[FileData] = set()
 
         for file in self.settings.files:
@@ -48,38 +66,53 @@ class HostConfiguration:
 
             msg = "Checking timestamp of %s." if should_check_timestamp else "Adding new item %s."
             self.printer.info(msg, from_path, verbose=True)
-            self._add_files(from_path, to, should_check_timestamp, files)
+            self._add_files(from_path, to, should_check_timestamp, files, span)
 
         return files
 
-    def _scripts_to_run(self) -> List[str]:
+    def _scripts_to_run(self) -> List[ScriptData]:
         scripts = self.settings.scripts
-        return [s for s in scripts if s not in self.status.executed_scripts]
+        return [s for s in scripts if s.path not in self.status.executed_scripts]
 
     def _shell_to_change(self) -> Optional[str]:
         shell = self.settings.shell
         return shell if self.status.shell != shell else None
 
-    def _add_files(self, from_path: str, to_path: str, should_check_timestamp: bool, files: Set[FileData]) -> None:
-        def _files(file) -> None:
-            for ignored in self.settings.ignored_files:
-                if fnmatch(file, ignored):
-                    return
-
-            if os.path.isdir(file):
-                for f in os.listdir(file):
-                    _files(f"{file}/{f}")
-                return
-
-            timestamp = date_to_time_stamp(self.status.last_deployment)
-            if not should_check_timestamp or os.path.getctime(file) > timestamp:
-                path = os.path.abspath(file)
-                path_to = path.replace(from_path, to_path)
-                files.add(FileData(path, path_to))
-
-        _files(from_path)
+    def _add_files(self, from_path: str, to_path: str, should_check_timestamp: bool, files: Set[FileData], span: tracing.Span) -> None:
+        timestamp = date_to_time_stamp(self.status.last_deployment)
+
+        scanned = 0
+        for file, stat in self.snapshot.files(from_path):
+            scanned += 1
+            path = os.path.abspath(file)
+            path_to = path.replace(from_path, to_path)
+            if self._has_changed(path, stat, path_to, should_check_timestamp, timestamp, span):
+                files.add(FileData(path, path_to, self.manifest[path_to][2]))
+        span.add(files=scanned)
+
+    def _has_changed(self, path: str, stat: os.stat_result, path_to: str, should_check_timestamp: bool, timestamp: float, span: tracing.Span) -> bool:
+        entry = self.status.manifest.get(path_to)
+        # Changing the permissions of a file doesn't change its mtime. Entries
+        # stored before the manifest had modes match any mode.
+        mode_matches = entry is not None and (len(entry) < 4 or entry[3] == stat.st_mode)
+        if entry and mode_matches and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            self.manifest[path_to] = [stat.st_size, stat.st_mtime_ns, entry[2], stat.st_mode]
+            return False
+
+        content_hash = self.snapshot.hash(path, stat)
+        span.add(hashed_files=1, hashed_bytes=stat.st_size)
+        self.manifest[path_to] = [stat.st_size, stat.st_mtime_ns, content_hash, stat.st_mode]
+        if entry:
+            return entry[2] != content_hash or not mode_matches
+        # Files missing from the manifest of a host haven't been deployed to it
+        if self.status.manifest:
+            return True
+
+        # Hosts deployed to before the manifest was introduced fall back to comparing timestamps
+        return not should_check_timestamp or stat.st_ctime > timestamp
 
     def _expand_remote_user(self, path: str) -> str:
         if not path.startswith("~"):
             return path
-        return f"/home/{self.settings.user}{path[1:]}"
+        home = (self.status.facts or {}).get("home") or f"/home/{self.user}"
+        return f"{home}{path[1:]}"
@@ -1,98 +1,252 @@
 import json
+import os
+import sqlite3
+import threading
 import time
-from typing import Dict, List, Set, Optional
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Set, Optional
 
 from scd.constants import *
 from scd.data_structs import FileData, StatusData, empty_status
 from scd.utils import time_stamp_to_date
 
+Modification = Callable[[StatusData], None]
 
+
+# The status of each host is stored as a row in an SQLite database and loaded
+# when it is first needed. Modifications are applied to the in memory status
+# directly and written in a single transaction when saved, reapplied on top
+# of the stored row so that concurrent scd processes don't lose each others
+# changes. Inside a batch, saving is postponed until the batch ends.
 class HostStatus:
+    BUSY_TIMEOUT = 30
 
     def __init__(self):
         self.status: Dict[str, StatusData] = {}
-        self.host_mappings: Dict[str, str] = {}
-        with open(SERVER_STATUS_FILE) as f:
-            try:
-                data = json.load(f)
-            except json.decoder.JSONDecodeError:
-                return
-            status = data.get("status")
-            if status:
-                self.status = self._read_host_status(status)
-            self.host_mappings = data.get("host_mappings") or {}
+        self._pending: Dict[str, List[Modification]] = {}
+        self._batch_depth = 0
+        self._lock = threading.RLock()
+        # The thread with a transaction open, and what to run once it has ended
+        self._transaction_thread: Optional[int] = None
+        self._after_transaction: List[Callable[[], None]] = []
+
+        self._db = sqlite3.connect(SERVER_STATUS_DB, timeout=self.BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        with self._transaction():
+            self._db.execute("CREATE TABLE IF NOT EXISTS status (host TEXT PRIMARY KEY, data TEXT NOT NULL)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS host_mappings (url TEXT PRIMARY KEY, name TEXT NOT NULL)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            self._import_legacy_status()
 
     def __getitem__(self, host: str) -> StatusData:
-        if host not in self.status:
-            self.status[host] = empty_status()
-        return self.status[host]
+        with self._lock:
+            if host not in self.status:
+                self.status[host] = self._load(host) or empty_status()
+            return self.status[host]
 
     def update(self,
                hostname: str,
                installed_programs: Set[str]=None,
                deployed_files: List[FileData]=None,
                shell: Optional[str]=None,
-               scripts: List[str]=None) -> None:
-        if not (installed_programs or deployed_files or shell or scripts):
+               scripts: List[str]=None,
+               manifest: Dict[str, List]=None) -> None:
+        if not (installed_programs or deployed_files or shell or scripts or manifest):
             return
 
-        status = self.status[hostname] if hostname in self.status else empty_status()
-        status.last_deployment = time_stamp_to_date(time.time())
+        last_deployment = time_stamp_to_date(time.time())
+
+        def _update(status: StatusData) -> None:
+            # Files changed since the last deployment of files are deployed again by hosts without a manifest
+            if deployed_files:
+                status.last_deployment = last_deployment
+
+            programs: Set[str] = set(status.installed_programs)
+
+            if installed_programs:
+                programs.update(installed_programs)
+            if deployed_files:
+                status.deployed_files = [f.from_path for f in deployed_files]
+            if shell:
+                programs.add(shell)
+                status.shell = shell
+            if scripts:
+                status.executed_scripts = status.executed_scripts + [s for s in scripts if s not in status.executed_scripts]
+            if manifest:
+                status.manifest = manifest
+
+            status.installed_programs = list(programs)
+
+        self._modify(hostname, _update)
+
+    # What a deployment did, recorded whether it succeeded or not
+    def update_results(self, hostname: str, script_results: Dict[str, List], deploy_seconds: float) -> None:
+        def _update(status: StatusData) -> None:
+            status.script_results = {**status.script_results, **script_results}
+            status.deploy_seconds = deploy_seconds
+
+        self._modify(hostname, _update)
+
+    def update_manifest(self, hostname: str, manifest: Dict[str, List]) -> None:
+        if self[hostname].manifest == manifest:
+            return
+
+        def _update(status: StatusData) -> None:
+            status.manifest = manifest
+
+        self._modify(hostname, _update)
 
-        programs: Set[str] = set(status.installed_programs)
+    def update_link(self, hostname: str, codecs: List[str]=None, throughput: float=None, rtt: float=None, probe_throughput: float=None) -> None:
+        def _update(status: StatusData) -> None:
+            if codecs is not None:
+                status.codecs = codecs
+            if throughput is not None:
+                status.throughput = throughput
+            if rtt is not None:
+                status.rtt = rtt
+            if probe_throughput is not None:
+                status.probe_throughput = probe_throughput
 
-        if installed_programs:
-            programs.update(installed_programs)
-        if deployed_files:
-            status.deployed_files = [f.from_path for f in deployed_files]
-        if shell:
-            programs.add(shell)
-            status.shell = shell
-        if scripts:
-            status.executed_scripts = scripts
+        self._modify(hostname, _update)
 
-        status.installed_programs = list(programs)
-        self.status[hostname] = status
-        self.save()
+    def update_sudo(self, hostname: str, sudo: bool) -> None:
+        def _update(status: StatusData) -> None:
+            status.sudo = sudo
+
+        self._modify(hostname, _update)
+
+    def update_facts(self, hostname: str, facts: Dict[str, any]) -> None:
+        def _update(status: StatusData) -> None:
+            status.facts = facts
+
+        self._modify(hostname, _update)
 
     def add_host_mapping(self, url: str, name: str) -> None:
-        self.host_mappings[url] = name
-        self.save()
+        with self._lock, self._transaction():
+            self._db.execute("INSERT OR REPLACE INTO host_mappings (url, name) VALUES (?, ?)", (url, name))
 
     def get_host_name(self, url: str) -> Optional[str]:
-        return self.host_mappings.get(url)
+        with self._lock:
+            row = self._db.execute("SELECT name FROM host_mappings WHERE url = ?", (url,)).fetchone()
+            return row[0] if row else None
+
+    def find(self, host: str) -> Optional[StatusData]:
+        with self._lock:
+            for name in (host, self.get_host_name(host)):
+                status = name and (self.status.get(name) or self._load(name))
+                if status:
+                    return status
+            return None
 
     def clear(self, url: str) -> bool:
-        name = self.get_host_name(url)
-        if name and name in self.status:
-            del self.status[name]
-            return True
-        if url in self.status:
-            del self.status[url]
-            return True
-        return False
+        with self._lock, self._transaction():
+            for host in (self.get_host_name(url), url):
+                if host and self._db.execute("DELETE FROM status WHERE host = ?", (host,)).rowcount > 0:
+                    self.status.pop(host, None)
+                    self._pending.pop(host, None)
+                    return True
+            return False
+
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        with self._lock:
+            self._batch_depth += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._batch_depth -= 1
+                if self._batch_depth == 0:
+                    self.save()
 
     def save(self) -> None:
-        with open(SERVER_STATUS_FILE, "w") as f:
-            f.seek(0)
-            f.truncate()
-            json.dump(self.as_dict(), f)
+        with self._lock:
+            if not self._pending:
+                return
+
+            pending, self._pending = self._pending, {}
+            with self._transaction():
+                for host, modifications in pending.items():
+                    status = self._load(host) or empty_status()
+                    for modify in modifications:
+                        modify(status)
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO status (host, data) VALUES (?, ?)",
+                        (host, json.dumps(status.__dict__))
+                    )
+                    self[host].init(status.__dict__)
+
+    # Whether the current thread is in the middle of a transaction, which a
+    # signal handler running on it mustn't start another one in
+    def in_transaction(self) -> bool:
+        return self._transaction_thread == threading.get_ident()
+
+    # Runs do once the transaction of the current thread has ended
+    def after_transaction(self, do: Callable[[], None]) -> None:
+        self._after_transaction.append(do)
 
     def as_dict(self) -> Dict[str, any]:
-        status_data = {}
-        for host, status in self.status.items():
-            status_data[host] = status.__dict__
+        with self._lock:
+            status_data = {host: json.loads(data) for host, data in self._db.execute("SELECT host, data FROM status")}
+            host_mappings = dict(self._db.execute("SELECT url, name FROM host_mappings"))
 
         return {
-            "host_mappings": self.host_mappings,
+            "host_mappings": host_mappings,
             "status": status_data
         }
 
-    @staticmethod
-    def _read_host_status(status_data: Dict[str, any]) -> Dict[str, StatusData]:
-        statuses: Dict[str, StatusData] = {}
-        for host, data in status_data.items():
+    def _modify(self, hostname: str, modify: Modification) -> None:
+        with self._lock:
+            modify(self[hostname])
+            self._pending.setdefault(hostname, []).append(modify)
+            if self._batch_depth == 0:
+                self.save()
+
+    def _load(self, host: str) -> Optional[StatusData]:
+        row = self._db.execute("SELECT data FROM status WHERE host = ?", (host,)).fetchone()
+        if not row:
+            return None
+        status = empty_status()
+        status.init(json.loads(row[0]))
+        return status
+
+    @contextmanager
+    def _transaction(self) -> Iterator[None]:
+        # Takes the write lock of the database up front so that concurrent
+        # processes wait for each other instead of failing mid transaction
+        self._transaction_thread = threading.get_ident()
+        try:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+        finally:
+            self._transaction_thread = None
+            after_transaction, self._after_transaction = self._after_transaction, []
+            for do in after_transaction:
+                do()
+
+    def _import_legacy_status(self) -> None:
+        if self._db.execute("SELECT 1 FROM meta WHERE key = 'legacy_imported'").fetchone():
+            return
+
+        self._db.execute("INSERT INTO meta (key, value) VALUES ('legacy_imported', ?)", (time_stamp_to_date(time.time()),))
+        if not os.path.isfile(SERVER_STATUS_FILE):
+            return
+
+        with open(SERVER_STATUS_FILE) as f:
+            try:
+                data = json.load(f)
+            except json.decoder.JSONDecodeError:
+                return
+
+        for host, host_data in (data.get("status") or {}).items():
             status = empty_status()
-            status.init(data)
-            statuses[host] = status
-        return statuses
+            status.init(host_data)
+            self._db.execute("INSERT OR REPLACE INTO status (host, data) VALUES (?, ?)", (host, json.dumps(status.__dict__)))
+        for url, name in (data.get("host_mappings") or {}).items():
+            self._db.execute("INSERT OR REPLACE INTO host_mappings (url, name) VALUES (?, ?)", (url, name))
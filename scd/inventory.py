@@ -0,0 +1,72 @@
+import itertools
+import re
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+RANGE = re.compile(r"\[([^\[\]]*)\]")
+OVERRIDES = ["user", "port", "private_key"]
+
+
+class Group:
+    def __init__(self, name: str, patterns: List[str], overrides: Dict[str, any]):
+        self.name = name
+        self.hosts = expand_patterns(patterns)
+        self.overrides = overrides
+
+
+# Named groups of hosts, each of which can override the user, port and private
+# key used to connect to its hosts. A host can be part of several groups, in
+# which case the groups defined later take precedence.
+class Inventory:
+    def __init__(self, groups: List[Group]):
+        self.groups: Dict[str, Group] = OrderedDict((g.name, g) for g in groups)
+        self.overrides: Dict[str, Dict[str, any]] = {}
+        for group in groups:
+            for host in group.hosts:
+                self.overrides.setdefault(host, {}).update(group.overrides)
+
+    def all_hosts(self) -> List[str]:
+        return list(OrderedDict.fromkeys(h for g in self.groups.values() for h in g.hosts))
+
+    # Names of groups are replaced by their hosts and patterns by the hosts they match
+    def expand(self, names: List[str]) -> List[str]:
+        hosts = []
+        for name in names:
+            group = self.groups.get(name)
+            hosts.extend(group.hosts if group else expand_pattern(name))
+        return list(OrderedDict.fromkeys(hosts))
+
+    def override_for(self, host: str, key: str) -> Optional[any]:
+        return self.overrides.get(host, {}).get(key)
+
+
+def expand_patterns(patterns: List[str]) -> List[str]:
+    return [host for pattern in patterns for host in expand_pattern(pattern)]
+
+
+# Expands the ranges in brackets of a pattern, web[01-03,07].dc[1-2] expands to
+# web01.dc1, web01.dc2, web02.dc1 up to web07.dc2. Numbers keep the width of
+# the start of their range so leading zeros are kept. Raises a ValueError for
+# invalid ranges.
+def expand_pattern(pattern: str) -> List[str]:
+    parts = RANGE.split(pattern)
+    if "[" in "".join(parts[::2]) or "]" in "".join(parts[::2]):
+        raise ValueError(f"Unbalanced brackets in {pattern}")
+
+    choices = [[part] if i % 2 == 0 else _expand_range(part, pattern) for i, part in enumerate(parts)]
+    return ["".join(p) for p in itertools.product(*choices)]
+
+
+def _expand_range(spec: str, pattern: str) -> List[str]:
+    values = []
+    for item in spec.split(","):
+        match = re.fullmatch(r"(\d+)(?:-(\d+))?", item.strip())
+        if not match:
+            raise ValueError(f"Invalid range [{spec}] in {pattern}, expected numbers such as [1-10] or [01,03,05-09]")
+
+        start, end = match.group(1), match.group(2) or match.group(1)
+        if int(end) < int(start):
+            raise ValueError(f"Invalid range [{spec}] in {pattern}, {end} is smaller than {start}")
+        width = len(start) if start.startswith("0") else 0
+        values.extend(str(i).zfill(width) for i in range(int(start), int(end) + 1))
+    return values
@@ -1,79 +1,346 @@
 import signal
 import sys
-import traceback
-from typing import List
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple, TYPE_CHECKING
 
-from pygments import highlight, lexers, formatters
-
-from scd import colors
-from scd.config_deployer import ConfigDeployer, DeploymentException
+from scd import colors, rollout, tracing
+from scd.artifact_cache import ArtifactCache
 from scd.constants import *
-from scd.host import Host
+from scd.data_structs import DeploymentException, DeploymentResult
 from scd.host_configuration import HostConfiguration
 from scd.host_status import HostStatus, empty_status
+from scd.output import HostState, Output
 from scd.printer import Printer
+from scd.scanner import ScanIndex, Snapshot
 from scd.settings import Settings
 from scd.utils import *
 
+# paramiko and pygments take longer to import than a run with nothing to
+# deploy takes in total, so they're only imported once they are needed
+if TYPE_CHECKING:
+    from scd.host import Host
+
 
 class SCD:
 
     def __init__(self):
         self.settings: Settings = None
         self.host_status: HostStatus = None
+        self.artifact_cache: ArtifactCache = None
+        self.scan_index: ScanIndex = None
+        self.snapshot: Snapshot = None
+        self.output: Output = None
         self.printer = Printer()
-        self.hosts: List[Host] = []
+        self.hosts: List["Host"] = []
+        self.running_in_parallel = False
 
     def run(self):
         self.settings = Settings()
-        self.printer = Printer(self.settings.verbose)
+        self.output = Output(log_folder=self.settings.log_folder, status_table=self.settings.status_table)
+        self.printer = Printer(self.settings.verbose, self.output)
+        if self.settings.trace:
+            tracing.enable()
+        if self.settings.profile:
+            tracing.enable_profiling()
+
+        try:
+            with tracing.profile():
+                self._run()
+        finally:
+            # Also written when the run failed, which is when they're needed the most
+            if self.settings.trace:
+                spans = tracing.write_trace(self.settings.trace)
+                self.printer.info("Wrote %s spans to %s.", spans, self.settings.trace, verbose=True)
+            if self.settings.profile:
+                tracing.write_profile(self.settings.profile)
+                self.printer.info("Wrote profile to %s.", self.settings.profile, verbose=True)
+            self.output.close()
+
+    def _run(self):
         self.host_status = HostStatus()
+        self.artifact_cache = ArtifactCache(self.settings.cache_size)
+        if self.settings.use_scan_index:
+            self.scan_index = ScanIndex(self.settings.ignored_files)
+        self.snapshot = Snapshot(self.settings.ignored_files, self.settings.scan_threads, self.scan_index)
+
+        urls = list(OrderedDict.fromkeys(self.settings.hosts))
+
+        for url in urls:
+            self.output.set_state(url, HostState.WAITING)
+        rolling = self.settings.canary or self.settings.batch_size or self.settings.max_failures is not None
+        if self.settings.probe:
+            self._probe_hosts(urls)
+        elif self.settings.plan:
+            self._print_plan(urls)
+        elif (self.settings.parallel > 1 or rolling) and len(urls) > 1:
+            self._deploy_in_waves(urls)
+        else:
+            for url in urls:
+                self._deploy(url)
+
+        if self.scan_index:
+            self.scan_index.save()
+
+    def _deploy_in_waves(self, urls: List[str]) -> None:
+        start = timer()
+        waves = rollout.plan_waves(urls, self.settings.canary, self.settings.batch_size, self._expected_work)
+        workers = min(self.settings.parallel, max(len(wave) for wave in waves))
+        self.printer.info("Deploying to %s hosts in %s waves using %s workers.", len(urls), len(waves), workers, verbose=True)
+
+        self.running_in_parallel = workers > 1
+        if self.running_in_parallel:
+            self.output.show_hosts(urls)
+        results: List[DeploymentResult] = []
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for i, wave in enumerate(waves):
+                if i > 0 and self._should_stop(results, is_canary=i == 1 and self.settings.canary > 0):
+                    results.extend(self._skip(url) for remaining in waves[i:] for url in remaining)
+                    break
+                if self.running_in_parallel:
+                    results.extend(executor.map(self._deploy_in_thread, wave))
+                else:
+                    results.extend(self._deploy(url) for url in wave)
+        self.running_in_parallel = False
+
+        self._print_summary(results, get_time(start))
+
+    def _should_stop(self, results: List[DeploymentResult], is_canary: bool) -> bool:
+        failed = len([r for r in results if r.result == DeploymentResult.FAILED])
+        if is_canary and failed > 0:
+            self.printer.error("Deployment to %s of the %s canary hosts failed, not deploying to the remaining hosts.", failed, len(results))
+            return True
+        if self.settings.max_failures is not None and failed > self.settings.max_failures:
+            self.printer.error("Deployment to %s hosts failed which is more than the %s allowed, not deploying to the remaining hosts.", failed, self.settings.max_failures)
+            return True
+        return False
+
+    def _skip(self, url: str) -> DeploymentResult:
+        self.output.set_state(url, HostState.SKIPPED)
+        return DeploymentResult(url, DeploymentResult.SKIPPED, "0")
+
+    def _expected_work(self, url: str) -> Tuple[float, ...]:
+        # How long the last deployment to the host took. Hosts that have never
+        # been deployed to come first, those on the slowest links measured by
+        # scd --probe first of all.
+        name = self.host_status.get_host_name(url)
+        status = self.host_status[name] if name else empty_status()
+        if status.deploy_seconds:
+            return 0, status.deploy_seconds
+        rtt = float("inf") if status.rtt is None else status.rtt
+        return 1, rtt, -(status.link_throughput() or 0)
+
+    def _print_plan(self, urls: List[str]) -> None:
+        # What a deployment would do, worked out from the host status without connecting to the hosts
+        start = timer()
+        hosts = files = size = 0
+        for url in urls:
+            name = self.host_status.get_host_name(url)
+            configuration = self._get_configuration(url, name, self.printer.for_host(url))
+            if configuration.is_empty():
+                self.printer.info("%s: up to date.", url)
+                continue
+
+            changes, items = [], []
+            if configuration.files:
+                changes.append("%s file (%s)" if len(configuration.files) == 1 else "%s files (%s)")
+                items.extend([len(configuration.files), format_size(configuration.files_size())])
+            if configuration.programs:
+                changes.append("install %s")
+                items.append(", ".join(sorted(configuration.programs)))
+            if configuration.scripts:
+                changes.append("run %s")
+                items.append(", ".join(s.path for s in configuration.scripts))
+            if configuration.shell:
+                changes.append("change shell to %s")
+                items.append(configuration.shell)
+            never_deployed = "" if name else " (never deployed to)"
+            self.printer.info(f"%s{never_deployed}: {', '.join(changes)}.", url, *items)
+
+            hosts += 1
+            files += len(configuration.files)
+            size += configuration.files_size()
+
+        self.printer.info(
+            "%s of %s hosts need a deployment, %s files (%s) in total. Planned in %s s.",
+            hosts, len(urls), files, format_size(size), get_time(start)
+        )
 
-        for host in self.settings.hosts:
-            start = timer()
-            self.printer.info("Checking host %s.", host, verbose=True)
-            self.printer.info("", verbose=True)
+    def _probe_hosts(self, urls: List[str]) -> None:
+        start = timer()
+        workers = min(self.settings.parallel, len(urls))
+        self.printer.info("Probing %s hosts using %s workers.", len(urls), workers, verbose=True)
+
+        self.running_in_parallel = workers > 1
+        if self.running_in_parallel:
+            self.output.show_hosts(urls)
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(self._probe_in_thread, urls))
+        else:
+            results = [self._probe(url) for url in urls]
+        self.running_in_parallel = False
+
+        failed = [url for url, succeeded in zip(urls, results) if not succeeded]
+        print_result = self.printer.error if failed else self.printer.success
+        print_result("Probed %s hosts and %s failed in %s s.", len(urls) - len(failed), len(failed), get_time(start))
+        if failed:
+            self.printer.error("Failed hosts:")
+            self.printer.error(failed)
+
+    def _probe_in_thread(self, url: str) -> bool:
+        with tracing.profile():
+            return self._probe(url)
+
+    def _probe(self, url: str) -> bool:
+        tracing.set_host(url)
+        printer = self.printer.for_host(url)
+        self.output.set_state(url, HostState.CHECKING)
+        from scd.host import Host
+        with tracing.span("probe", host=url):
+            host = None
             try:
-                if self._deploy_config_to_host(host):
-                    elapsed_time = get_time(start)
-                    self.printer.success("Configuration successfully deployed to %s in %s s.", host, elapsed_time)
+                # Constructing the host resolves its hostname
+                host = Host(printer, self.settings, self.host_status, url)
+                self.hosts.append(host)
+                host.probe_facts(force=True)
+                rtt = host.measure_rtt()
+                throughput = host.measure_throughput(rtt)
+                sudo = host.check_sudo()
             except DeploymentException:
-                self.printer.error("Failed deploying configuration to %s.", host)
+                printer.error("Failed probing %s.", url)
+                self.output.set_state(url, HostState.FAILED)
+                return False
+            finally:
+                if host:
+                    host.close()
 
-    def _deploy_config_to_host(self, url: str) -> bool:
-        host = Host(self.printer, self.settings, self.host_status, url)
-        self.hosts.append(host)
+        printer.success(
+            "Probed %s (%s): %s ms round trip time, %s Mbit/s upload, %s.",
+            url, host.name, round(rtt * 1000, 1), round(throughput * 8 / 1e6, 1), "sudo works" if sudo else "no sudo"
+        )
+        self.output.set_state(url, HostState.PROBED)
+        return True
+
+    def _deploy_in_thread(self, url: str) -> DeploymentResult:
+        with tracing.profile():
+            return self._deploy(url)
+
+    def _deploy(self, url: str) -> DeploymentResult:
+        tracing.set_host(url)
+        with tracing.span("deploy", host=url):
+            return self._deploy_and_report(url)
 
-        host_status = empty_status() if self.settings.force else host.status
-        configuration = HostConfiguration(self.printer, self.settings, host_status)
+    def _deploy_and_report(self, url: str) -> DeploymentResult:
+        start = timer()
+        printer = self.printer.for_host(url)
+        self.output.set_state(url, HostState.CHECKING)
+        printer.info("Checking host %s.", url, verbose=True)
+        printer.info("", verbose=True)
+        try:
+            if not self._deploy_config_to_host(url, printer):
+                self.output.set_state(url, HostState.UNCHANGED)
+                return DeploymentResult(url, DeploymentResult.UNCHANGED, get_time(start))
+        except DeploymentException:
+            printer.error("Failed deploying configuration to %s.", url)
+            self.output.set_state(url, HostState.FAILED)
+            return DeploymentResult(url, DeploymentResult.FAILED, get_time(start))
+        except Exception as e:
+            # Such as a connection dropped midway, which mustn't stop the deployment to the other hosts
+            printer.error("Failed deploying configuration to %s, an unexpected error occurred:", url)
+            printer.error(f"    {type(e).__name__}: {e}")
+            self.output.set_state(url, HostState.FAILED)
+            return DeploymentResult(url, DeploymentResult.FAILED, get_time(start))
 
-        if configuration.is_empty():
-            self.printer.info("No changes to %s. Skipping deployment.", host.name, verbose=True)
+        elapsed_time = get_time(start)
+        printer.success("Configuration successfully deployed to %s in %s s.", url, elapsed_time)
+        self.output.set_state(url, HostState.DEPLOYED)
+        return DeploymentResult(url, DeploymentResult.DEPLOYED, elapsed_time)
+
+    def _print_summary(self, results: List[DeploymentResult], elapsed_time: str) -> None:
+        def _count(result: str) -> int:
+            return len([r for r in results if r.result == result])
+
+        failed = [r.url for r in results if r.result == DeploymentResult.FAILED]
+        print_result = self.printer.error if failed else self.printer.success
+        print_result(
+            "Deployed to %s hosts, %s unchanged, %s failed and %s skipped in %s s.",
+            _count(DeploymentResult.DEPLOYED), _count(DeploymentResult.UNCHANGED), len(failed), _count(DeploymentResult.SKIPPED), elapsed_time
+        )
+        if failed:
+            self.printer.error("Failed hosts:")
+            self.printer.error(failed)
+
+    def _deploy_config_to_host(self, url: str, printer: Printer) -> bool:
+        start = timer()
+        # When the hostname is known we can tell whether there's anything to
+        # deploy before importing paramiko or connecting to the host
+        name = self.host_status.get_host_name(url)
+        configuration = self._get_configuration(url, name, printer) if name else None
+        if configuration and configuration.is_empty():
+            self._skip_deployment(name, configuration, printer)
             return False
 
-        self._deploy_configuration(host, configuration)
-        return True
+        from scd.host import Host
+        host = Host(printer, self.settings, self.host_status, url)
+        self.hosts.append(host)
+
+        try:
+            # Facts that were missing or out of date can change what has to be deployed
+            if host.probe_facts() or configuration is None:
+                configuration = self._get_configuration(url, host.name, printer)
+            if configuration.is_empty():
+                self._skip_deployment(host.name, configuration, printer)
+                return False
 
-    def _deploy_configuration(self, host: Host, configuration: HostConfiguration) -> None:
-        config_deployer = ConfigDeployer(self.printer, host)
+            self.output.set_state(url, HostState.DEPLOYING)
+            self._deploy_configuration(host, configuration, printer, start)
+            return True
+        finally:
+            host.close()
 
-        config_deployer.install_programs(configuration.programs)
-        self.host_status.update(host.name, installed_programs=self.settings.programs)
+    def _get_configuration(self, url: str, name: Optional[str], printer: Printer) -> HostConfiguration:
+        # Hosts whose name isn't known yet haven't been deployed to
+        host_status = self.host_status[name] if name else empty_status()
+        if self.settings.force:
+            facts = host_status.facts
+            host_status = empty_status()
+            host_status.facts = facts
+        return HostConfiguration(printer, self.settings, host_status, self.snapshot, self.settings.user_for(url))
 
-        config_deployer.deploy_files(configuration.files)
-        self.host_status.update(host.name, deployed_files=self.settings.files)
+    def _skip_deployment(self, name: str, configuration: HostConfiguration, printer: Printer) -> None:
+        printer.info("No changes to %s. Skipping deployment.", name, verbose=True)
+        # Files that were touched but not changed don't have to be hashed again next time
+        self.host_status.update_manifest(name, configuration.manifest)
 
-        config_deployer.change_shell(configuration.shell)
-        self.host_status.update(host.name, shell=configuration.shell)
+    def _deploy_configuration(self, host: "Host", configuration: HostConfiguration, printer: Printer, start: float) -> None:
+        from scd.config_deployer import ConfigDeployer
+        from scd.execution_plan import Step
+        config_deployer = ConfigDeployer(printer, self.settings, host, self.artifact_cache)
+        plan = config_deployer.deploy(configuration)
 
-        executed_scripts = config_deployer.run_scripts(configuration.scripts)
-        self.host_status.update(host.name, scripts=executed_scripts)
-        if len(configuration.scripts) != len(executed_scripts):
+        # Only what succeeded is recorded so the rest is retried by the next deployment
+        with tracing.span("save status"), self.host_status.batch():
+            if plan.succeeded(Step.FILES):
+                self.host_status.update(host.name, deployed_files=self.settings.files, manifest=configuration.manifest)
+            if plan.succeeded(Step.PROGRAMS):
+                self.host_status.update(host.name, installed_programs=self.settings.programs)
+            if plan.succeeded(Step.SHELL):
+                self.host_status.update(host.name, shell=configuration.shell)
+            now = time_stamp_to_date(time.time())
+            script_results = {s.name: [s.exit_code, s.elapsed and round(s.elapsed, 2), now] for s in plan.steps if s.kind == Step.SCRIPT and s.has_run()}
+            self.host_status.update(host.name, scripts=plan.succeeded_steps(Step.SCRIPT))
+            self.host_status.update_results(host.name, script_results, round(timer() - start, 2))
+
+        if not plan.succeeded() or len(plan.succeeded_steps(Step.SCRIPT)) != len(configuration.scripts):
             raise DeploymentException
 
     def color_exceptions(self, tpe, value, tb):
+        import traceback
         stack_trace = "".join(traceback.format_exception(tpe, value, tb))
         if not colors.no_color:
+            from pygments import highlight, lexers, formatters
             lexer = lexers.get_lexer_by_name("pytb", stripall=True)
             formatter = formatters.TerminalFormatter()
             stack_trace = highlight(stack_trace, lexer, formatter)
@@ -83,16 +350,26 @@ class SCD:
             self.printer.info(line)
 
     def sigint_handler(self, _signal, _frame):
+        if self.host_status and self.host_status.in_transaction():
+            # Interrupted while saving the status, saving again would nest
+            # transactions, so the handler runs once the transaction has ended
+            self.host_status.after_transaction(lambda: self.sigint_handler(_signal, _frame))
+            return
+
         print()  # since most terminals echo ^C
         self.printer.error("Received ^C, exiting...")
 
-        for file in TEMPORARY_FILES:
-            if os.path.isfile(file):
-                os.remove(file)
+        remove_temporary_files()
+        if self.host_status:
+            self.host_status.save()
 
         for host in self.hosts:
-            host.cleanup()
+            host.close()
 
+        if self.running_in_parallel:
+            # sys.exit would wait for the worker threads to finish their deployments
+            self.printer.output.flush()
+            os._exit(0)
         sys.exit(0)
 
 
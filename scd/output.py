@@ -0,0 +1,199 @@
+import atexit
+import os
+import re
+import sys
+import threading
+import weakref
+from collections import OrderedDict
+from timeit import default_timer as timer
+from typing import Dict, List, Optional, TextIO
+
+from scd import colors
+from scd.utils import get_time
+
+ANSI_ESCAPE = re.compile(r"\033\[[0-9;]*[A-Za-z]")
+
+# Outputs that haven't been closed, flushed by a single handler at exit
+_open_outputs: "weakref.WeakSet[Output]" = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_open_outputs() -> None:
+    for output in list(_open_outputs):
+        output.flush()
+
+
+class HostState:
+    WAITING = "waiting"
+    CHECKING = "checking"
+    DEPLOYING = "deploying"
+    DEPLOYED = "deployed"
+    UNCHANGED = "unchanged"
+    FAILED = "failed"
+    SKIPPED = "skipped"
+    PROBED = "probed"
+
+
+# Where everything printed by the Printers ends up. Lines are buffered per host
+# and written in whole blocks a few times a second, so output from concurrent
+# deployments never interleaves within a line and a long file list doesn't
+# cost a flush per line. When deploying to several hosts at once each line is
+# prefixed with its host. The output of each host can also be written to a
+# log file of its own, and on a terminal a table with the state of each host
+# can be shown instead of the output of the hosts.
+class Output:
+    FLUSH_INTERVAL = 0.1
+
+    def __init__(self, stream: TextIO = None, log_folder: Optional[str] = None, status_table=False):
+        self.stream = stream or sys.stdout
+        self.log_folder = log_folder and os.path.expanduser(log_folder)
+        self.table = StatusTable() if status_table and self.stream.isatty() else None
+        self.host_width = 0
+        self.lock = threading.RLock()
+        self.pending: Dict[Optional[str], List[str]] = OrderedDict()
+        self.log_files: Dict[str, TextIO] = {}
+        self.flush_timer: Optional[threading.Timer] = None
+        _open_outputs.add(self)
+
+    def show_hosts(self, hosts: List[str]) -> None:
+        with self.lock:
+            self.host_width = max(len(h) for h in hosts)
+            if self.table:
+                for host in hosts:
+                    self.table.set_state(host, HostState.WAITING)
+
+    def set_state(self, host: str, state: str) -> None:
+        if self.table:
+            with self.lock:
+                self.table.set_state(host, state)
+                self._schedule_flush()
+
+    def write(self, host: Optional[str], lines: List[str], is_error=False, end="\n") -> None:
+        with self.lock:
+            if host and self.log_folder:
+                self._log(host, lines)
+
+            if self.table and host and not is_error:
+                self.table.set_message(host, lines[-1])
+            else:
+                prefix = self._prefix(host)
+                self.pending.setdefault(host, []).extend(prefix + line + end for line in lines)
+
+            # Output not ending with a newline is a prompt the user has to see right away
+            if end != "\n":
+                self.flush()
+            else:
+                self._schedule_flush()
+
+    def flush(self) -> None:
+        with self.lock:
+            if self.flush_timer:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+
+            text = [line for lines in self.pending.values() for line in lines]
+            self.pending.clear()
+            if self.table:
+                text = [self.table.clear(), *text, self.table.render()]
+            self.stream.write("".join(text))
+            self.stream.flush()
+            for f in self.log_files.values():
+                f.flush()
+
+            # Redrawn regularly so the elapsed times keep counting
+            if self.table and self.table.is_running():
+                self._schedule_flush()
+
+    def close(self) -> None:
+        _open_outputs.discard(self)
+        with self.lock:
+            self.flush()
+            self.table = None
+            for f in self.log_files.values():
+                f.close()
+            self.log_files.clear()
+
+    def _prefix(self, host: Optional[str]) -> str:
+        prefix = colors.bold(colors.cyan("SCD │ "))
+        if self.host_width == 0:
+            return prefix
+        return prefix + colors.bold((host or "").ljust(self.host_width)) + colors.bold(colors.cyan(" │ "))
+
+    def _schedule_flush(self) -> None:
+        if self.flush_timer is None:
+            self.flush_timer = threading.Timer(self.FLUSH_INTERVAL, self.flush)
+            self.flush_timer.daemon = True
+            self.flush_timer.start()
+
+    def _log(self, host: str, lines: List[str]) -> None:
+        log_file = self.log_files.get(host)
+        if log_file is None:
+            os.makedirs(self.log_folder, exist_ok=True)
+            log_file = open(os.path.join(self.log_folder, f"{host}.log"), "a")
+            self.log_files[host] = log_file
+        log_file.writelines(ANSI_ESCAPE.sub("", line) + "\n" for line in lines)
+
+
+class StatusTable:
+    STATE_COLORS = {
+        HostState.DEPLOYING: colors.yellow,
+        HostState.DEPLOYED: colors.green,
+        HostState.PROBED: colors.green,
+        HostState.FAILED: colors.red
+    }
+
+    FINAL_STATES = [HostState.DEPLOYED, HostState.UNCHANGED, HostState.FAILED, HostState.SKIPPED, HostState.PROBED]
+
+    def __init__(self):
+        # Maps each host to [state, last message, start time, elapsed time once finished]
+        self.hosts: Dict[str, List] = OrderedDict()
+        self.height = 0
+
+    def set_state(self, host: str, state: str) -> None:
+        entry = self.hosts.setdefault(host, [state, "", timer(), None])
+        if entry[0] == HostState.WAITING and state != HostState.WAITING:
+            entry[2] = timer()
+        if state in self.FINAL_STATES:
+            entry[3] = get_time(entry[2])
+        entry[0] = state
+
+    def set_message(self, host: str, message: str) -> None:
+        self.hosts.setdefault(host, [HostState.CHECKING, "", timer(), None])[1] = message
+
+    def is_running(self) -> bool:
+        return any(state not in self.FINAL_STATES for state, _, _, _ in self.hosts.values())
+
+    def clear(self) -> str:
+        # Moves the cursor back to where the table started and erases it
+        text = f"\033[{self.height}F\033[J" if self.height else ""
+        self.height = 0
+        return text
+
+    def render(self) -> str:
+        import shutil
+        width = shutil.get_terminal_size().columns
+        host_width = max([len(h) for h in self.hosts] + [0])
+        lines = []
+        for host, (state, message, start, elapsed) in self.hosts.items():
+            color = self.STATE_COLORS.get(state, colors.empty_color)
+            elapsed = "" if state in [HostState.WAITING, HostState.SKIPPED] else (elapsed or get_time(start)) + " s"
+            message = ANSI_ESCAPE.sub("", message).strip()
+            line = f"{host.ljust(host_width)}  {state.ljust(9)}  {elapsed.rjust(8)}  {message}"
+            lines.append(color(line[:width - 1]) + "\n")
+
+        self.height = len(lines)
+        return "".join(lines)
+
+
+_default_output: Optional[Output] = None
+_default_output_lock = threading.Lock()
+
+
+# The Output of Printers not given one of their own, shared so that there is a
+# single buffer and a single flush at exit however many such Printers exist
+def default_output() -> Output:
+    global _default_output
+    with _default_output_lock:
+        if _default_output is None:
+            _default_output = Output()
+        return _default_output
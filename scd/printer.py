@@ -1,15 +1,21 @@
-from typing import Tuple, Union, List, Callable
+from typing import Tuple, Union, List, Callable, Optional
 
 from scd import colors
 from scd.constants import *
+from scd.output import Output, default_output
 
 
 class Printer:
-    def __init__(self, verbose_active=False):
+
+    def __init__(self, verbose_active=False, output: Optional[Output] = None, host: Optional[str] = None):
         self.verbose_active = verbose_active
-        self.prefix = colors.bold(colors.cyan("SCD │ "))
+        self.output = output or default_output()
+        self.host = host
         self.indent = "    "
 
+    def for_host(self, host: str) -> "Printer":
+        return Printer(self.verbose_active, self.output, host)
+
     def info(self, output: Union[str, List[str]], *items, verbose=False, end="\n") -> None:
         if not self.verbose_active and verbose:
             return
@@ -30,22 +36,27 @@ class Printer:
 
         def red_bold(s): return colors.red(colors.bold(s))
 
-        self._print(output, items, colors.red, red_bold, end)
+        self._print(output, items, colors.red, red_bold, end, is_error=True)
 
-    def _print(self, output: Union[str, List[str]], items: Tuple[any], str_color: Callable[[str], str], item_color: Callable[[str], str], end: str):
+    def _print(self, output: Union[str, List[str]], items: Tuple[any], str_color: Callable[[str], str], item_color: Callable[[str], str], end: str, is_error=False):
         if type(output) is str:
-            self._print_string(output, items, str_color, item_color, end)
+            lines = [self._format(output, items, str_color, item_color)]
         elif type(output) is list:
-            for line in output:
-                self._print_string(self.indent + line, tuple(), str_color, item_color, end)
+            lines = [self._format(self.indent + line, tuple(), str_color, item_color) for line in output]
+        else:
+            return
+
+        # All lines of a call are written together so they're never split up by output from other hosts
+        self.output.write(self.host, lines, is_error, end)
 
-    def _print_string(self, output: str, items: Tuple[any], str_color: Callable[[str], str], item_color: Callable[[str], str], end: str):
-        print(self.prefix, end="")
+    @staticmethod
+    def _format(output: str, items: Tuple[any], str_color: Callable[[str], str], item_color: Callable[[str], str]) -> str:
+        line = []
         i = 0
         for s in output.split("%s"):
-            print(str_color(s.replace(HOME, "~")), end="")
+            line.append(str_color(s.replace(HOME, "~")))
             if i < len(items):
                 item = str(items[i]).replace(HOME, "~")
-                print(item_color(item), end="")
+                line.append(item_color(item))
                 i += 1
-        print(end=end, flush=True)
+        return "".join(line)
@@ -0,0 +1,24 @@
+from typing import Callable, List, Optional, Tuple
+
+
+# Splits hosts into the waves of a rolling deployment: first the canary hosts,
+# in the order they were given, then the remaining hosts in batches. Hosts
+# expected to take the longest come first, so that each batch holds hosts
+# taking about as long and the long deployments start while the workers still
+# have short ones to fill in with.
+def plan_waves(urls: List[str], canary: int, batch_size: int, expected_work: Callable[[str], Tuple[float, ...]]) -> List[List[str]]:
+    waves = [urls[:canary]] if canary > 0 else []
+    remaining = sorted(urls[canary:], key=expected_work, reverse=True)
+    size = batch_size if batch_size > 0 else len(remaining)
+    waves.extend(remaining[i:i + size] for i in range(0, len(remaining), size))
+    return [wave for wave in waves if wave]
+
+
+# The number of failed hosts a deployment tolerates, either a number of hosts
+# or a percentage of the hosts such as "10%". None means no limit.
+def parse_failure_budget(value: any, num_hosts: int) -> Optional[int]:
+    if value is None:
+        return None
+    if type(value) is str and value.endswith("%"):
+        return int(float(value[:-1]) * num_hosts / 100)
+    return int(value)
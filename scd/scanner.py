@@ -0,0 +1,194 @@
+import json
+import os
+import re
+import threading
+import time
+from fnmatch import translate
+from typing import Dict, List, Optional, Pattern, Set, Tuple
+
+from scd import tracing
+from scd.constants import SCAN_INDEX_FILE, SCD_FOLDER
+from scd.utils import file_hash
+
+# Listings of directories modified this recently are not stored since the
+# directory could change again without its mtime changing
+RACY_INTERVAL_NS = 2 * 10 ** 9
+
+Listing = Tuple[List[str], List[str]]
+
+
+def _compile(patterns: List[str]) -> Optional[Pattern]:
+    if len(patterns) == 0:
+        return None
+    return re.compile("|".join(f"(?:{translate(p)})" for p in patterns))
+
+
+class IgnoreMatcher:
+    def __init__(self, patterns: List[str]):
+        self.regex = _compile(patterns)
+        # A pattern ending with * that matches "<directory>/" matches everything
+        # inside that directory, so the directory doesn't have to be listed at all
+        self.prune_regex = _compile([p for p in patterns if p.endswith("*")])
+
+    def is_ignored(self, path: str) -> bool:
+        return self.regex is not None and self.regex.match(path) is not None
+
+    def is_pruned(self, directory: str) -> bool:
+        if self.is_ignored(directory):
+            return True
+        return self.prune_regex is not None and self.prune_regex.match(directory + "/") is not None
+
+
+# Persistent index of the directories scanned in earlier runs. A directory is
+# only listed again if its mtime changed, which happens whenever an entry is
+# added, removed or renamed. Files in it are still stat:ed on every scan
+# since modifying a file doesn't change the mtime of its directory.
+class ScanIndex:
+    VERSION = 1
+
+    def __init__(self, ignored_files: List[str]):
+        self.ignored_files = ignored_files
+        self.directories: Dict[str, List] = {}
+        self.visited: Set[str] = set()
+        # Only directories below the roots scanned in this run can be known to be gone
+        self.scanned_roots: Set[str] = set()
+        self.changed = False
+        self.lock = threading.Lock()
+
+        try:
+            with open(SCAN_INDEX_FILE) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        # What's stored depends on the ignored files, so a changed configuration invalidates the index
+        if data.get("version") == self.VERSION and data.get("ignored_files") == ignored_files:
+            self.directories = data.get("directories") or {}
+
+    def get(self, directory: str, mtime: int) -> Optional[Listing]:
+        with self.lock:
+            self.visited.add(directory)
+            entry = self.directories.get(directory)
+            if entry and entry[0] == mtime:
+                return entry[1], entry[2]
+            return None
+
+    def add_root(self, root: str) -> None:
+        with self.lock:
+            self.scanned_roots.add(root)
+
+    def put(self, directory: str, mtime: int, listing: Listing) -> None:
+        if time.time() * 10 ** 9 - mtime < RACY_INTERVAL_NS:
+            return
+
+        with self.lock:
+            self.directories[directory] = [mtime, listing[0], listing[1]]
+            self.changed = True
+
+    def save(self) -> None:
+        with self.lock:
+            stale = [d for d in self.directories if d not in self.visited and self._is_below_scanned_root(d)]
+            if not (self.changed or stale):
+                return
+            for directory in stale:
+                del self.directories[directory]
+
+            import tempfile
+            data = {"version": self.VERSION, "ignored_files": self.ignored_files, "directories": self.directories}
+            fd, tmp_path = tempfile.mkstemp(prefix=".scan_index_", dir=SCD_FOLDER)
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f)
+            os.rename(tmp_path, SCAN_INDEX_FILE)
+            self.changed = False
+
+    def _is_below_scanned_root(self, directory: str) -> bool:
+        return any(directory == root or directory.startswith(root.rstrip("/") + "/") for root in self.scanned_roots)
+
+
+# The local files to deploy as they were when they were first needed in a run.
+# Each root is scanned and each file hashed at most once per run, however many
+# hosts the files are deployed to, and every host sees the same files.
+class Snapshot:
+    def __init__(self, ignored_files: List[str], threads: int = 1, index: Optional[ScanIndex] = None):
+        self.matcher = IgnoreMatcher(ignored_files)
+        self.threads = threads
+        self.index = index
+        self.roots: Dict[str, List[Tuple[str, os.stat_result]]] = {}
+        self.hashes: Dict[str, Tuple[int, int, str]] = {}
+        self.lock = threading.Lock()
+        self.root_locks: Dict[str, threading.Lock] = {}
+
+    def files(self, root: str) -> List[Tuple[str, os.stat_result]]:
+        with self.lock:
+            root_lock = self.root_locks.setdefault(root, threading.Lock())
+
+        # Hosts needing a root that is being scanned wait for the scan instead of scanning it as well
+        with root_lock:
+            if root not in self.roots:
+                with tracing.span("snapshot", root=root) as span:
+                    self.roots[root] = scan(root, self.matcher, self.threads, self.index)
+                    span.set(files=len(self.roots[root]))
+            return self.roots[root]
+
+    def hash(self, path: str, stat: os.stat_result) -> str:
+        with self.lock:
+            entry = self.hashes.get(path)
+        if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            return entry[2]
+
+        content_hash = file_hash(path)
+        with self.lock:
+            self.hashes[path] = (stat.st_size, stat.st_mtime_ns, content_hash)
+        return content_hash
+
+
+# Returns every file below root which isn't ignored together with its stat.
+# Stats can be made concurrently, which helps on network file systems.
+def scan(root: str, matcher: IgnoreMatcher, threads: int = 1, index: Optional[ScanIndex] = None) -> List[Tuple[str, os.stat_result]]:
+    if index:
+        index.add_root(root)
+    if matcher.is_ignored(root):
+        return []
+    if not os.path.isdir(root):
+        return [(root, os.stat(root))]
+
+    paths: List[str] = []
+    directories = [root]
+    while directories:
+        directory = directories.pop()
+        subdirectories, files = _list(directory, matcher, index)
+        directories.extend(f"{directory}/{d}" for d in subdirectories)
+        paths.extend(f"{directory}/{f}" for f in files)
+
+    def _stat(path: str) -> Tuple[str, os.stat_result]:
+        return path, os.stat(path)
+
+    if threads > 1 and len(paths) > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            return list(executor.map(_stat, paths))
+    return [_stat(p) for p in paths]
+
+
+def _list(directory: str, matcher: IgnoreMatcher, index: Optional[ScanIndex]) -> Listing:
+    mtime = 0
+    if index:
+        mtime = os.stat(directory).st_mtime_ns
+        listing = index.get(directory, mtime)
+        if listing:
+            return listing
+
+    subdirectories: List[str] = []
+    files: List[str] = []
+    with os.scandir(directory) as it:
+        for entry in it:
+            path = f"{directory}/{entry.name}"
+            if entry.is_dir():
+                if not matcher.is_pruned(path):
+                    subdirectories.append(entry.name)
+            elif not matcher.is_ignored(path):
+                files.append(entry.name)
+
+    if index:
+        index.put(directory, mtime, (subdirectories, files))
+    return subdirectories, files
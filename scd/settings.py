@@ -4,19 +4,25 @@ import textwrap
 from getpass import getpass
 from typing import List, Set, Dict, Optional
 
-from pygments import highlight, lexers, formatters
-
-from scd import colors
+from scd import colors, compression, inventory, rollout
 from scd.argparser import parser
 from scd.constants import *
-from scd.data_structs import FileData
+from scd.data_structs import FileData, ScriptData
 from scd.host_status import HostStatus
+from scd.inventory import Group, Inventory
 from scd.printer import Printer
 
 
 class Settings:
     DEFAULT_PORT = 22
     DEFAULT_TIMEOUT = 5
+    DEFAULT_PARALLEL = 1
+    DEFAULT_PROBE_PARALLEL = 32
+    DEFAULT_AGENT_TTL = 600
+    DEFAULT_CACHE_SIZE_MB = 256
+    DEFAULT_SCAN_THREADS = 1
+    DEFAULT_FACTS_TTL = 24 * 60 * 60
+    DEFAULT_OUTPUT_LINES = 100
     DEFAULT_CONFIG = textwrap.dedent("""
     {
         "user": "",
@@ -100,18 +106,16 @@ class Settings:
 
     def _print_host_status(self, host_to_print: str) -> None:
         host_status = HostStatus()
-        status = host_status.status
         if host_to_print == "all":
             self._print_colored_json(host_status.as_dict())
-        elif host_to_print in status:
-            self._print_colored_json(status[host_to_print])
-        else:
-            host_name = host_status.get_host_name(host_to_print)
-            if host_name not in host_status.status:
-                self.printer.error("No status saved for host %s.", host_to_print)
-                sys.exit(1)
+            sys.exit(0)
+
+        status = host_status.find(host_to_print)
+        if not status:
+            self.printer.error("No status saved for host %s.", host_to_print)
+            sys.exit(1)
 
-            self._print_colored_json(host_status.status[host_name])
+        self._print_colored_json(status)
         sys.exit(0)
 
     def _print_config(self, config: Dict[str, any]):
@@ -119,25 +123,55 @@ class Settings:
         sys.exit(0)
 
     def _parse_settings(self, args: any, config: Dict[str, any]) -> None:
-        self.hosts: List[str] = args.hosts or config.get("hosts") or self._error(
-            "No host specified. Specify hosts either in %s under the attribute %s or as a command line argument.",
-            SCD_CONFIG, '"hosts"'
-        )
-
-        self.user: str = args.user or config.get("user") or self._error(
-            "No user specified. Specify user either in %s under the attribute %s or using the %s (%s) flag.",
-            SCD_CONFIG, '"user"', "--user", "-u"
+        self.inventory = self._parse_inventory(args, config)
+        hosts = args.hosts or config.get("hosts") or self.inventory.all_hosts() or self._error(
+            "No host specified. Specify hosts either in %s under the attribute %s or %s or as a command line argument.",
+            SCD_CONFIG, '"hosts"', '"inventory"'
         )
+        try:
+            self.hosts: List[str] = self.inventory.expand(hosts)
+        except ValueError as e:
+            self._error("Invalid host: %s.", e)
+
+        self.user: Optional[str] = args.user or config.get("user")
+        if not self.user and not all(self.inventory.override_for(host, "user") for host in self.hosts):
+            self._error(
+                "No user specified. Specify user either in %s under the attribute %s or using the %s (%s) flag.",
+                SCD_CONFIG, '"user"', "--user", "-u"
+            )
 
         self.files = self._parse_files(config)
-        self.scripts: List[str] = config.get("scripts") or []
+        self.scripts = self._parse_scripts(config)
         self.programs: Set[str] = set(config.get("programs") or [])
         self.shell: Optional[str] = config.get("shell")
         self.ignored_files: List[str] = config.get("ignored_files") or []
+        self.use_scan_index: bool = config.get("scan_index") is not False
+        self.scan_threads = int(config.get("scan_threads") or self.DEFAULT_SCAN_THREADS)
         self.timeout = float(config.get("timeout") or self.DEFAULT_TIMEOUT)
         self.port = int(args.port or config.get("port") or self.DEFAULT_PORT)
+        self.probe: bool = args.probe
+        self.plan: bool = args.plan
+        self.parallel = int(args.parallel or config.get("parallel") or (self.DEFAULT_PROBE_PARALLEL if self.probe else self.DEFAULT_PARALLEL))
+        if self.parallel < 1:
+            self._error("Invalid value %s for %s, expected a positive number.", self.parallel, "parallel")
+        self.canary = int(args.canary or config.get("canary") or 0)
+        self.batch_size = int(args.batch_size or config.get("batch_size") or 0)
+        self.max_failures = self._parse_failure_budget(args, config)
         self.verbose: bool = args.verbose
+        self.output_lines = int(config.get("output_lines") or self.DEFAULT_OUTPUT_LINES)
+        self.log_folder: Optional[str] = args.log_folder or config.get("log_folder") or None
+        self.status_table: bool = args.status_table or config.get("status_table") is True
+        self.trace: Optional[str] = args.trace
+        self.profile: Optional[str] = args.profile
         self.force: bool = args.force
+        self.compression = self._parse_compression(args, config)
+        cache_size_mb = config.get("cache_size")
+        self.cache_size = int((self.DEFAULT_CACHE_SIZE_MB if cache_size_mb is None else cache_size_mb) * 1024 * 1024)
+        self.delta_transfer: bool = args.delta_transfer or config.get("delta_transfer") is True
+        # Probing measures the links to the hosts, which the agent would hide
+        self.use_agent: bool = (args.use_agent or config.get("use_agent") is True) and not self.probe
+        self.agent_ttl = float(config.get("agent_ttl") or self.DEFAULT_AGENT_TTL)
+        self.facts_ttl = float(config.get("facts_ttl") or self.DEFAULT_FACTS_TTL)
         self.private_key: str = args.private_key or config.get("private_key") or None
         self.password = self._get_password(config, args)
 
@@ -165,6 +199,113 @@ class Settings:
 
         return [_parse_file(file) for file in files]
 
+    def _parse_scripts(self, config: Dict[str, any]) -> List[ScriptData]:
+        def _parse_script(script: any) -> ScriptData:
+            if type(script) is str:
+                return ScriptData(script)
+            if type(script) is not dict or type(script.get("file")) is not str or not set(script) <= {"file", "after", "as_sudo"}:
+                self._error("Invalid script: %s. Expected a string or a dict containing %s and optionally %s and %s.", script, '"file"', '"after"', '"as_sudo"')
+
+            after = script.get("after") or []
+            if type(after) is not list or any(type(a) is not str for a in after):
+                self._error("Invalid value %s for %s of script %s, expected a list of scripts.", after, '"after"', script["file"])
+            return ScriptData(script["file"], after, script.get("as_sudo") is True)
+
+        scripts = {s.path: s for s in (_parse_script(script) for script in config.get("scripts") or [])}
+
+        # Sorted so that every script comes after the scripts it depends on
+        ordered: Dict[str, ScriptData] = {}
+        visiting: Set[str] = set()
+
+        def _visit(script: ScriptData) -> None:
+            if script.path in ordered:
+                return
+            if script.path in visiting:
+                self._error("Script %s depends on itself.", script.path)
+            visiting.add(script.path)
+            for dependency in script.after:
+                if dependency not in scripts:
+                    self._error("Script %s runs after %s which is not one of the configured scripts.", script.path, dependency)
+                _visit(scripts[dependency])
+            ordered[script.path] = script
+
+        for s in scripts.values():
+            _visit(s)
+        return list(ordered.values())
+
+    def _parse_inventory(self, args: any, config: Dict[str, any]) -> Inventory:
+        # Either the groups themselves or the path of a JSON file containing them
+        value = config.get("inventory") or {}
+        if type(value) is str:
+            path = os.path.expanduser(value)
+            if not os.path.isfile(path):
+                self._error("The inventory file %s does not exist.", value)
+            with open(path) as f:
+                try:
+                    value = json.load(f)
+                except json.decoder.JSONDecodeError as e:
+                    self.printer.error("Failed to parse inventory file %s:", value)
+                    self.printer.error(f"    {e}")
+                    sys.exit(1)
+        if type(value) is not dict:
+            self._error("Invalid inventory: %s. Expected an object mapping group names to groups or the path to a file containing one.", value)
+
+        # Settings given as flags apply to every host
+        flags = {key for key in inventory.OVERRIDES if getattr(args, key)}
+        groups = []
+        for name, group in value.items():
+            if type(group) is list:
+                group = {"hosts": group}
+            hosts = type(group) is dict and group.get("hosts")
+            if type(hosts) is not list or any(type(h) is not str for h in hosts) or not set(group) <= {"hosts", *inventory.OVERRIDES}:
+                self._error("Invalid group %s: %s. Expected a list of hosts or a dict containing %s and optionally %s, %s and %s.", name, group, '"hosts"', '"user"', '"port"', '"private_key"')
+            if "port" in group and type(group["port"]) is not int:
+                self._error("Invalid value %s for %s of group %s, expected a number.", group["port"], '"port"', name)
+
+            try:
+                groups.append(Group(name, hosts, {k: v for k, v in group.items() if k in inventory.OVERRIDES and k not in flags}))
+            except ValueError as e:
+                self._error("Invalid host in group %s: %s.", name, e)
+        return Inventory(groups)
+
+    def _parse_failure_budget(self, args: any, config: Dict[str, any]) -> Optional[int]:
+        value = args.max_failures or config.get("max_failures")
+        try:
+            budget = rollout.parse_failure_budget(value, len(self.hosts))
+        except ValueError:
+            budget = -1
+        if budget is not None and budget < 0:
+            self._error("Invalid value %s for %s, expected a number of hosts or a percentage such as %s.", value, "max_failures", "10%")
+        return budget
+
+    def user_for(self, url: str) -> str:
+        return self.inventory.override_for(url, "user") or self.user
+
+    def port_for(self, url: str) -> int:
+        return self.inventory.override_for(url, "port") or self.port
+
+    def private_key_for(self, url: str) -> Optional[str]:
+        return self.inventory.override_for(url, "private_key") or self.private_key
+
+    def _parse_compression(self, args: any, config: Dict[str, any]) -> Dict[str, str]:
+        # Either a single codec or a codec per host with an optional "default"
+        value = config.get("compression") or compression.AUTO
+        specs = dict(value) if type(value) is dict else {"default": value}
+        if args.compression:
+            specs["default"] = args.compression
+        specs.setdefault("default", compression.AUTO)
+
+        for host, spec in specs.items():
+            if type(spec) is not str or not compression.is_valid_spec(spec):
+                self._error(
+                    "Invalid compression %s for %s. Expected one of %s, %s, %s, %s or %s, optionally followed by a level such as %s.",
+                    spec, host, compression.AUTO, compression.NONE, compression.GZIP, compression.XZ, compression.ZSTD, "gzip:9"
+                )
+        return specs
+
+    def compression_for(self, url: str, name: str) -> str:
+        return self.compression.get(url) or self.compression.get(name) or self.compression["default"]
+
     def _get_password(self, config: Dict[str, any], args) -> str:
         password_file = args.password_file
         if password_file:
@@ -186,6 +327,7 @@ class Settings:
     def _print_colored_json(self, obj) -> None:
         formatted_json = json.dumps(obj, default=lambda o: o.__dict__, sort_keys=True, indent=4)
         if not colors.no_color:
+            from pygments import highlight, lexers, formatters
             formatted_json = highlight(formatted_json, lexers.JsonLexer(), formatters.TerminalFormatter()).strip()
         for line in formatted_json.split("\n"):
             self.printer.info(line)
@@ -0,0 +1,166 @@
+import json
+import os
+import threading
+from contextlib import contextmanager
+from timeit import default_timer as timer
+from typing import Dict, Iterator, List, Optional
+
+# Spans of time spent in each phase of a run, recorded when tracing is enabled
+# with --trace and written in the Chrome trace format which can be opened in
+# chrome://tracing or https://ui.perfetto.dev. Each host gets a row of its own.
+# Spans carry counts such as the number of files and bytes they handled.
+# With --profile, cProfile statistics of every thread are written as well.
+# Python 3.12 and later allow only one active profiler, that of the main thread.
+
+_enabled = False
+_origin = timer()
+_events: List[Dict[str, any]] = []
+_lock = threading.Lock()
+_local = threading.local()
+
+# Profilers of every thread when profiling with --profile
+_profiling = False
+_profilers: List[any] = []
+
+
+class Span:
+    def __init__(self, args: Dict[str, any]):
+        self.args = args
+
+    # Adds to the counts of the span, e.g. span.add(files=1, bytes=size)
+    def add(self, **counts: int) -> None:
+        for key, value in counts.items():
+            self.args[key] = self.args.get(key, 0) + value
+
+    def set(self, **args: any) -> None:
+        self.args.update(args)
+
+
+class _DisabledSpan(Span):
+    def __init__(self):
+        super().__init__({})
+
+    def add(self, **counts: int) -> None:
+        pass
+
+    def set(self, **args: any) -> None:
+        pass
+
+
+_DISABLED_SPAN = _DisabledSpan()
+
+
+def enable() -> None:
+    global _enabled
+    _enabled = True
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+# Spans recorded by the current thread are attributed to the given host
+def set_host(host: Optional[str]) -> None:
+    _local.host = host
+
+
+def get_host() -> Optional[str]:
+    return getattr(_local, "host", None)
+
+
+@contextmanager
+def span(name: str, **args: any) -> Iterator[Span]:
+    if not _enabled:
+        yield _DISABLED_SPAN
+        return
+
+    current = Span(args)
+    start = timer()
+    try:
+        yield current
+    finally:
+        record(name, start, timer(), **current.args)
+
+
+# Records a span that was measured elsewhere, such as a step executed on a host
+def record(name: str, start: float, end: float, **args: any) -> None:
+    if not _enabled:
+        return
+
+    event = {
+        "name": name,
+        "host": get_host(),
+        "start": start,
+        "end": end,
+        "args": args
+    }
+    with _lock:
+        _events.append(event)
+
+
+def write_trace(path: str) -> int:
+    # Returns the number of spans written
+    with _lock:
+        events = list(_events)
+
+    hosts = list(dict.fromkeys(e["host"] for e in events))
+    thread_ids = {host: i for i, host in enumerate(hosts)}
+    trace_events = [
+        {"name": "thread_name", "ph": "M", "pid": 0, "tid": thread_ids[host], "args": {"name": host or "scd"}}
+        for host in hosts
+    ]
+    for event in events:
+        trace_events.append({
+            "name": event["name"],
+            "cat": "scd",
+            "ph": "X",
+            "pid": 0,
+            "tid": thread_ids[event["host"]],
+            "ts": round((event["start"] - _origin) * 1e6),
+            "dur": round((event["end"] - event["start"]) * 1e6),
+            "args": event["args"]
+        })
+
+    with open(os.path.expanduser(path), "w") as f:
+        json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, f)
+    return len(events)
+
+
+def enable_profiling() -> None:
+    global _profiling
+    _profiling = True
+
+
+@contextmanager
+def profile() -> Iterator[None]:
+    # cProfile only sees the thread it was enabled in, so every thread doing
+    # work profiles itself and the results are merged when written
+    if not _profiling or getattr(_local, "profiler", None):
+        yield
+        return
+
+    import cProfile
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Another thread's profiler is already active
+        yield
+        return
+
+    with _lock:
+        _profilers.append(profiler)
+    _local.profiler = profiler
+    try:
+        yield
+    finally:
+        profiler.disable()
+        _local.profiler = None
+
+
+def write_profile(path: str) -> None:
+    import pstats
+    with _lock:
+        profilers = list(_profilers)
+    if profilers:
+        pstats.Stats(*profilers).dump_stats(os.path.expanduser(path))
@@ -1,9 +1,17 @@
+import os
 import textwrap
+import threading
 import time
 from datetime import datetime
 from timeit import default_timer as timer
+from typing import Set
 
-from scd.constants import TIME_FORMAT
+from scd.constants import TIME_FORMAT, SCD_FOLDER
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+_temporary_files: Set[str] = set()
+_temporary_files_lock = threading.Lock()
 
 
 def trim_multiline_str(string: str) -> str:
@@ -14,9 +22,49 @@ def get_time(start_time: float) -> str:
     return "%.2f" % (timer() - start_time)
 
 
+def format_size(size: int) -> str:
+    for unit in ["B", "KB", "MB", "GB"]:
+        if size < 1024 or unit == "GB":
+            return f"{size} {unit}" if unit == "B" else "%.1f %s" % (size, unit)
+        size /= 1024
+
+
 def date_to_time_stamp(date: str) -> float:
     return time.mktime(datetime.strptime(date, TIME_FORMAT).timetuple())
 
 
 def time_stamp_to_date(time_stamp: float) -> str:
     return datetime.fromtimestamp(time_stamp).strftime(TIME_FORMAT)
+
+
+def file_hash(path: str) -> str:
+    import hashlib
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def create_temporary_file(name: str) -> str:
+    # Every caller gets its own file so concurrent deployments never collide
+    import tempfile
+    fd, path = tempfile.mkstemp(prefix="scd_", suffix=f"_{name}", dir=SCD_FOLDER)
+    os.close(fd)
+    with _temporary_files_lock:
+        _temporary_files.add(path)
+    return path
+
+
+def remove_temporary_file(path: str) -> None:
+    with _temporary_files_lock:
+        _temporary_files.discard(path)
+    if os.path.isfile(path):
+        os.remove(path)
+
+
+def remove_temporary_files() -> None:
+    with _temporary_files_lock:
+        paths = list(_temporary_files)
+    for path in paths:
+        remove_temporary_file(path)
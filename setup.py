@@ -21,6 +21,7 @@ setup(
     url='https://github.com/timlindeberg/ShellConfigDeployer',
     packages=find_packages(),
     install_requires=requirements,
+    extras_require={'zstd': ['zstandard']},
     entry_points={'console_scripts': ['scd=scd.main:main']},
     package_data={'': ['README.md']},
     data_files=[('.', ['README.md'])],